@@ -0,0 +1,139 @@
+"""
+Database settings benchmark. Measures course insert and lookup throughput on
+a SQLite database file with different DB configuration options: SQLite's
+defaults (rollback journal, synchronous=FULL), WAL, WAL with
+synchronous=NORMAL, and WAL with synchronous=NORMAL and memory mapped I/O.
+Inserts commit one course at a time like the addcourse command, lookups go
+through AsyncDatabase with several worker threads like the reaction
+handlers, and the mixed test runs lookups while courses are being inserted.
+Results are printed as JSON operations per second for each setting.
+
+Run from the repository root:
+
+    python -m benchmarks.db_settings --courses 2000 --lookups 20000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from iteebot import database
+
+SETTINGS = {
+    "default": {},
+    "wal": {"WAL": True},
+    "wal_normal": {"WAL": True, "SYNCHRONOUS": "NORMAL"},
+    "wal_normal_mmap": {
+        "WAL": True, "SYNCHRONOUS": "NORMAL", "MMAP_SIZE": 268435456
+    },
+}
+
+def make_db_cfg(path, sqlite_cfg):
+    return {
+        "URL": f"sqlite:///{path}",
+        "PRE_PING": True,
+        "SQLITE": sqlite_cfg,
+    }
+
+def course(i):
+    return {
+        "code": f"C{i}",
+        "name_en": f"Course {i}",
+        "name_fi": f"Kurssi {i}",
+        "role_id": i,
+        "message_id": i,
+    }
+
+async def measure(db_cfg, options):
+    """
+    Runs the insert, lookup and mixed tests on one database configuration.
+    Returns operations per second for each test.
+    """
+
+    database.init_db(db_cfg)
+    async_db = database.AsyncDatabase(
+        database.get_engine(db_cfg), options.workers
+    )
+    rng = random.Random(options.seed)
+    results = {}
+
+    start = time.perf_counter()
+    for i in range(1, options.courses + 1):
+        await async_db.add_course(**course(i))
+    results["insert_per_s"] = options.courses / (time.perf_counter() - start)
+
+    async def lookups(count):
+        for i in range(count):
+            await async_db.find_courses(rng.randint(1, options.courses))
+
+    per_task = options.lookups // options.workers
+    start = time.perf_counter()
+    await asyncio.gather(*(lookups(per_task) for i in range(options.workers)))
+    results["lookup_per_s"] = (
+        per_task * options.workers / (time.perf_counter() - start)
+    )
+
+    async def inserts(count):
+        for i in range(count):
+            await async_db.add_course(**course(options.courses + 1 + i))
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        inserts(options.courses // 10),
+        *(lookups(per_task // 10) for i in range(options.workers - 1))
+    )
+    results["mixed_ops_per_s"] = (
+        (options.courses // 10 + per_task // 10 * (options.workers - 1))
+        / (time.perf_counter() - start)
+    )
+    async_db.close()
+    return results
+
+async def run_benchmark(options):
+    """
+    Runs the benchmark for every setting and returns the results as a
+    dictionary.
+
+    * options (Namespace) - benchmark options, see parse_args
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, sqlite_cfg in SETTINGS.items():
+            if options.only and name not in options.only:
+                continue
+            path = os.path.join(workdir, f"{name}.db")
+            results[name] = await measure(make_db_cfg(path, sqlite_cfg), options)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--courses", type=int, default=2000,
+                        help="courses inserted one transaction at a time")
+    parser.add_argument("--lookups", type=int, default=20000)
+    parser.add_argument("--workers", type=int, default=4,
+                        help="database thread pool size")
+    parser.add_argument("--only", nargs="*",
+                        help="only measure these settings")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = asyncio.run(run_benchmark(options))
+    if options.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
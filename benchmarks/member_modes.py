@@ -0,0 +1,191 @@
+"""
+Member cache benchmark. Compares the default mode, where every member is
+cached and the guild is chunked at startup, with low-memory mode, where
+members are fetched on demand into a bounded LRU. A simulated guild keeps
+its members in a compact server-side table and only creates member objects
+when they are chunked or fetched. Startup is timed with a simulated delay
+per chunk of 1000 members, and memory held by the process is measured with
+tracemalloc after startup and after a reaction workload that also resets
+one role. Results are printed as JSON for both modes.
+
+The mock member objects are much smaller than discord.py's, so the memory
+numbers show the difference between the modes rather than real sizes. The
+simulated server-side table is included in the numbers of both modes.
+
+Run from the repository root:
+
+    python -m benchmarks.member_modes --members 100000 --events 5000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy.orm import Session
+
+from iteebot import database
+from iteebot.configurator import FACTORY
+from tests.mocks import (
+    MockAPI, MockClient, MockGuild, MockMember, MockMessage,
+    MockReactionEvent
+)
+
+SIGNUP_CHANNEL = 1
+CONTROL_CHANNEL = 2
+GUILD = 1
+CHUNK = 1000
+
+class SimulatedGuild(MockGuild):
+    """
+    Guild whose members live in a server-side table of user ID to role IDs.
+    Member objects are only created by chunking (default mode) or fetching.
+    """
+
+    def __init__(self, guild_id, api, member_count):
+        super().__init__(guild_id, api)
+        self._server = {user_id: set() for user_id in range(1, member_count + 1)}
+
+    def _member(self, user_id):
+        member = MockMember(user_id, self)
+        member.roles = {self._roles[role_id] for role_id in self._server[user_id]}
+        return member
+
+    async def chunk(self, latency):
+        """
+        Simulates discord.py requesting all members at startup.
+        """
+
+        for i, user_id in enumerate(self._server):
+            if i % CHUNK == 0 and latency:
+                await asyncio.sleep(latency)
+            self._members[user_id] = self._member(user_id)
+
+    async def fetch_member(self, user_id):
+        await self._api.call()
+        return self._member(user_id)
+
+    async def fetch_members(self, limit=None):
+        for i, user_id in enumerate(self._server):
+            if i % CHUNK == 0:
+                await self._api.call()
+            yield self._member(user_id)
+
+def make_config(workdir, options, low_memory):
+    config = json.loads(json.dumps(FACTORY))
+    config["DB"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    config["SIGNUP_CHANNEL"] = SIGNUP_CHANNEL
+    config["CONTROL_CHANNEL"] = CONTROL_CHANNEL
+    config["LOG"]["FILE"] = os.path.join(workdir, "log", "iteebot.log")
+    config["ROLE_QUEUE"]["SETTLE"] = 0.01
+    config["OUTBOUND"]["RATE"] = 100000
+    config["OUTBOUND"]["BURST"] = 100000
+    config["MEMBERS"]["LOW_MEMORY"] = low_memory
+    config["MEMBERS"]["CACHE_SIZE"] = options.cache_size
+    return config
+
+async def measure(workdir, options, low_memory):
+    """
+    Starts a bot in one mode, runs the workload and returns the results.
+    """
+
+    config = make_config(workdir, options, low_memory)
+    database.init_db(config["DB"])
+    with Session(database.get_engine(config["DB"])) as s:
+        for i in range(1, options.courses + 1):
+            s.add(database.Course(code=f"C{i}", message_id=i, role_id=i))
+        s.commit()
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    bot = MockClient(config)
+    bot.api = MockAPI(options.latency)
+    bot.run()
+    bot.create_channel(SIGNUP_CHANNEL)
+    bot.create_channel(CONTROL_CHANNEL)
+    guild = SimulatedGuild(GUILD, bot.api, options.members)
+    guild.cache_members = not low_memory
+    bot._guilds[GUILD] = guild
+    for i in range(1, options.courses + 1):
+        guild.create_role(i)
+    await bot.setup_hook()
+    if not low_memory:
+        await guild.chunk(options.chunk_latency)
+    startup = time.perf_counter() - start
+    after_startup = tracemalloc.get_traced_memory()[0] - base
+
+    rng = random.Random(options.seed)
+    messages = [MockMessage(i, "") for i in range(1, options.courses + 1)]
+    for i in range(options.events):
+        user_id = rng.randint(1, options.members)
+        member = guild.get_member(user_id) or guild._member(user_id)
+        event = MockReactionEvent(
+            rng.choice(messages), SIGNUP_CHANNEL, GUILD, member
+        )
+        if rng.random() < 0.7:
+            await bot.on_raw_reaction_add(event)
+        else:
+            await bot.on_raw_reaction_remove(event)
+    await bot._roles.drain()
+    await bot._remove_role_from_all(guild.get_role(1), "Benchmark reset")
+    after_workload, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results = {
+        "startup_seconds": startup,
+        "memory_after_startup_mb": after_startup / 2**20,
+        "memory_after_workload_mb": (after_workload - base) / 2**20,
+        "memory_peak_mb": (peak - base) / 2**20,
+        "api_calls": bot.api.calls,
+        "member_cache": bot._members.stats(),
+    }
+    await bot.close()
+    return results
+
+async def run_benchmark(options):
+    """
+    Runs the benchmark in both modes and returns the results as a
+    dictionary.
+
+    * options (Namespace) - benchmark options, see parse_args
+    """
+
+    results = {}
+    for name, low_memory in (("default", False), ("low_memory", True)):
+        with tempfile.TemporaryDirectory() as workdir:
+            results[name] = await measure(workdir, options, low_memory)
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--members", type=int, default=100000)
+    parser.add_argument("--courses", type=int, default=50)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--cache-size", type=int, default=10000,
+                        help="member LRU size in low-memory mode")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated API latency in seconds")
+    parser.add_argument("--chunk-latency", type=float, default=0.01,
+                        help="simulated time per member chunk at startup")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = asyncio.run(run_benchmark(options))
+    if options.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
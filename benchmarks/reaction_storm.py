@@ -0,0 +1,210 @@
+"""
+Reaction storm benchmark. Drives a large number of synthetic reaction add,
+remove and clear events, and control channel commands, through the real
+ITEEBot handlers using the mockups from tests/mocks.py. The simulated API can
+be given latency and a failure rate. Results are printed as JSON: overall
+throughput, p50/p95/p99 latency and error count for each handler, and API
+call counts.
+
+Run from the repository root:
+
+    python -m benchmarks.reaction_storm --events 20000 --latency 0.005
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy.orm import Session
+
+from iteebot import database
+from iteebot.configurator import FACTORY
+from tests.mocks import (
+    MockAPI, MockClient, MockMessage, MockReactionEvent
+)
+
+SIGNUP_CHANNEL = 1
+CONTROL_CHANNEL = 2
+GUILD = 1
+COMMANDS = ("!test", "!stats")
+
+def percentile(sorted_values, fraction):
+    """
+    Returns the value at the given fraction of a sorted list using the
+    nearest rank method.
+
+    * sorted_values (list) - sorted samples
+    * fraction (float) - percentile as a fraction, e.g. 0.95
+    """
+
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1,
+                      round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def summarize(samples):
+    """
+    Summarizes handler latency samples (seconds) as milliseconds.
+
+    * samples (list) - latency samples
+    """
+
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p95_ms": percentile(samples, 0.95) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": (samples[-1] if samples else 0.0) * 1000,
+    }
+
+def make_config(workdir, options):
+    config = json.loads(json.dumps(FACTORY))
+    config["DB"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    config["SIGNUP_CHANNEL"] = SIGNUP_CHANNEL
+    config["CONTROL_CHANNEL"] = CONTROL_CHANNEL
+    config["LOG"]["FILE"] = os.path.join(workdir, "log", "iteebot.log")
+    config["ROLE_QUEUE"]["SETTLE"] = options.settle
+    config["OUTBOUND"]["RATE"] = options.rate
+    config["OUTBOUND"]["BURST"] = options.rate
+    return config
+
+def make_bot(config, options):
+    """
+    Creates a mock bot with a populated database, guild, roles and members.
+    """
+
+    database.init_db(config["DB"])
+    with Session(database.get_engine(config["DB"])) as s:
+        for i in range(1, options.courses + 1):
+            s.add(database.Course(code=f"C{i}", message_id=i, role_id=i))
+        s.commit()
+
+    bot = MockClient(config)
+    bot.api = MockAPI(options.latency, options.failure_rate, options.seed)
+    bot.run()
+    bot.create_channel(SIGNUP_CHANNEL)
+    bot.create_channel(CONTROL_CHANNEL)
+    guild = bot.create_guild(GUILD)
+    for i in range(1, options.courses + 1):
+        guild.create_role(i)
+    for i in range(1, options.members + 1):
+        guild.create_member(i)
+    return bot, guild
+
+def generate_events(bot, guild, options):
+    """
+    Generates (handler name, handler, argument) tuples for the event mix.
+    """
+
+    rng = random.Random(options.seed)
+    messages = [MockMessage(i, "") for i in range(1, options.courses + 1)]
+    members = list(guild._members.values())
+    for i in range(options.events):
+        roll = rng.random()
+        if roll < options.command_rate:
+            msg = MockMessage(0, rng.choice(COMMANDS))
+            yield "_parse_command", bot._parse_command, msg
+            continue
+
+        event = MockReactionEvent(
+            rng.choice(messages), SIGNUP_CHANNEL, GUILD, rng.choice(members)
+        )
+        if roll < options.command_rate + options.clear_rate:
+            yield "on_raw_reaction_clear", bot.on_raw_reaction_clear, event
+        elif rng.random() < 0.7:
+            yield "on_raw_reaction_add", bot.on_raw_reaction_add, event
+        else:
+            yield "on_raw_reaction_remove", bot.on_raw_reaction_remove, event
+
+async def run_benchmark(options):
+    """
+    Runs the benchmark and returns the results as a dictionary.
+
+    * options (Namespace) - benchmark options, see main
+    """
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bot, guild = make_bot(make_config(workdir, options), options)
+        await bot.setup_hook()
+        samples = {}
+        errors = {}
+
+        async def timed(name, handler, arg):
+            # exceptions would go to on_error when dispatched by discord.py
+            start = time.perf_counter()
+            try:
+                await handler(arg)
+            except Exception:
+                errors[name] = errors.get(name, 0) + 1
+            samples.setdefault(name, []).append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        batch = []
+        for name, handler, arg in generate_events(bot, guild, options):
+            batch.append(asyncio.create_task(timed(name, handler, arg)))
+            if len(batch) >= options.batch:
+                await asyncio.gather(*batch)
+                batch = []
+        await asyncio.gather(*batch)
+        handled = time.perf_counter() - start
+        await bot._roles.drain()
+        drained = time.perf_counter() - start
+        await bot.close()
+
+    return {
+        "events": options.events,
+        "handled_seconds": handled,
+        "drained_seconds": drained,
+        "throughput_eps": options.events / handled if handled else 0.0,
+        "handlers": {
+            name: dict(summarize(values), errors=errors.get(name, 0))
+            for name, values in sorted(samples.items())
+        },
+        "api": {"calls": bot.api.calls, "failures": bot.api.failures},
+        "role_queue": bot._roles.stats(),
+        "outbound": bot._outbound.stats(),
+    }
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--events", type=int, default=20000)
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--courses", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated API latency in seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0,
+                        help="probability of a simulated API call failing")
+    parser.add_argument("--command-rate", type=float, default=0.01,
+                        help="fraction of events that are commands")
+    parser.add_argument("--clear-rate", type=float, default=0.0005,
+                        help="fraction of events that are reaction clears")
+    parser.add_argument("--settle", type=float, default=0.05,
+                        help="role queue settle window in seconds")
+    parser.add_argument("--rate", type=float, default=100000,
+                        help="outbound scheduler rate (calls per second)")
+    parser.add_argument("--batch", type=int, default=500,
+                        help="events dispatched concurrently")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = asyncio.run(run_benchmark(options))
+    if options.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+"""
+Startup benchmark. Runs each iteebot command line command, and run_s2i.py,
+in a fresh interpreter with -X importtime and reports how long importing
+modules took, how many modules were imported and whether discord.py was
+among them. Commands run against a temporary configuration and database.
+The run commands can't log in with the dummy token, so they fail after
+their imports are done, which doesn't affect the measurement. A bare
+interpreter is measured as the baseline.
+
+Run from the repository root:
+
+    python -m benchmarks.startup --repeat 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def parse_importtime(output):
+    """
+    Parses -X importtime output. Returns the total import time in
+    milliseconds (sum of the cumulative times of top level imports) and the
+    names of the imported modules.
+
+    * output (str) - stderr of the interpreter
+    """
+
+    total = 0
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # header line
+            continue
+        name = fields[2]
+        modules.append(name.strip())
+        if not name[1:].startswith(" "):
+            total += cumulative
+    return total / 1000, modules
+
+def make_workdir(workdir):
+    """
+    Writes the configuration and course files used by the commands.
+    """
+
+    config = os.path.join(workdir, "config.json")
+    with open(config, "w") as f:
+        json.dump({
+            "TOKEN": "benchmark",
+            "DB": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            "LOG": {"FILE": os.path.join(workdir, "log", "iteebot.log")},
+            "RECONCILE": {"ENABLED": False},
+        }, f)
+    courses = os.path.join(workdir, "courses.csv")
+    with open(courses, "w") as f:
+        f.write("role_id,code,name_en,name_fi\n1,C1,Course,Kurssi\n")
+    return config, courses
+
+def commands(workdir):
+    """
+    Returns (name, argv, extra environment) for each measured command.
+    """
+
+    config, courses = make_workdir(workdir)
+    manage = [sys.executable, "-X", "importtime", "-m", "iteebot.manage"]
+    return [
+        ("python", [sys.executable, "-X", "importtime", "-c", "pass"], {}),
+        ("init-config", manage + [
+            "init-config", os.path.join(workdir, "new", "config.json")
+        ], {}),
+        ("init-db", manage + ["init-db", config], {}),
+        ("migrate", manage + ["migrate", config], {}),
+        ("import-courses", manage + ["import-courses", courses, config], {}),
+        ("run", manage + ["run", config], {}),
+        ("run_s2i.py", [
+            sys.executable, "-X", "importtime",
+            os.path.join(ROOT, "run_s2i.py")
+        ], {
+            "CONFIG_PATH": config,
+            "DISCORD_TOKEN": "benchmark",
+            "DB_STRING": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        }),
+    ]
+
+def measure(argv, env, cwd, timeout=60):
+    """
+    Runs one command and returns its total import time in milliseconds and
+    imported module names.
+    """
+
+    env = dict(os.environ, PYTHONPATH=ROOT, **env)
+    try:
+        result = subprocess.run(
+            argv, cwd=cwd, env=env, capture_output=True, text=True,
+            timeout=timeout
+        )
+        output = result.stderr
+    except subprocess.TimeoutExpired as e:
+        output = e.stderr or ""
+        if isinstance(output, bytes):
+            output = output.decode()
+    return parse_importtime(output)
+
+def run_benchmark(options):
+    """
+    Measures every command and returns the results as a dictionary.
+
+    * options (Namespace) - benchmark options, see parse_args
+    """
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, argv, env in commands(workdir):
+            if options.only and name not in options.only:
+                continue
+            times = []
+            for i in range(options.repeat):
+                import_ms, modules = measure(argv, env, workdir)
+                times.append(import_ms)
+            results[name] = {
+                "import_ms": statistics.median(times),
+                "modules": len(modules),
+                "discord": "discord" in modules,
+                "sqlalchemy": "sqlalchemy" in modules,
+            }
+    return results
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="runs per command, the median is reported")
+    parser.add_argument("--only", nargs="*",
+                        help="only measure these commands")
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = run_benchmark(options)
+    if options.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -4,64 +4,189 @@ education Discord server to allow users to sign up for course areas.
 It holds an internal database of registered courses, each with an assigned
 role ID, and a signup message ID. When user reacts to the signup message, the
 bot will assign the associated role for that user. When they remove reaction,
-the bot will remove the associated role.
+the bot will remove the associated role. A signup message can also hold
+several courses, each signed up for with its own reaction emoji.
+
+One bot can serve several guilds, each with its own control and signup
+channels. For large deployments the sharded variant of the bot can be created
+with create_bot.
 """
 
+import asyncio
+import datetime
 import logging
 import os
-import sys
-from logging.handlers import TimedRotatingFileHandler
+import signal
+from contextlib import asynccontextmanager
 
 import discord
-from sqlalchemy.orm import Session
 
+from . import configurator as conf
 from . import database as db
+from .bulk import BulkRoleOperation
+from .commands import CommandRegistry, CommandError, command
+from .coordination import Coordinator
+from .counters import SignupCounters
+from .courseindex import CourseIndex, UNKNOWN
+from .journal import RoleJournal
+from .importer import (
+    CourseFileError, content_digest, parse_courses, render_group,
+    render_signup
+)
+from .logs import setup_logging, stop_logging
+from .members import MemberCache
+from .metrics import Metrics, MetricsServer, instrumented
+from .reconcile import Reconciler
+from .recorder import EventRecorder, message_fields, reaction_fields
+from .rolequeue import RoleChangeQueue
+from .scheduler import OutboundScheduler, TokenBucket, INTERACTIVE, BULK
+from .signuplog import SignupLog
+
+# Maximum length of a Discord message
+MESSAGE_LIMIT = 2000
+# Maximum number of different reactions on a Discord message
+REACTION_LIMIT = 20
+# Maximum number of messages in one bulk delete
+BULK_DELETE_LIMIT = 100
+# Bulk delete only accepts messages younger than two weeks, minus a margin
+# for clock differences
+BULK_DELETE_AGE = datetime.timedelta(days=14, minutes=-10)
 
 class ITEEBot(discord.Client):
     """
     This class extends discord.py Client. Primary addition is the ability to
     hold two internal objects: a configuration dictionary, and SQLAlchemy
     engine object for database access. These are held in internal attributes
-    _cfg and _engine, respectively.
+    _cfg and _engine, respectively. All database access from event handlers
+    goes through the asynchronous wrapper in _db.
+
+    Registered courses are also kept in an in-memory index (_courses) so that
+    reactions can be resolved without querying the database. Role changes
+    caused by reactions are buffered per member in _roles, which combines
+    them into as few API calls as possible. All outbound API calls are paced
+    and prioritized by the _outbound scheduler. Handler, query and API call
+    latencies are recorded in _metrics. Handled reactions are recorded as
+    signup events through the write-behind buffer in _signups, and counted
+    per course in _counts.
+
+    Per-guild configuration is resolved once into dictionaries keyed by
+    guild and channel ID, so routing an event to its guild's configuration is
+    a single lookup regardless of the number of guilds.
+
+    When several bot processes share one database (CLUSTER option), leases
+    held through _coordinator decide which shards each process connects and
+    make sure that bulk jobs only run in one process.
+
+    Configuration can be reloaded while the bot is running, see
+    reload_config. Handled events can be recorded for offline replay
+    (RECORD option) through _recorder. Role operations can be journaled in
+    _journal (JOURNAL option), so that they are retried after failures and
+    restarts.
     """
     
-    def __init__(self, config, *args, debug=False, **kwargs):
+    def __init__(self, config, *args, debug=False, config_path=None,
+                 **kwargs):
         """
         Initializes the bot using options from a configuration file. Also
-        initializes logging based on the debug argument, using stdout if it is
-        True, or a time rotating logger otherwise.
+        initializes logging based on the debug argument, using stderr if it is
+        True, or a time rotating logger otherwise. Log records are written by
+        a background thread, see the logs module.
         
         Intents are currently hard-coded based on what are needed for the bot's
-        current features.
+        current features. In low-memory mode (MEMBERS.LOW_MEMORY) discord.py
+        doesn't cache members or request them at startup, and members are
+        looked up through _members instead.
         
         * config (dict) - configuration dictionary from the configurator module
         * debug (bool) - run in debug mode
+        * config_path (str) - configuration file to reload from, if any
         """
     
         self._cfg = config
+        self._config_path = config_path
+        self._config_mtime = None
+        self._watch_task = None
+        self._build_routing(config)
         intents = discord.Intents(
             members=True,
             messages=True,
             reactions=True,
             guilds=True
         )
+        self._metrics = Metrics()
+        self._metrics_server = None
+        self._reconcile_task = None
+        self._lease_task = None
+        self._journal_task = None
+        self._shutdown_task = None
+        self._one_shot = False
         self._engine = db.get_engine(config["DB"])
-        if debug:   
-            logging.basicConfig(level=logging.DEBUG)
-        else:
-            os.makedirs(os.path.dirname(config["LOG"]["FILE"]), exist_ok=True)
-            rotator = TimedRotatingFileHandler(
-                config["LOG"]["FILE"],
-                when=config["LOG"]["ROTATE"][0],
-                interval=config["LOG"]["ROTATE"][1],
+        self._db = db.AsyncDatabase(
+            self._engine, config["DB_WORKERS"], self._metrics
+        )
+        self._coordinator = None
+        if config["CLUSTER"]["ENABLED"]:
+            self._coordinator = Coordinator(
+                self._db,
+                config["CLUSTER"]["HOLDER"],
+                config["CLUSTER"]["LEASE_TTL"],
+            )
+        self._courses = CourseIndex()
+        self._counts = SignupCounters()
+        self._outbound = OutboundScheduler(
+            rate=config["OUTBOUND"]["RATE"],
+            burst=config["OUTBOUND"]["BURST"],
+            concurrency=config["OUTBOUND"]["CONCURRENCY"],
+            metrics=self._metrics,
+        )
+        low_memory = config["MEMBERS"]["LOW_MEMORY"]
+        self._members = MemberCache(
+            self._outbound, config["MEMBERS"]["CACHE_SIZE"], low_memory
+        )
+        self._journal = None
+        if config["JOURNAL"]["ENABLED"]:
+            self._journal = RoleJournal(
+                config["JOURNAL"]["FILE"],
+                config["JOURNAL"]["BACKOFF"],
+                config["JOURNAL"]["MAX_BACKOFF"],
+                config["JOURNAL"]["MAX_ATTEMPTS"],
+            )
+            self._metrics.collect("role_journal", self._journal.stats)
+        self._roles = RoleChangeQueue(
+            config["ROLE_QUEUE"]["SETTLE"],
+            self._outbound,
+            trust_roles=not low_memory,
+            journal=self._journal,
+            on_change=self._counts.change
+        )
+        self._metrics.collect("course_index", self._courses.stats)
+        self._metrics.collect("role_queue", self._roles.stats)
+        self._signups = None
+        if config["SIGNUP_LOG"]["ENABLED"]:
+            self._signups = SignupLog(
+                self._db,
+                config["SIGNUP_LOG"]["FLUSH_INTERVAL"],
+                config["SIGNUP_LOG"]["BATCH_SIZE"],
             )
-            logging.basicConfig(
-                format="%(asctime)s %(name)s %(levelname)-8s %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-                handlers=[rotator],
-                level=logging.INFO
+            self._metrics.collect("signup_log", self._signups.stats)
+        self._metrics.collect("member_cache", self._members.stats)
+        self._recorder = None
+        if config["RECORD"]["ENABLED"]:
+            self._recorder = EventRecorder(config["RECORD"]["FILE"])
+        for lane in self._outbound.stats():
+            self._metrics.collect(
+                "outbound",
+                lambda lane=lane: self._outbound.stats()[lane],
+                lane=lane
             )
+        setup_logging(config["LOG"], debug)
+        if low_memory:
+            kwargs.setdefault(
+                "member_cache_flags", discord.MemberCacheFlags.none()
+            )
+            kwargs.setdefault("chunk_guilds_at_startup", False)
         super().__init__(*args, intents=intents, **kwargs)
+        self._commands = CommandRegistry(self)
     
     def run(self, *args, **kwargs):
         """
@@ -69,114 +194,1326 @@ class ITEEBot(discord.Client):
         """
     
         super().run(self._cfg["TOKEN"], *args, **kwargs)
+
+    def _build_routing(self, config):
+        """
+        Resolves the configuration of each guild in the GUILDS option on top
+        of the top level channel and message options, which also act as the
+        default configuration for guilds that are not listed. Builds lookup
+        dictionaries from guild, signup channel and control channel IDs to
+        the resolved configurations. Each configuration has the keys
+        GUILD_ID, CONTROL_CHANNEL, SIGNUP_CHANNEL and MESSAGES.
+
+        * config (dict) - configuration dictionary
+        """
+
+        default = {
+            "GUILD_ID": None,
+            "CONTROL_CHANNEL": config["CONTROL_CHANNEL"],
+            "SIGNUP_CHANNEL": config["SIGNUP_CHANNEL"],
+            "MESSAGES": config["MESSAGES"],
+        }
+        guilds = {}
+        for guild_id, local in config["GUILDS"].items():
+            guild_cfg = dict(default, GUILD_ID=int(guild_id))
+            guild_cfg.update(local)
+            guild_cfg["MESSAGES"] = dict(
+                default["MESSAGES"], **local.get("MESSAGES", {})
+            )
+            guilds[int(guild_id)] = guild_cfg
+
+        configs = [default] + list(guilds.values())
+        self._default_guild_cfg = default
+        self._guild_cfgs = guilds
+        self._signup_channels = {c["SIGNUP_CHANNEL"]: c for c in configs}
+        self._control_channels = {c["CONTROL_CHANNEL"]: c for c in configs}
+
+    def reload_config(self, config=None):
+        """
+        Replaces the configuration of the running bot. The new configuration
+        is loaded from the bot's configuration file unless given. If it can't
+        be loaded or is not valid, the old configuration is kept. Options in
+        configurator.RESTART_KEYS keep their current values. The swap and the
+        rebuild of the guild routing happen without yielding to the event
+        loop, so event handlers never see a partially updated configuration.
+        Returns True if the configuration was replaced.
+
+        * config (dict) - new configuration dictionary, optional
+        """
+
+        if config is None:
+            try:
+                config = conf.load_config(self._config_path)
+            except (OSError, conf.ConfigError) as e:
+                logging.error(f"Configuration not reloaded: {e}")
+                return False
+        else:
+            try:
+                conf.validate_config(config)
+            except conf.ConfigError as e:
+                logging.error(f"Configuration not reloaded: {e}")
+                return False
+
+        for key in conf.RESTART_KEYS:
+            if config[key] != self._cfg[key]:
+                logging.warning(f"Changes to {key} need a restart")
+            config[key] = self._cfg[key]
+        self._build_routing(config)
+        self._cfg = config
+        logging.info("Configuration reloaded")
+        return True
+
+    async def _watch_config(self):
+        """
+        Reloads the configuration whenever the configuration file's
+        modification time changes. The file is checked every RELOAD.INTERVAL
+        seconds.
+        """
+
+        while True:
+            await asyncio.sleep(self._cfg["RELOAD"]["INTERVAL"])
+            try:
+                mtime = os.stat(self._config_path).st_mtime
+            except OSError:
+                continue
+            if mtime != self._config_mtime:
+                self._config_mtime = mtime
+                self.reload_config()
+
+    def _guild_config(self, guild_id):
+        """
+        Returns the resolved configuration for a guild.
+
+        * guild_id (int) - guild ID, or None for the default configuration
+        """
+
+        return self._guild_cfgs.get(guild_id, self._default_guild_cfg)
+
+    @staticmethod
+    def _guild_id(message):
+        """
+        Returns the ID of the guild a message was sent in, or None.
+
+        * message (Message) - a discord.py message object
+        """
+
+        return message.guild.id if message.guild is not None else None
+
+    async def setup_hook(self):
+        """
+        Loads all registered courses into the course index before the bot
+        connects to the gateway. Also starts the lease renewal task in
+        cluster mode and the event recording if enabled, and opens the role
+        journal. Jobs run from the command line with run_once stop there,
+        the running bot also starts its services, see _start_services.
+        """
+
+        await self._load_courses()
+        if self._recorder is not None:
+            self._recorder.start(self._courses.entries())
+        if self._journal is not None:
+            await self._journal.open()
+        if self._coordinator is not None:
+            self._lease_task = asyncio.create_task(
+                self._coordinator.run_renewal(self._leases_lost)
+            )
+        if not self._one_shot:
+            await self._start_services()
+
+    async def _start_services(self):
+        """
+        Starts the metrics HTTP endpoint if it has been enabled in the
+        configuration, and configuration reloading if the bot was created
+        with a configuration file path. SIGTERM is set to shut the bot down
+        gracefully, see close.
+        """
+
+        try:
+            asyncio.get_running_loop().add_signal_handler(
+                signal.SIGTERM, self._terminate
+            )
+        except (AttributeError, NotImplementedError, RuntimeError):
+            logging.info("SIGTERM not available for graceful shutdown")
+        if self._config_path is not None:
+            self._config_mtime = os.stat(self._config_path).st_mtime
+            try:
+                asyncio.get_running_loop().add_signal_handler(
+                    signal.SIGHUP, self.reload_config
+                )
+            except (AttributeError, NotImplementedError, RuntimeError):
+                logging.info("SIGHUP not available for configuration reload")
+            if self._cfg["RELOAD"]["WATCH"]:
+                self._watch_task = asyncio.create_task(self._watch_config())
+        if self._cfg["METRICS"]["ENABLED"]:
+            self._metrics_server = MetricsServer(
+                self._metrics,
+                self._cfg["METRICS"]["HOST"],
+                self._cfg["METRICS"]["PORT"],
+            )
+            await self._metrics_server.start()
+
+    def _terminate(self):
+        """
+        SIGTERM handler. Starts closing the bot unless it's already closing.
+        """
+
+        if self._shutdown_task is None:
+            logging.info("SIGTERM received, shutting down")
+            self._shutdown_task = asyncio.create_task(self.close())
+
+    async def close(self):
+        """
+        Flushes pending role changes, signup events and outbound calls, closes
+        the client and shuts down the database thread pool and metrics
+        endpoint. Pending role changes are given SHUTDOWN.DRAIN_DEADLINE
+        seconds to finish; changes that don't make it stay in the role
+        journal, if enabled, and are made after the next start.
+        """
+
+        for task in (self._reconcile_task, self._lease_task,
+                     self._watch_task, self._journal_task):
+            if task is not None:
+                task.cancel()
+        deadline = self._cfg["SHUTDOWN"]["DRAIN_DEADLINE"]
+        try:
+            await asyncio.wait_for(self._roles.drain(), deadline)
+        except asyncio.TimeoutError:
+            logging.warning(
+                f"Role changes were not finished within {deadline} seconds" +
+                (", they are kept in the journal" if self._journal else "")
+            )
+        if self._signups is not None:
+            await self._signups.close()
+        await self._outbound.close()
+        await super().close()
+        if self._coordinator is not None:
+            await self._coordinator.release_all()
+        if self._journal is not None:
+            await self._journal.close()
+        self._db.close()
+        if self._metrics_server is not None:
+            await self._metrics_server.stop()
+        if self._recorder is not None:
+            self._recorder.close()
+        stop_logging()
+
+    async def connect(self, *args, **kwargs):
+        """
+        Connects to the gateway. In cluster mode this process's share of the
+        shards is claimed first, waiting as a standby if all shards are
+        taken by other processes.
+        """
+
+        if self._coordinator is not None:
+            self.shard_ids = await self._coordinator.claim_shards(
+                self._cfg["SHARDING"]["SHARD_COUNT"],
+                self._cfg["CLUSTER"]["PROCESSES"],
+            )
+        await super().connect(*args, **kwargs)
+
+    async def _leases_lost(self, names):
+        """
+        Called by the lease renewal task when leases have been taken over by
+        another process. The bot shuts down so that two processes never run
+        the same shard, and the process can be restarted as a standby. The
+        shutdown runs in its own task like in _terminate, because close
+        cancels the lease renewal task this is called from.
+
+        * names (list) - names of the lost leases
+        """
+
+        logging.error(f"Lost leases {', '.join(names)}, shutting down")
+        if self._shutdown_task is None:
+            self._shutdown_task = asyncio.create_task(self.close())
+
+    @asynccontextmanager
+    async def _exclusive(self, name):
+        """
+        Async context manager for jobs that must only run in one process.
+        Yields True if the job can run, always when not in cluster mode.
+
+        * name (str) - job lease name
+        """
+
+        if self._coordinator is None:
+            yield True
+        else:
+            async with self._coordinator.exclusive(name) as acquired:
+                yield acquired
+
+    async def run_once(self, job, *args):
+        """
+        Logs in without connecting to the gateway, runs a job coroutine
+        function with the given arguments, and closes the client. Used for
+        running jobs from the command line, so the metrics endpoint, signal
+        handlers and configuration reloading of the running bot are not
+        started. Returns the job's result.
+
+        * job (coroutine function) - the job to run
+        """
+
+        self._one_shot = True
+        async with self:
+            await self.login(self._cfg["TOKEN"])
+            return await job(*args)
+
+    async def import_courses(self, courses, channel=None, guild_id=None):
+        """
+        Imports courses, posting a signup message for each one that isn't
+        already registered, and writing all new course records in one
+        transaction. Up to IMPORT.WINDOW messages are sent at once through
+        the outbound scheduler's bulk lane. In cluster mode, raises
+        CommandError if another process is importing to the same guild.
+
+        If an earlier import was interrupted after posting messages but
+        before writing the records, the messages are found from the signup
+        channel's history by their content and reused instead of posting
+        duplicates. Returns a dictionary of counts.
+
+        * courses (list) - course dictionaries from importer.parse_courses
+        * channel (TextChannel) - signup channel, fetched if not given
+        * guild_id (int) - guild to import to, None for default configuration
+        """
+
+        async with self._exclusive(f"job:import:{guild_id}") as acquired:
+            if not acquired:
+                raise CommandError("An import is already running elsewhere")
+            return await self._import_courses(courses, channel, guild_id)
+
+    async def _import_courses(self, courses, channel, guild_id):
+        guild_cfg = self._guild_config(guild_id)
+        channel = await self._signup_channel(guild_cfg, channel)
+        template = guild_cfg["MESSAGES"]["SIGNUP"]
+        registered = await self._guild_courses(guild_cfg)
+        known = {(c.role_id, c.code) for c in registered}
+        pending = [
+            c for c in courses if (c["role_id"], c["code"]) not in known
+        ]
+        counts = {
+            "added": 0,
+            "adopted": 0,
+            "skipped": len(courses) - len(pending),
+            "failed": 0,
+        }
+        if not pending:
+            return counts
+
+        orphans = await self._orphan_signups(
+            channel,
+            {c.message_id for c in registered},
+            len(pending) + self._cfg["IMPORT"]["HISTORY"]
+        )
+        rows = []
+        posts = []
+        for course in pending:
+            content = render_signup(template, course)
+            if orphans.get(content):
+                rows.append(dict(
+                    course,
+                    message_id=orphans[content].pop(),
+                    guild_id=guild_id,
+                    rendered=content_digest(content)
+                ))
+                counts["adopted"] += 1
+            else:
+                posts.append((course, content))
+
+        posted = await self._post_signups(channel, posts, guild_id, counts)
+        rows.extend(posted.values())
+        for course in await self._db.add_courses(rows):
+            self._courses.add(course.message_id, course)
+            if (course.message_id in posted
+                    and self._counts.get(course.role_id) is None):
+                self._counts.set(course.role_id, 0)
+        counts["added"] = len(rows)
+        return counts
+
+    async def _orphan_signups(self, channel, used, limit):
+        """
+        Finds the bot's messages in the signup channel's recent history that
+        are not signup messages of any course, left behind by an interrupted
+        import. Returns a dictionary of message IDs by content.
+
+        * channel (TextChannel) - signup channel
+        * used (set) - message IDs of registered courses
+        * limit (int) - number of recent messages to look through
+        """
+
+        orphans = {}
+        async for old in self._outbound.pages(
+            BULK, channel.history, "before", limit=limit
+        ):
+            if old.author == self.user and old.id not in used:
+                orphans.setdefault(old.content, []).append(old.id)
+        return orphans
+
+    async def _post_signups(self, channel, posts, guild_id, counts):
+        """
+        Posts signup messages for imported courses, up to IMPORT.WINDOW at a
+        time through the bulk lane. Failed posts are counted in counts.
+        Returns the course records to write by message ID.
+
+        * channel (TextChannel) - signup channel
+        * posts (list) - (course dictionary, message content) pairs
+        * guild_id (int) - guild of the courses
+        * counts (dict) - import counts
+        """
+
+        window = asyncio.Semaphore(self._cfg["IMPORT"]["WINDOW"])
+        rows = {}
+
+        async def post(course, content):
+            async with window:
+                try:
+                    signup = await self._outbound.call(
+                        BULK, channel.send, content
+                    )
+                except discord.HTTPException as e:
+                    logging.warning(f"Import failed for {course['code']}: {e}")
+                    counts["failed"] += 1
+                    return
+            rows[signup.id] = dict(
+                course,
+                message_id=signup.id,
+                guild_id=guild_id,
+                rendered=content_digest(content)
+            )
+
+        await asyncio.gather(*(post(c, content) for c, content in posts))
+        return rows
+
+    async def pack_courses(self, channel=None, guild_id=None, group_size=None):
+        """
+        Packs courses that have a signup message of their own into grouped
+        signup messages, where each course is signed up for with its own
+        emoji from the PACK.EMOJIS option. The bot reacts to each grouped
+        message with the courses' emojis, and registers the new signups
+        one message at a time, so an interrupted run can be rerun to pack the
+        remaining courses. In cluster mode, raises CommandError if another
+        process is packing the same guild's courses.
+
+        Users' reactions can't be moved, so the old signup messages are
+        left in place and keep working. Returns a dictionary of counts.
+
+        * channel (TextChannel) - signup channel, fetched if not given
+        * guild_id (int) - guild to pack, None for default configuration
+        * group_size (int) - courses per message, PACK.GROUP_SIZE if not given
+        """
+
+        async with self._exclusive(f"job:pack:{guild_id}") as acquired:
+            if not acquired:
+                raise CommandError("Courses are already being packed elsewhere")
+            return await self._pack_courses(channel, guild_id, group_size)
+
+    async def _pack_courses(self, channel, guild_id, group_size):
+        guild_cfg = self._guild_config(guild_id)
+        if channel is None:
+            channel = await self.fetch_channel(guild_cfg["SIGNUP_CHANNEL"])
+        template = guild_cfg["MESSAGES"]["GROUP_LINE"]
+        emojis = self._cfg["PACK"]["EMOJIS"]
+        group_size = min(
+            group_size or self._cfg["PACK"]["GROUP_SIZE"],
+            len(emojis),
+            REACTION_LIMIT
+        )
+        registered = [
+            c for c in await self._db.all_courses()
+            if self._guild_config(c.guild_id) is guild_cfg
+        ]
+        grouped = {c.role_id for c in registered if c.emoji}
+        singles = {}
+        for course in sorted(registered, key=lambda c: (c.code, c.id)):
+            if course.role_id not in grouped:
+                singles.setdefault(course.role_id, course)
+        singles = list(singles.values())
+        counts = {"packed": 0, "messages": 0, "failed": 0}
+
+        for start in range(0, len(singles), group_size):
+            group = list(zip(emojis, singles[start:start + group_size]))
+            content = render_group(template, [
+                (emoji, self._course_fields(course))
+                for emoji, course in group
+            ])
+            try:
+                signup = await self._outbound.call(BULK, channel.send, content)
+                for emoji, course in group:
+                    await self._outbound.call(
+                        BULK, signup.add_reaction, emoji
+                    )
+            except discord.HTTPException as e:
+                logging.warning(f"Packing {group[0][1].code} failed: {e}")
+                counts["failed"] += len(group)
+                continue
+            rows = [
+                dict(
+                    code=course.code,
+                    name_en=course.name_en,
+                    name_fi=course.name_fi,
+                    role_id=course.role_id,
+                    guild_id=guild_id,
+                    message_id=signup.id,
+                    emoji=emoji,
+                    rendered=content_digest(content),
+                )
+                for emoji, course in group
+            ]
+            for course in await self._db.add_courses(rows):
+                self._courses.add(course.message_id, course)
+            counts["packed"] += len(rows)
+            counts["messages"] += 1
+        return counts
+
+    @staticmethod
+    def _course_fields(course):
+        """
+        Returns the template fields of a database course object as a course
+        dictionary.
+
+        * course (Course) - course object from the database module
+        """
+
+        return {
+            "code": course.code,
+            "name_en": course.name_en,
+            "name_fi": course.name_fi,
+        }
+
+    def _render_courses(self, guild_cfg, courses):
+        """
+        Renders the content of a signup message from the current templates.
+        A message with one course that accepts any emoji uses the SIGNUP
+        template, and grouped messages have a GROUP_LINE for each course in
+        the order they were registered.
+
+        * guild_cfg (dict) - resolved guild configuration
+        * courses (list) - course objects of the message from the database
+        """
+
+        if len(courses) == 1 and not courses[0].emoji:
+            return render_signup(
+                guild_cfg["MESSAGES"]["SIGNUP"],
+                self._course_fields(courses[0])
+            )
+        return render_group(guild_cfg["MESSAGES"]["GROUP_LINE"], [
+            (course.emoji, self._course_fields(course))
+            for course in sorted(courses, key=lambda c: c.id)
+        ])
+
+    async def _signup_channel(self, guild_cfg, channel=None):
+        """
+        Returns the given signup channel, or fetches the guild's configured
+        signup channel if no channel is given.
+
+        * guild_cfg (dict) - the guild's configuration
+        * channel (TextChannel) - signup channel, if already known
+        """
+
+        if channel is None:
+            channel = await self.fetch_channel(guild_cfg["SIGNUP_CHANNEL"])
+        return channel
+
+    async def _guild_courses(self, guild_cfg):
+        """
+        Returns the registered courses that belong to a guild.
+
+        * guild_cfg (dict) - the guild's configuration
+        """
+
+        return [
+            c for c in await self._db.all_courses()
+            if self._guild_config(c.guild_id) is guild_cfg
+        ]
+
+    async def rerender(self, channel=None, guild_id=None):
+        """
+        Edits signup messages whose content differs from what the current
+        templates and course names render. The current contents are read
+        from the signup channel's history, except for messages whose stored
+        digest shows that they were already rendered from the same content.
+        Edits go through the bulk lane and are paced to RERENDER.EDIT_RATE
+        edits per second to stay under the channel's edit rate limit. The
+        digest is stored after each message, so an interrupted run can be
+        rerun and continues where it stopped. In cluster mode, raises
+        CommandError if another process is re-rendering the same guild.
+        Returns a dictionary of counts.
+
+        * channel (TextChannel) - signup channel, fetched if not given
+        * guild_id (int) - guild to re-render, None for default configuration
+        """
+
+        async with self._exclusive(f"job:rerender:{guild_id}") as acquired:
+            if not acquired:
+                raise CommandError("A re-render is already running elsewhere")
+            return await self._rerender(channel, guild_id)
+
+    async def _rerender(self, channel, guild_id):
+        guild_cfg = self._guild_config(guild_id)
+        channel = await self._signup_channel(guild_cfg, channel)
+        messages = {}
+        for course in await self._guild_courses(guild_cfg):
+            messages.setdefault(course.message_id, []).append(course)
+        counts = {"edited": 0, "unchanged": 0, "missing": 0, "failed": 0}
+
+        pending = {}
+        for message_id, courses in messages.items():
+            content = self._render_courses(guild_cfg, courses)
+            if all(c.rendered == content_digest(content) for c in courses):
+                counts["unchanged"] += 1
+            else:
+                pending[message_id] = content
+        if not pending:
+            return counts
+
+        found = await self._find_messages(channel, pending)
+        bucket = TokenBucket(
+            self._cfg["RERENDER"]["EDIT_RATE"],
+            self._cfg["RERENDER"]["EDIT_BURST"]
+        )
+        for message_id, content in pending.items():
+            message = found.get(message_id)
+            if message is None:
+                counts["missing"] += 1
+                continue
+            result = await self._edit_signup(bucket, message, content)
+            counts[result] += 1
+            if result != "failed":
+                await self._db.set_rendered(
+                    message_id, content_digest(content)
+                )
+        return counts
+
+    async def _find_messages(self, channel, message_ids):
+        """
+        Reads a channel's history until all of the given messages have been
+        found. Returns a dictionary of the found messages by ID.
+
+        * channel (TextChannel) - the channel
+        * message_ids (collection) - IDs of the messages
+        """
+
+        found = {}
+        async for message in self._outbound.pages(
+            BULK, channel.history, "before"
+        ):
+            if message.id in message_ids:
+                found[message.id] = message
+                if len(found) == len(message_ids):
+                    break
+        return found
+
+    async def _edit_signup(self, bucket, message, content):
+        """
+        Edits a signup message to the given content for a re-render, unless
+        it already has it. Returns the name of the count to increase:
+        edited, unchanged or failed.
+
+        * bucket (TokenBucket) - paces the edits
+        * message (Message) - the signup message
+        * content (str) - the new content
+        """
+
+        if message.content == content:
+            return "unchanged"
+        await bucket.acquire()
+        try:
+            await self._outbound.call(BULK, message.edit, content=content)
+        except discord.HTTPException as e:
+            logging.warning(f"Editing message {message.id} failed: {e}")
+            return "failed"
+        return "edited"
+
+    async def rollover(self, codes=None, channel=None, guild_id=None,
+                       guild=None):
+        """
+        Archives a guild's courses at the end of a semester. The courses are
+        removed from the course index right away, their signup messages are
+        deleted, and their roles are cleared from all members, one bulk
+        operation per role with all roles running concurrently. Finally the
+        courses are moved to the course archive table. An interrupted
+        rollover can be rerun. In cluster mode, raises CommandError if
+        another process is running a rollover for the same guild.
+
+        Messages younger than two weeks are deleted with the bulk delete API,
+        up to 100 at a time, and older ones one at a time, paced to
+        ROLLOVER.DELETE_RATE per second. Grouped signup messages that also
+        hold courses that are not archived are kept, as are roles that still
+        have other signups. Returns a dictionary of counts.
+
+        * codes (iterable) - codes of the courses to archive, None for all of
+          the guild's courses
+        * channel (TextChannel) - signup channel, fetched if not given
+        * guild_id (int) - guild whose courses to archive, None for default
+          configuration
+        * guild (Guild) - the guild, looked up or fetched if not given
+        """
+
+        async with self._exclusive(f"job:rollover:{guild_id}") as acquired:
+            if not acquired:
+                raise CommandError("A rollover is already running elsewhere")
+            return await self._rollover(codes, channel, guild_id, guild)
+
+    async def _rollover(self, codes, channel, guild_id, guild):
+        guild_cfg = self._guild_config(guild_id)
+        channel = await self._signup_channel(guild_cfg, channel)
+        scan = False
+        if guild is None:
+            guild, scan = await self._rollover_guild(channel, guild_id)
+        codes = set(codes) if codes is not None else None
+        registered = await self._guild_courses(guild_cfg)
+        selected = [
+            c for c in registered if codes is None or c.code in codes
+        ]
+        archived_ids = {c.id for c in selected}
+        kept = [c for c in registered if c.id not in archived_ids]
+        kept_messages = {c.message_id for c in kept}
+        kept_roles = {c.role_id for c in kept}
+        messages = {c.message_id for c in selected} - kept_messages
+        roles = {c.role_id for c in selected} - kept_roles
+        counts = {
+            "archived": 0,
+            "deleted": 0,
+            "bulk_deleted": 0,
+            "kept": len({c.message_id for c in selected} & kept_messages),
+            "missing": 0,
+            "failed": 0,
+            "roles": len(roles),
+            "cleared": 0,
+            "clear_failed": 0,
+        }
+        if not selected:
+            return counts
+
+        self._forget_courses(selected, kept, roles)
+        members = await self._members.role_members(guild, roles, scan=scan)
+        clears = [
+            self._remove_role_from_all(
+                guild.get_role(role_id), f"Clearing role {role_id}",
+                guild_id, members[role_id]
+            )
+            for role_id in sorted(roles)
+            if guild.get_role(role_id) is not None
+        ]
+        results = await asyncio.gather(
+            self._delete_signups(channel, sorted(messages), counts),
+            *clears
+        )
+        for operation in results[1:]:
+            counts["cleared"] += operation.done
+            counts["clear_failed"] += len(operation.failed)
+
+        archived = await self._db.archive_courses(sorted(archived_ids))
+        counts["archived"] = len(archived)
+        return counts
+
+    async def _rollover_guild(self, channel, guild_id):
+        """
+        Returns the guild of a rollover, and whether its role members need
+        to be found by scanning its member list because it was fetched
+        instead of found in discord.py's cache.
+
+        * channel (TextChannel) - signup channel
+        * guild_id (int) - guild ID, None for default configuration
+        """
+
+        guild_key = guild_id if guild_id is not None else channel.guild.id
+        guild = self.get_guild(guild_key)
+        if guild is not None:
+            return guild, False
+        return await self.fetch_guild(guild_key), True
+
+    def _forget_courses(self, archived, kept, roles):
+        """
+        Removes archived courses from the course index, keeping the signup
+        messages they share with other courses, and drops pending role
+        changes and signup counts of their roles.
+
+        * archived (list) - courses being archived
+        * kept (list) - the guild's other courses
+        * roles (set) - IDs of the roles that have no other courses
+        """
+
+        removed = {c.message_id for c in archived}
+        for message_id in removed:
+            self._courses.remove(message_id)
+        for course in kept:
+            if course.message_id in removed:
+                self._courses.add(course.message_id, course)
+        for role_id in roles:
+            self._roles.discard_role(role_id)
+            self._counts.remove(role_id)
+
+    async def _delete_signups(self, channel, message_ids, counts):
+        """
+        Deletes signup messages for a rollover. Young messages are deleted
+        in bulk, and the rest, including the ones from failed bulk deletes,
+        one by one. Updates the deleted, bulk_deleted, missing and failed
+        counts.
+
+        * channel (TextChannel) - signup channel
+        * message_ids (list) - IDs of the messages
+        * counts (dict) - rollover counts
+        """
+
+        cutoff = discord.utils.utcnow() - BULK_DELETE_AGE
+        young = [
+            m for m in message_ids if discord.utils.snowflake_time(m) > cutoff
+        ]
+        single = [
+            m for m in message_ids if discord.utils.snowflake_time(m) <= cutoff
+        ]
+        for start in range(0, len(young), BULK_DELETE_LIMIT):
+            chunk = young[start:start + BULK_DELETE_LIMIT]
+            try:
+                await self._outbound.call(
+                    BULK, channel.delete_messages,
+                    [discord.Object(id=m) for m in chunk]
+                )
+            except discord.HTTPException as e:
+                logging.warning(
+                    f"Bulk deleting {len(chunk)} messages failed: {e}"
+                )
+                single.extend(chunk)
+                continue
+            counts["deleted"] += len(chunk)
+            counts["bulk_deleted"] += len(chunk)
+
+        bucket = TokenBucket(
+            self._cfg["ROLLOVER"]["DELETE_RATE"],
+            self._cfg["ROLLOVER"]["DELETE_BURST"]
+        )
+        for message_id in single:
+            await bucket.acquire()
+            try:
+                await self._outbound.call(
+                    BULK, channel.get_partial_message(message_id).delete
+                )
+            except discord.NotFound:
+                counts["missing"] += 1
+            except discord.HTTPException as e:
+                logging.warning(f"Deleting message {message_id} failed: {e}")
+                counts["failed"] += 1
+            else:
+                counts["deleted"] += 1
+
+    async def _load_courses(self):
+        """
+        Fills the course index from the database, and the signup counters
+        from the reconciliation checkpoints.
+        """
+
+        self._courses.load(await self._db.all_courses())
+        self._counts.load((await self._db.get_checkpoints()).values())
+        logging.info(f"Loaded {len(self._courses)} courses into index")
+
+    async def _get_course(self, message_id, emoji=""):
+        """
+        Returns the course index entry for a reaction, or None if the message
+        and emoji are not associated with a course. Message IDs that are not
+        in the index are looked up from the database once, and the result is
+        stored in the index.
+
+        * message_id (int) - ID of the reacted message
+        * emoji (str) - the reaction emoji as a string
+        """
+
+        course = self._courses.get(message_id, emoji)
+        if course is UNKNOWN:
+            course = self._courses.resolve(
+                self._courses.store(
+                    message_id,
+                    await self._db.find_courses(message_id)
+                ),
+                emoji
+            )
+        return course
+
+    async def _get_courses(self, message_id):
+        """
+        Returns the course index entries of all courses on a signup message,
+        or an empty list. Looks up unknown messages like _get_course.
+
+        * message_id (int) - ID of the message
+        """
+
+        targets = self._courses.get_all(message_id)
+        if targets is UNKNOWN:
+            targets = self._courses.store(
+                message_id,
+                await self._db.find_courses(message_id)
+            )
+        return list(targets.values()) if targets else []
+
+    async def _remove_role_from_all(self, role, description, guild_id=None,
+                                    members=None, keep=()):
+        """
+        Removes a role from all members that have it, using a concurrent bulk
+        operation that reports its progress to the control channel. Journaled
+        operations for the role are dropped first, so that failed adds are
+        not retried after the role is cleared. Returns the finished
+        operation.
+
+        * role (Role) - role to remove
+        * description (str) - description used in progress reports
+        * guild_id (int) - guild whose control channel gets the reports
+        * members (list) - members that have the role, looked up if not given
+        * keep (set) - IDs of users who keep the role, whose journaled
+          operations are not dropped
+        """
+
+        if members is None:
+            found = await self._members.role_members(role.guild, [role.id])
+            members = found[role.id]
+        if self._journal is not None:
+            await self._journal.discard_role(role.guild.id, role.id, keep)
+        ids = {}
+        if self._journal is not None and members:
+            ids = dict(zip(
+                (m.id for m in members),
+                await self._journal.record([
+                    (role.guild.id, m.id, role.id, False, description)
+                    for m in members
+                ])
+            ))
+
+        async def remove(member):
+            call = self._outbound.call(BULK, member.remove_roles, role)
+            if member.id not in ids:
+                return await call
+            return await self._journal.track([ids[member.id]], call)
+
+        operation = BulkRoleOperation(
+            description,
+            members,
+            remove,
+            concurrency=self._cfg["BULK"]["CONCURRENCY"],
+            report=lambda text: self._report(text, guild_id),
+            progress_interval=self._cfg["BULK"]["PROGRESS_INTERVAL"],
+        )
+        await operation.run()
+        return operation
+
+    async def _reconcile(self, guild_id=None):
+        """
+        Compares signup message reactions with role members for every course
+        and fixes the differences. Courses that haven't changed since their
+        last checkpoint are skipped. Returns the summary texts, which are
+        also reported to each guild's control channel if anything was
+        changed. In cluster mode, guilds that are being reconciled by another
+        process are skipped.
+
+        * guild_id (int) - only reconcile this guild's courses if given
+        """
+
+        courses = await self._db.all_courses()
+        configs = [self._default_guild_cfg] + list(self._guild_cfgs.values())
+        if guild_id is not None:
+            configs = [self._guild_config(guild_id)]
+        summaries = []
+        for guild_cfg in configs:
+            channel = self.get_channel(guild_cfg["SIGNUP_CHANNEL"])
+            if channel is None:
+                continue
+            reconciler = Reconciler(
+                self._db,
+                self._outbound,
+                user=self.user,
+                members=self._members,
+                counters=self._counts,
+                concurrency=self._cfg["BULK"]["CONCURRENCY"],
+                max_age=self._cfg["RECONCILE"]["MAX_AGE"],
+                remove=self._cfg["RECONCILE"]["REMOVE"],
+            )
+            lease = f"job:reconcile:{guild_cfg['GUILD_ID']}"
+            async with self._exclusive(lease) as acquired:
+                if not acquired:
+                    continue
+                summary = await reconciler.reconcile(channel, [
+                    c for c in courses
+                    if self._guild_config(c.guild_id) is guild_cfg
+                ])
+            if reconciler.added or reconciler.removed:
+                await self._report(summary, guild_cfg["GUILD_ID"])
+            summaries.append(summary)
+        return summaries
+
+    def _record_event(self, name, event):
+        """
+        Appends a handled event to the event recording, if recording is
+        enabled.
+
+        * name (str) - event name, see the recorder module
+        * event (object) - raw reaction event or message from discord.py
+        """
+
+        if self._recorder is not None:
+            if name == "message":
+                self._recorder.record(name, message_fields(event))
+            else:
+                self._recorder.record(name, reaction_fields(event))
+
+    def _record_signup(self, action, event, course, user_id=None):
+        """
+        Records a signup event for a handled reaction, if the signup log is
+        enabled.
+
+        * action (str) - add, remove or clear
+        * event (RawReactionEvent) - reaction event from discord.py
+        * course (CourseEntry) - the reacted message's course
+        * user_id (int) - ID of the reacting user, None for clears
+        """
+
+        if self._signups is not None:
+            self._signups.record(
+                action, event.message_id, course.role_id, event.guild_id,
+                user_id
+            )
+
+    async def _report_lines(self, lines, guild_id=None):
+        """
+        Sends lines of text to a guild's control channel, splitting them into
+        as few messages as fit in Discord's message length limit.
+
+        * lines (list) - lines of text
+        * guild_id (int) - guild ID, or None for the default control channel
+        """
+
+        text = ""
+        for line in lines:
+            if text and len(text) + len(line) + 1 > MESSAGE_LIMIT:
+                await self._report(text, guild_id)
+                text = ""
+            text = f"{text}\n{line}" if text else line
+        if text:
+            await self._report(text, guild_id)
+
+    async def _report(self, text, guild_id=None):
+        """
+        Sends a message to a guild's control channel, if it's available.
+
+        * text (str) - message content
+        * guild_id (int) - guild ID, or None for the default control channel
+        """
+
+        channel = self.get_channel(
+            self._guild_config(guild_id)["CONTROL_CHANNEL"]
+        )
+        if channel is not None:
+            await self._outbound.call(INTERACTIVE, channel.send, text)
         
+    @instrumented
     async def on_raw_reaction_add(self, event):
         """
         Uses the reaction event's message ID to find the course associated
         with the reacted message. If the course is found, the associated role
-        is assigned to the user who triggered the reaction event.
+        is queued to be assigned to the user who triggered the reaction event.
         
-        Reactions on channels other than the designated singup channel are 
-        ignored.
+        Reactions on channels other than the designated singup channels are 
+        ignored, as are reactions to courses of other guilds and
+        the bot's own reactions.
        
         * event (RawReactionEvent) - reaction event from discord.py
         """
         
-        if event.channel_id != self._cfg["SIGNUP_CHANNEL"]:
+        if event.channel_id not in self._signup_channels:
+            return
+        if self.user is not None and event.user_id == self.user.id:
             return
 
-        with Session(self._engine) as s:
-            course = s.query(db.Course).filter_by(
-                message_id=event.message_id
-            ).first()
-            if not course:
-                return
+        self._record_event("add", event)
+        course = await self._get_course(event.message_id, str(event.emoji))
+        if not course or course.guild_id not in (None, event.guild_id):
+            return
         
         guild = self.get_guild(event.guild_id)
         role = guild.get_role(course.role_id)
-        await event.member.add_roles(role)
+        self._members.put(event.member)
+        self._roles.add(event.member, role)
+        self._record_signup("add", event, course, event.user_id)
 
+    @instrumented
     async def on_raw_reaction_remove(self, event):
         """
         Uses the reaction event's message ID to find the course associated
         with the reacted message. If the course is found, the associated role
-        is removed from the user who triggered the reaction event.
+        is queued to be removed from the user who triggered the reaction event,
+        unless the user has also reacted to another signup of the role, e.g.
+        the grouped message of a packed course.
 
-        Reactions on channels other than the designated singup channel are 
-        ignored.
+        Reactions on channels other than the designated singup channels are 
+        ignored, as are reactions to courses of other guilds and
+        the bot's own reactions.
 
         * event (RawReactionEvent) - reaction event from discord.py
         """
 
-        if event.channel_id != self._cfg["SIGNUP_CHANNEL"]:
+        if event.channel_id not in self._signup_channels:
+            return
+        if self.user is not None and event.user_id == self.user.id:
             return
 
-        with Session(self._engine) as s:
-            course = s.query(db.Course).filter_by(
-                message_id=event.message_id
-            ).first()
-            if not course:
-                return
+        self._record_event("remove", event)
+        course = await self._get_course(event.message_id, str(event.emoji))
+        if not course or course.guild_id not in (None, event.guild_id):
+            return
         
         guild = self.get_guild(event.guild_id)
         role = guild.get_role(course.role_id)
-        member = guild.get_member(event.user_id)
-        await member.remove_roles(role)
+        member = await self._members.get(guild, event.user_id)
+        if member is not None and not await self._signed_up_elsewhere(
+            event, course
+        ):
+            self._roles.remove(member, role)
+        self._record_signup("remove", event, course, event.user_id)
         
+    @instrumented
     async def on_raw_reaction_clear(self, event):
         """
-        Uses the reaction event's message ID to find the course associated
-        with the reacted message. If the course is found, the associated role
-        is removed from all users.
+        Uses the reaction event's message ID to find the courses associated
+        with the message. The associated role of each course is removed from
+        all users.
 
-        Reactions on channels other than the designated singup channel are 
-        ignored.
+        Reactions on channels other than the designated singup channels are 
+        ignored, as are reactions to courses of other guilds.
 
         * event (RawReactionEvent) - reaction event from discord.py
         """
 
-        if event.channel_id != self._cfg["SIGNUP_CHANNEL"]:
+        if event.channel_id not in self._signup_channels:
+            return
+
+        self._record_event("clear", event)
+        for course in await self._get_courses(event.message_id):
+            await self._clear_course(event, course)
+
+    @instrumented
+    async def on_raw_reaction_clear_emoji(self, event):
+        """
+        Finds the course associated with the message and the cleared emoji.
+        If the course is found, the associated role is removed from all
+        users. Courses that accept any emoji are not cleared, as their
+        signups may use other emojis.
+
+        * event (RawReactionClearEmojiEvent) - reaction event from discord.py
+        """
+
+        if event.channel_id not in self._signup_channels:
+            return
+
+        self._record_event("clear_emoji", event)
+        emoji = str(event.emoji)
+        for course in await self._get_courses(event.message_id):
+            if course.emoji == emoji:
+                await self._clear_course(event, course)
+
+    async def _clear_course(self, event, course):
+        """
+        Removes a course's role from all users after its reactions were
+        cleared. If the role has other signups, users who have reacted to
+        them keep the role.
+
+        * event (RawReactionEvent) - reaction event from discord.py
+        * course (CourseEntry) - the course whose reactions were cleared
+        """
+
+        if course.guild_id not in (None, event.guild_id):
             return
 
-        with Session(self._engine) as s:
-            course = s.query(db.Course).filter_by(
-                message_id=event.message_id
-            ).first()
-            if not course:
-                return
-        
         guild = self.get_guild(event.guild_id)
         role = guild.get_role(course.role_id)
-        for m in role.members:
-            await m.remove_roles(role)
-        
-        logging.info("Cleared roles for "+course.name_en) 
+        keep = set()
+        for message, entry in await self._other_signups(event, course):
+            for reaction in self._entry_reactions(message, entry):
+                async for user in self._outbound.pages(
+                    BULK, reaction.users, "after"
+                ):
+                    keep.add(user.id)
+        if self.user is not None:
+            keep.discard(self.user.id)
+        found = await self._members.role_members(guild, [role.id])
+        members = [m for m in found[role.id] if m.id not in keep]
+        self._roles.discard_role(role.id, keep)
+        self._counts.set(course.role_id, len(found[role.id]) - len(members))
+        self._record_signup("clear", event, course)
+        await self._remove_role_from_all(
+            role, f"Clearing role for {course.code}", event.guild_id,
+            members, keep
+        )
+
+    async def _other_signups(self, event, course):
+        """
+        Fetches the signup messages of a course's role other than the one in
+        a reaction event. Returns (message, course entry) pairs for the
+        messages that still exist.
+
+        * event (RawReactionEvent) - reaction event from discord.py
+        * course (CourseEntry) - the course the event was for
+        """
+
+        channel = self.get_channel(event.channel_id)
+        signups = []
+        for message_id, entry in self._courses.signups(course.role_id):
+            if message_id == event.message_id:
+                continue
+            try:
+                message = await self._outbound.call(
+                    INTERACTIVE, channel.fetch_message, message_id
+                )
+            except discord.NotFound:
+                continue
+            signups.append((message, entry))
+        return signups
+
+    @staticmethod
+    def _entry_reactions(message, entry):
+        """
+        Returns the reactions of a message that count as signups for a
+        course entry: the ones with its emoji, or all if it has none.
+        """
+
+        return [
+            r for r in message.reactions
+            if not entry.emoji or str(r.emoji) == entry.emoji
+        ]
+
+    async def _signed_up_elsewhere(self, event, course):
+        """
+        Checks whether the user of a reaction remove event has reacted to
+        another signup of the course's role. Each reaction is checked with
+        one request for the first reactor from the user's ID on.
+
+        * event (RawReactionEvent) - reaction event from discord.py
+        * course (CourseEntry) - the course whose reaction was removed
+        """
+
+        async def has_reacted(reaction):
+            after = discord.Object(event.user_id - 1)
+            async for user in reaction.users(limit=1, after=after):
+                return user.id == event.user_id
+            return False
+
+        for message, entry in await self._other_signups(event, course):
+            for reaction in self._entry_reactions(message, entry):
+                if await self._outbound.call(
+                    INTERACTIVE, has_reacted, reaction
+                ):
+                    return True
+        return False
 
     async def on_error(self, event, *args, **kwargs):
         """
-        Logs errors. 
+        Logs errors with the event's arguments and the traceback as one
+        record.
         
         * event (str) - name of the event that caused the error
         """
     
-        etype, evalue, etrace = sys.exc_info()
-        logging.error(f"Error processing event {event} with arguments")
-        logging.error(",".join(repr(arg) for arg in args))
-        logging.error(",".join(f"{key!r}: {val!r}" for key, val in kwargs))
-        logging.error(f"{etype} - {evalue}")
+        arguments = [repr(arg) for arg in args]
+        arguments += [f"{key}={val!r}" for key, val in kwargs.items()]
+        logging.error(
+            f"Error processing event {event} with arguments "
+            f"{', '.join(arguments)}",
+            exc_info=True,
+            extra={"event": event}
+        )
 
+    @instrumented
     async def on_ready(self):
         """
-        Simply logs the ready status for debug purposes.
+        Logs the ready status and starts reconciliation in the background, if
+        enabled in the configuration, to catch up with reactions that were
+        missed while the bot was offline and to correct signup counters. The
+        role journal's retry worker is also started.
         """
         
         logging.info("Online") 
+        if self._cfg["RECONCILE"]["ENABLED"] and (
+                self._reconcile_task is None or self._reconcile_task.done()):
+            self._reconcile_task = asyncio.create_task(self._reconcile_loop())
+        if self._journal is not None and (
+                self._journal_task is None or self._journal_task.done()):
+            self._journal_task = asyncio.create_task(self._journal_loop())
+
+    async def _reconcile_loop(self):
+        """
+        Runs a reconciliation pass, and repeats it every RECONCILE.INTERVAL
+        seconds if the interval is positive.
+        """
+
+        while True:
+            try:
+                await self._reconcile()
+            except discord.HTTPException as e:
+                logging.warning(f"Reconciliation failed: {e}")
+            interval = self._cfg["RECONCILE"]["INTERVAL"]
+            if not interval or interval <= 0:
+                return
+            await asyncio.sleep(interval)
+
+    async def _journal_loop(self):
+        """
+        Retries journaled role operations that are due, including the ones
+        left unfinished by the previous process. Checks for due operations
+        every JOURNAL.POLL_INTERVAL seconds. Errors are logged and don't stop
+        the loop.
+        """
 
+        while True:
+            try:
+                operations = await self._journal.due()
+            except Exception as e:
+                logging.warning(f"Reading the role journal failed: {e}")
+                operations = []
+            results = await asyncio.gather(*(
+                self._retry_operation(operation) for operation in operations
+            ), return_exceptions=True)
+            for operation, result in zip(operations, results):
+                if isinstance(result, Exception):
+                    logging.error(
+                        f"Retrying role operation {operation.id} failed: "
+                        f"{result!r}"
+                    )
+            if not operations:
+                await asyncio.sleep(self._cfg["JOURNAL"]["POLL_INTERVAL"])
+
+    async def _retry_operation(self, operation):
+        """
+        Retries one journaled role operation through the bulk lane. Members
+        that have left the guild need nothing more.
+
+        * operation (RoleOperation) - operation from the journal
+        """
+
+        guild = self.get_guild(operation.guild_id)
+        role = guild.get_role(operation.role_id) if guild else None
+        if role is None:
+            await self._journal.fail(
+                [operation.id], f"Role {operation.role_id} not available"
+            )
+            return
+        try:
+            member = await self._members.get(guild, operation.user_id)
+        except Exception as e:
+            await self._journal.fail([operation.id], e)
+            return
+        if member is None:
+            self._journal.finish([operation.id])
+            return
+        func = member.add_roles if operation.add else member.remove_roles
+        try:
+            await self._journal.track(
+                [operation.id], self._outbound.call(BULK, func, role)
+            )
+        except Exception as e:
+            logging.warning(
+                f"Retrying role operation {operation.id} failed: {e}"
+            )
+
+    @instrumented
     async def on_message(self, message):
         """
         Handles messages from other users. Currently this is a command handler.
-        Messages are only parsed if they were sent to the designated control
-        channel.
+        Messages are only parsed if they were sent to one of the designated
+        control channels.
         
         * message (Message) - a discord.py message object
         """
@@ -184,10 +1521,12 @@ class ITEEBot(discord.Client):
         if message.author == self.user:
             return
             
-        if message.channel.id == self._cfg["CONTROL_CHANNEL"]:
+        if message.channel.id in self._control_channels:
             logging.debug("Command channel event")
+            self._record_event("message", message)
             await self._parse_command(message)
         
+    @instrumented
     async def _parse_command(self, message):
         """
         Parses messages that are regarded commands, currently marked with 
@@ -195,24 +1534,40 @@ class ITEEBot(discord.Client):
         account for different use cases without adding escape mechanisms to
         the command syntax.
         
-        Command handlers are looked up with getattr and need to be named in
-        the _{command_keyword}_command pattern.
+        Command handlers need to be named in the _{command_keyword}_handler
+        pattern. They are collected into a command registry when the bot is
+        created. Arguments are validated and converted to the types in the
+        handler's annotations before it's called, and problems are reported
+        to the control channel.
 
         * message (Message) - a discord.py message object
         """
     
         content = message.content.lstrip("<@0123456789> ")
-        logging.debug(content)
-
         if not content.startswith("!"):
             return
-        command, *args = content.lstrip("!").split(
-            self._cfg["COMMAND_SEP"]
+        sep = self._cfg["COMMAND_SEP"]
+        name, args = self._commands.split(content[1:], sep)
+        logging.debug(
+            "Received command %s with args: %s", name, args,
+            extra={"handler": name}
         )
-        logging.info(f"Received command {command} with args:")
-        logging.info(self._cfg["COMMAND_SEP"].join(args))
-        handler = getattr(self, f"_{command}_handler", self._invalid_command)
-        await handler(message, *args)
+        command = self._commands.get(name)
+        if command is None:
+            self._metrics.inc("commands", command="invalid")
+            await self._invalid_command(message, *args)
+            return
+
+        self._metrics.inc("commands", command=name)
+        try:
+            await self._commands.run(command, message, command.convert(args))
+        except CommandError as e:
+            logging.warning(
+                f"Command {name} rejected: {e}", extra={"handler": name}
+            )
+            await self._report(
+                f"{e}\nUsage: {command.usage(sep)}", self._guild_id(message)
+            )
         
     async def _invalid_command(self, message, *args):
         """
@@ -222,8 +1577,7 @@ class ITEEBot(discord.Client):
         * message (Message) - a discord.py message object
         """
     
-        logging.warning("Reveived invalid command")
-        logging.warning(message.content)
+        logging.warning(f"Received invalid command: {message.content}")
         
     async def _test_handler(self, message, *args):
         """
@@ -234,19 +1588,19 @@ class ITEEBot(discord.Client):
     
         logging.debug("Received test command")
 
-    async def _addcourse_handler(self, 
-                           message,
-                           role_id,
-                           course_code,
-                           course_name_en,
-                           course_name_fi):
+    async def _addcourse_handler(self,
+                                 message,
+                                 role_id: int,
+                                 course_code,
+                                 course_name_en,
+                                 course_name_fi):
         """
         Handler for the addcourse command. Upon receiveing this command, the
-        bot will post a new signup message to the desingated signup channel,
-        using the message template from configuration. After confirming that
-        the message has been posted, the bot creates a database record for the
-        new course that associates the message ID with the course, and 
-        especially course's role ID. 
+        bot will post a new signup message to the desingated signup channel of
+        the guild, using the message template from configuration. After
+        confirming that the message has been posted, the bot creates a
+        database record for the new course that associates the message ID
+        with the course, and especially course's role ID.
         
         * message (Message) - a discord.py message object
         * role_id (int) - ID of an existing role
@@ -255,36 +1609,299 @@ class ITEEBot(discord.Client):
         * course_name_fi (str) - course's name in Finnish
         """
         
-        channel = self.get_channel(self._cfg["SIGNUP_CHANNEL"])
-        signup = await channel.send(
-            self._cfg["MESSAGES"]["SIGNUP"].format(
-                code=course_code,
-                name_en=course_name_en,
-                name_fi=course_name_fi,
-            )
+        guild_id = self._guild_id(message)
+        guild_cfg = self._guild_config(guild_id)
+        channel = self.get_channel(guild_cfg["SIGNUP_CHANNEL"])
+        content = render_signup(guild_cfg["MESSAGES"]["SIGNUP"], {
+            "code": course_code,
+            "name_en": course_name_en,
+            "name_fi": course_name_fi,
+        })
+        signup = await self._outbound.call(
+            INTERACTIVE, channel.send, content
         )
-        with Session(self._engine) as s:
-            course = db.Course(
-                code=course_code,
-                name_fi=course_name_fi,
-                name_en=course_name_en,
-                role_id=int(role_id),
-                message_id=signup.id
-            )
-            s.add(course)
-            s.commit()
+        course = await self._db.add_course(
+            code=course_code,
+            name_fi=course_name_fi,
+            name_en=course_name_en,
+            role_id=role_id,
+            message_id=signup.id,
+            guild_id=guild_id,
+            rendered=content_digest(content)
+        )
+        self._courses.add(course.message_id, course)
+        if self._counts.get(role_id) is None:
+            self._counts.set(role_id, 0)
             
-    async def _resetrole_handler(self, 
-                           message,
-                           role_id):
+    @command(limit=1)
+    async def _resetrole_handler(self,
+                                 message,
+                                 role_id: int):
         """
         Handler for the resetrole command. Upon receiveing this command, the
-        bot will remove the given role_id from all users on the server.
+        bot will remove the given role_id from all users on the server, and
+        drop queued reaction changes of the role so that they can't give it
+        back after the reset. Only one reset can run at a time.
         
         * message (Message) - a discord.py message object
         * role_id (int) - ID of an existing role
         """
         
-        role = message.guild.get_role(int(role_id))
-        for m in role.members:
-            await m.remove_roles(role)
\ No newline at end of file
+        role = message.guild.get_role(role_id)
+        async with self._exclusive(f"job:resetrole:{role_id}") as acquired:
+            if not acquired:
+                raise CommandError(
+                    f"Role {role_id} is already being reset elsewhere"
+                )
+            self._roles.discard_role(role_id)
+            await self._remove_role_from_all(
+                role, f"Resetting role {role_id}", message.guild.id
+            )
+
+    async def _stats_handler(self, message, *args):
+        """
+        Handler for the stats command. Reports course index size and lookup
+        hit rates, role change queue counters, outbound lane statistics and
+        latency summaries for handlers, database queries and API calls to the
+        control channel.
+
+        * message (Message) - a discord.py message object
+        """
+
+        stats = self._courses.stats()
+        await self._report(
+            "Course index: {courses} courses, {negatives} negatives, "
+            "{hits} hits, {negative_hits} negative hits, {misses} misses "
+            "({hit_rate:.1%} hit rate)\n".format(**stats) +
+            "Role queue: {requested} changes, {calls} API calls, "
+            "{saved} calls saved, {skipped} no-op, {failed} failed, "
+            "{pending} pending".format(**self._roles.stats()) +
+            "".join(
+                f"\nOutbound {lane}: depth {stats['depth']}, "
+                f"{stats['dispatched']} calls, "
+                f"wait avg {stats['wait_avg']:.2f}s max {stats['wait_max']:.2f}s"
+                for lane, stats in self._outbound.stats().items()
+            ) +
+            "".join(
+                f"\n{title}:\n" + "\n".join(lines)
+                for title, lines in (
+                    ("Handlers", self._metrics.summary("handler_seconds")),
+                    ("Database", self._metrics.summary("db_query_seconds")),
+                    ("API calls", self._metrics.summary("outbound_call_seconds")),
+                )
+                if lines
+            ),
+            self._guild_id(message)
+        )
+
+    async def _coursestats_handler(self, message, *args):
+        """
+        Handler for the coursestats command. Reports the number of signups
+        for each of the guild's courses from the signup counters. Courses
+        that haven't been counted yet are shown with a question mark, and
+        courses with several signup messages are only listed once.
+
+        * message (Message) - a discord.py message object
+        """
+
+        guild_id = self._guild_id(message)
+        guild_cfg = self._guild_config(guild_id)
+        lines = []
+        listed = set()
+        for _, course in sorted(
+                self._courses.entries(), key=lambda item: item[1].code):
+            if (self._guild_config(course.guild_id) is not guild_cfg
+                    or course.role_id in listed):
+                continue
+            listed.add(course.role_id)
+            count = self._counts.get(course.role_id)
+            lines.append(
+                f"{course.code} {course.name_en or ''}: "
+                f"{'?' if count is None else count}"
+            )
+        await self._report_lines(lines or ["No courses"], guild_id)
+
+    @command(limit=1)
+    async def _importcourses_handler(self, message):
+        """
+        Handler for the importcourses command. Imports courses from a CSV or
+        JSON file attached to the command message, see import_courses. Can be
+        rerun after a partial failure to finish the import.
+
+        * message (Message) - a discord.py message object
+        """
+
+        if not message.attachments:
+            raise CommandError("importcourses needs a CSV or JSON attachment")
+        attachment = message.attachments[0]
+        try:
+            courses = parse_courses(
+                await attachment.read(), attachment.filename
+            )
+        except CourseFileError as e:
+            raise CommandError(str(e))
+        guild_id = self._guild_id(message)
+        counts = await self.import_courses(
+            courses,
+            self.get_channel(self._guild_config(guild_id)["SIGNUP_CHANNEL"]),
+            guild_id
+        )
+        await self._report(
+            "Import done: {added} added ({adopted} reused existing messages), "
+            "{skipped} already registered, {failed} failed".format(**counts),
+            guild_id
+        )
+
+    @command(limit=1)
+    async def _packcourses_handler(self, message, group_size: int = 0):
+        """
+        Handler for the packcourses command. Packs the guild's single-course
+        signup messages into grouped messages, see pack_courses, and reports
+        the result to the control channel.
+
+        * message (Message) - a discord.py message object
+        * group_size (int) - courses per message, optional
+        """
+
+        if group_size < 0:
+            raise CommandError("group_size can't be negative")
+        guild_id = self._guild_id(message)
+        counts = await self.pack_courses(
+            self.get_channel(self._guild_config(guild_id)["SIGNUP_CHANNEL"]),
+            guild_id,
+            group_size
+        )
+        await self._report(
+            "Packing done: {packed} courses packed into {messages} messages, "
+            "{failed} failed. The old signup messages were left in place "
+            "so that existing signups keep their roles.".format(**counts),
+            guild_id
+        )
+
+    @command(limit=1)
+    async def _rerender_handler(self, message):
+        """
+        Handler for the rerender command. Edits the guild's signup messages
+        that don't match the current templates, see rerender, and reports
+        the result to the control channel.
+
+        * message (Message) - a discord.py message object
+        """
+
+        guild_id = self._guild_id(message)
+        counts = await self.rerender(
+            self.get_channel(self._guild_config(guild_id)["SIGNUP_CHANNEL"]),
+            guild_id
+        )
+        await self._report(
+            "Re-render done: {edited} edited, {unchanged} unchanged, "
+            "{missing} missing, {failed} failed".format(**counts),
+            guild_id
+        )
+
+    async def _deadletters_handler(self, message):
+        """
+        Handler for the deadletters command. Lists the guild's role
+        operations that have failed for good in the role journal, oldest
+        first, with the error of their last attempt.
+
+        * message (Message) - a discord.py message object
+        """
+
+        if self._journal is None:
+            raise CommandError("Role journal is not enabled")
+        guild_id = self._guild_id(message)
+        operations, total = await self._journal.dead_letters(guild_id)
+        lines = [f"{total} dead letters"] + [
+            f"{op.id}: {'add' if op.add else 'remove'} role {op.role_id} "
+            f"{'to' if op.add else 'from'} user {op.user_id} "
+            f"({op.source}, {op.attempts} attempts): {op.error}"
+            for op in operations
+        ]
+        if total > len(operations):
+            lines.append(f"... and {total - len(operations)} more")
+        await self._report_lines(lines, guild_id)
+
+    async def _retrydead_handler(self, message):
+        """
+        Handler for the retrydead command. Requeues the guild's dead letters
+        in the role journal so that they are retried from the start.
+
+        * message (Message) - a discord.py message object
+        """
+
+        if self._journal is None:
+            raise CommandError("Role journal is not enabled")
+        guild_id = self._guild_id(message)
+        count = await self._journal.requeue_dead(guild_id)
+        await self._report(f"{count} dead letters requeued", guild_id)
+
+    @command(limit=1)
+    async def _rollover_handler(self, message, *codes):
+        """
+        Handler for the rollover command. Archives the guild's courses with
+        the given codes, or all of them if the only code is all, deletes
+        their signup messages and clears their roles, see rollover. Reports
+        the result to the control channel.
+
+        * message (Message) - a discord.py message object
+        * codes (str) - codes of the courses to archive
+        """
+
+        if not codes:
+            raise CommandError("Give the codes of the courses to archive, or all")
+        guild_id = self._guild_id(message)
+        counts = await self.rollover(
+            None if list(codes) == ["all"] else codes,
+            self.get_channel(self._guild_config(guild_id)["SIGNUP_CHANNEL"]),
+            guild_id,
+            message.guild
+        )
+        await self._report(
+            "Rollover done: {archived} courses archived, {deleted} signup "
+            "messages deleted ({bulk_deleted} in bulk), {missing} missing, "
+            "{failed} failed, {kept} kept for other courses. Cleared "
+            "{roles} roles from {cleared} members, {clear_failed} "
+            "failed".format(**counts),
+            guild_id
+        )
+
+    @command(limit=1)
+    async def _reconcile_handler(self, message):
+        """
+        Handler for the reconcile command. Runs a reconciliation pass for the
+        guild, see _reconcile, and reports the summary to the control channel.
+
+        * message (Message) - a discord.py message object
+        """
+
+        guild_id = self._guild_id(message)
+        for summary in await self._reconcile(guild_id):
+            await self._report(summary, guild_id)
+
+
+class ShardedITEEBot(ITEEBot, discord.AutoShardedClient):
+    """
+    ITEEBot variant that uses discord.py's AutoShardedClient, for running one
+    bot process over a large number of guilds.
+    """
+
+
+def create_bot(config, *args, **kwargs):
+    """
+    Creates a sharded or regular bot depending on the SHARDING configuration
+    option. If a shard count is configured, it's passed to the client,
+    otherwise Discord's recommended count is used. Cluster mode needs a
+    fixed shard count so that all processes split the same shards.
+
+    * config (dict) - configuration dictionary from the configurator module
+    """
+
+    if config["CLUSTER"]["ENABLED"] and not (
+            config["SHARDING"]["ENABLED"] and config["SHARDING"]["SHARD_COUNT"]):
+        raise ValueError("Cluster mode needs sharding with a SHARD_COUNT")
+    if not config["SHARDING"]["ENABLED"]:
+        return ITEEBot(config, *args, **kwargs)
+    if config["SHARDING"]["SHARD_COUNT"]:
+        kwargs.setdefault("shard_count", config["SHARDING"]["SHARD_COUNT"])
+    return ShardedITEEBot(config, *args, **kwargs)
@@ -0,0 +1,109 @@
+"""
+Bulk role operations for ITEEBot. Commands like resetrole and reaction clear
+events need to change roles for hundreds of members at once. Instead of
+awaiting each API call in turn, BulkRoleOperation runs them with a small
+number of concurrent workers. discord.py takes care of waiting out rate
+limits for each route, so the bounded parallelism only needs to be small
+enough that the workers don't spend most of their time waiting.
+
+Individual failures are logged and counted but do not stop the operation.
+Progress is reported periodically, and a summary at the end, through an
+optional report coroutine (usually sending to the control channel).
+"""
+
+import asyncio
+import logging
+import time
+
+import discord
+
+class BulkRoleOperation:
+    """
+    Applies a role operation to a collection of members. The operation is a
+    coroutine function that takes a member and performs one API call, e.g.
+    lambda m: m.remove_roles(role). Attributes after running:
+    * done (int) - number of successful operations
+    * failed (list) - (member, exception) tuples for failed operations
+    """
+
+    def __init__(self,
+                 description,
+                 members,
+                 operation,
+                 concurrency=4,
+                 report=None,
+                 progress_interval=15):
+        """
+        * description (str) - human readable description used in reports
+        * members (iterable) - members to apply the operation to
+        * operation (coroutine function) - called with each member
+        * concurrency (int) - maximum number of API calls in flight
+        * report (coroutine function) - called with progress report texts
+        * progress_interval (float) - seconds between progress reports
+        """
+
+        self.description = description
+        self._members = list(members)
+        self._operation = operation
+        self._concurrency = max(1, concurrency)
+        self._report = report
+        self._interval = progress_interval
+        self.done = 0
+        self.failed = []
+
+    @property
+    def total(self):
+        return len(self._members)
+
+    async def run(self):
+        """
+        Runs the operation for all members and returns the summary text. The
+        summary is also sent to the report coroutine, if one was given.
+        """
+
+        start = time.monotonic()
+        pending = iter(self._members)
+        workers = [
+            asyncio.create_task(self._worker(pending))
+            for i in range(min(self._concurrency, self.total))
+        ]
+        progress = None
+        if self._report is not None and self._interval:
+            progress = asyncio.create_task(self._progress())
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            if progress is not None:
+                progress.cancel()
+
+        summary = (
+            f"{self.description}: {self.done}/{self.total} done, "
+            f"{len(self.failed)} failed in {time.monotonic() - start:.1f}s"
+        )
+        logging.info(summary)
+        if self._report is not None:
+            await self._report(summary)
+        return summary
+
+    async def _worker(self, pending):
+        for member in pending:
+            try:
+                await self._operation(member)
+            except discord.HTTPException as e:
+                logging.warning(
+                    f"{self.description}: failed for member {member.id}: {e}"
+                )
+                self.failed.append((member, e))
+            else:
+                self.done += 1
+
+    async def _progress(self):
+        while True:
+            await asyncio.sleep(self._interval)
+            try:
+                await self._report(
+                    f"{self.description}: "
+                    f"{self.done + len(self.failed)}/{self.total} processed"
+                )
+            except discord.HTTPException:
+                pass
@@ -0,0 +1,172 @@
+"""
+Command registry for ITEEBot. Command handlers are bot methods named in the
+_{command}_handler pattern. The registry is built once when the bot starts:
+each handler's signature is inspected to record its parameters and their
+types (from annotations), so that arguments can be validated and converted
+before the handler is called. Handlers can also be given a concurrency limit
+with the command decorator, e.g. to make sure that two role resets never run
+at the same time.
+"""
+
+import inspect
+import re
+
+HANDLER_PATTERN = re.compile(r"^_(\w+)_handler$")
+
+class CommandError(Exception):
+    """
+    Raised when a command can't be run with the given arguments.
+    """
+
+
+def command(limit=None):
+    """
+    Decorator for setting command options on a handler method.
+
+    * limit (int) - maximum number of concurrent runs of the command, 1 for
+      single-flight commands
+    """
+
+    def decorator(func):
+        func._command_limit = limit
+        return func
+
+    return decorator
+
+
+class Command:
+    """
+    A registered command with its handler and argument specification.
+    """
+
+    __slots__ = (
+        "name", "handler", "params", "required", "varargs", "limit", "running"
+    )
+
+    def __init__(self, name, handler):
+        """
+        * name (str) - command keyword
+        * handler (coroutine method) - bound handler method
+        """
+
+        self.name = name
+        self.handler = handler
+        self.params = []
+        self.required = 0
+        self.varargs = False
+        self.limit = getattr(handler, "_command_limit", None)
+        self.running = 0
+        # first parameter is always the message
+        for param in list(inspect.signature(handler).parameters.values())[1:]:
+            if param.kind == param.VAR_POSITIONAL:
+                self.varargs = True
+                continue
+            if param.annotation is param.empty:
+                convert = str
+            else:
+                convert = param.annotation
+            self.params.append((param.name, convert))
+            if param.default is param.empty:
+                self.required += 1
+
+    def usage(self, sep):
+        """
+        Returns the usage string of the command.
+
+        * sep (str) - command argument separator
+        """
+
+        return sep.join(
+            [f"!{self.name}"] + [name for name, convert in self.params]
+        )
+
+    def convert(self, args):
+        """
+        Validates the number of arguments and converts them to the types
+        required by the handler. Raises CommandError if they are not valid.
+
+        * args (list) - argument strings
+        """
+
+        if len(args) < self.required or (
+                len(args) > len(self.params) and not self.varargs):
+            raise CommandError(
+                f"{self.name} takes {self.required} arguments, "
+                f"got {len(args)}"
+            )
+
+        converted = []
+        for (name, convert), value in zip(self.params, args):
+            try:
+                converted.append(convert(value))
+            except ValueError:
+                raise CommandError(
+                    f"Invalid value for {name}: {value!r}"
+                )
+        converted.extend(args[len(self.params):])
+        return converted
+
+
+class CommandRegistry:
+    """
+    Registry of commands, built from an object's handler methods.
+    """
+
+    def __init__(self, owner):
+        """
+        * owner (object) - object that has the _{command}_handler methods
+        """
+
+        self._commands = {}
+        for attr in dir(owner):
+            match = HANDLER_PATTERN.match(attr)
+            if match:
+                name = match.group(1)
+                self._commands[name] = Command(name, getattr(owner, attr))
+
+    def __contains__(self, name):
+        return name in self._commands
+
+    def get(self, name):
+        """
+        Returns the command registered with the given keyword, or None.
+
+        * name (str) - command keyword
+        """
+
+        return self._commands.get(name)
+
+    @staticmethod
+    def split(content, sep):
+        """
+        Splits command content (without the ! prefix) into the command
+        keyword and a list of argument strings.
+
+        * content (str) - command content
+        * sep (str) - command argument separator
+        """
+
+        name, found, rest = content.partition(sep)
+        if not found:
+            return name, []
+        return name, rest.split(sep)
+
+    async def run(self, command, message, args):
+        """
+        Runs a command with arguments that have already been converted.
+        Raises CommandError if the command is already running at its
+        concurrency limit.
+
+        * command (Command) - the command to run
+        * message (Message) - a discord.py message object
+        * args (list) - converted arguments
+        """
+
+        if command.limit is not None and command.running >= command.limit:
+            raise CommandError(f"{command.name} is already running")
+
+        command.running += 1
+        try:
+            await command.handler(message, *args)
+        finally:
+            command.running -= 1
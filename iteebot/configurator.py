@@ -8,27 +8,253 @@ configuration to ensure all options have been set. So technically local
 configuration files do not need to be complete. Using the initialization is
 simply a utility for making a new editable configuration file that has all
 options included.
+
+Loaded configuration is validated, so that a running bot can reload its
+configuration and keep the old one if the new file has errors. Options in
+RESTART_KEYS are only read when the bot starts and can't be reloaded.
 """
 
+import copy
 import json
 import os
 
 FACTORY = {
     "TOKEN": "insert-token-here",
-    "DB": "sqlite:///botdata.db",
+    "DB": {
+        "URL": "sqlite:///botdata.db",
+        "POOL_SIZE": None,
+        "MAX_OVERFLOW": None,
+        "POOL_RECYCLE": 1800,
+        "PRE_PING": True,
+        "SQLITE": {
+            "WAL": True,
+            "SYNCHRONOUS": "NORMAL",
+            "MMAP_SIZE": 268435456
+        }
+    },
+    "DB_WORKERS": 4,
     "CONTROL_CHANNEL": 0,
     "SIGNUP_CHANNEL": 0,
+    "GUILDS": {},
+    "SHARDING": {
+        "ENABLED": False,
+        "SHARD_COUNT": None
+    },
+    "CLUSTER": {
+        "ENABLED": False,
+        "PROCESSES": 1,
+        "LEASE_TTL": 30,
+        "HOLDER": None
+    },
     "COMMAND_SEP": ",",
+    "OUTBOUND": {
+        "RATE": 40,
+        "BURST": 10,
+        "CONCURRENCY": 8
+    },
+    "MEMBERS": {
+        "LOW_MEMORY": False,
+        "CACHE_SIZE": 10000
+    },
+    "ROLE_QUEUE": {
+        "SETTLE": 1.0
+    },
+    "BULK": {
+        "CONCURRENCY": 4,
+        "PROGRESS_INTERVAL": 15
+    },
+    "RECONCILE": {
+        "ENABLED": True,
+        "INTERVAL": 21600,
+        "MAX_AGE": 86400,
+        "REMOVE": False
+    },
+    "IMPORT": {
+        "WINDOW": 4,
+        "HISTORY": 100
+    },
     "MESSAGES": {
-        "SIGNUP": "{code} {name_en} / {name_fi}"
+        "SIGNUP": "{code} {name_en} / {name_fi}",
+        "GROUP_LINE": "{emoji} {code} {name_en} / {name_fi}"
+    },
+    "RERENDER": {
+        "EDIT_RATE": 0.8,
+        "EDIT_BURST": 1
+    },
+    "ROLLOVER": {
+        "DELETE_RATE": 1,
+        "DELETE_BURST": 5
+    },
+    "PACK": {
+        "GROUP_SIZE": 10,
+        # regional indicator letters A to T
+        "EMOJIS": [chr(0x1F1E6 + i) for i in range(20)]
+    },
+    "RELOAD": {
+        "WATCH": True,
+        "INTERVAL": 5
+    },
+    "SIGNUP_LOG": {
+        "ENABLED": True,
+        "FLUSH_INTERVAL": 5,
+        "BATCH_SIZE": 500
+    },
+    "RECORD": {
+        "ENABLED": False,
+        "FILE": "instance/record/events.jsonl"
+    },
+    "JOURNAL": {
+        "ENABLED": False,
+        "FILE": "instance/journal.db",
+        "BACKOFF": 5,
+        "MAX_BACKOFF": 600,
+        "MAX_ATTEMPTS": 8,
+        "POLL_INTERVAL": 1
+    },
+    "SHUTDOWN": {
+        "DRAIN_DEADLINE": 20
+    },
+    "METRICS": {
+        "ENABLED": False,
+        "HOST": "127.0.0.1",
+        "PORT": 9108
     },
     "LOG": {
         "FILE": "instance/log/iteebot.log",
         "ROTATE": ("d", 31),
-        "BACKUPS": 6
+        "BACKUPS": 6,
+        "FORMAT": "text"
     }
 }
 
+# Options that need a restart to take effect
+RESTART_KEYS = (
+    "TOKEN", "DB", "DB_WORKERS", "SHARDING", "CLUSTER", "OUTBOUND",
+    "MEMBERS", "ROLE_QUEUE", "SIGNUP_LOG", "RECORD", "JOURNAL", "METRICS",
+    "RELOAD", "LOG"
+)
+
+class ConfigError(ValueError):
+    """
+    Raised when a configuration is not valid.
+    """
+
+
+def merge(base, local):
+    """
+    Returns a new dictionary where local is merged on top of base. Nested
+    dictionaries are merged recursively instead of being replaced, so a local
+    configuration only needs to include the options it changes.
+
+    * base (dict) - dictionary of default values
+    * local (dict) - dictionary of overriding values
+    """
+
+    merged = copy.deepcopy(base)
+    for key, value in local.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+def validate_config(config):
+    """
+    Checks that options have usable values. Signup templates are rendered
+    once with placeholder values so that a broken template is caught when
+    the configuration is loaded instead of when a course is added. Raises
+    ConfigError describing the first problem found.
+
+    * config (dict) - configuration dictionary
+    """
+
+    if not isinstance(config["COMMAND_SEP"], str) or not config["COMMAND_SEP"]:
+        raise ConfigError("COMMAND_SEP must be a non-empty string")
+
+    db_cfg = config["DB"]
+    if isinstance(db_cfg, dict):
+        db_cfg = db_cfg.get("URL")
+    if not isinstance(db_cfg, str):
+        raise ConfigError("DB must be an engine string or have a URL")
+
+    _validate_guild_options(config)
+    _validate_numbers(config)
+    _validate_pack(config)
+
+def _validate_guild_options(config):
+    """
+    Checks the options that can be set per guild, in the top level and in
+    each GUILDS section.
+
+    * config (dict) - configuration dictionary
+    """
+
+    sections = [("", config)]
+    for guild_id, local in config["GUILDS"].items():
+        try:
+            int(guild_id)
+        except ValueError:
+            raise ConfigError(f"GUILDS key {guild_id!r} is not a guild ID")
+        sections.append((f"GUILDS.{guild_id}.", local))
+    for prefix, section in sections:
+        _validate_section(prefix, section)
+
+def _validate_section(prefix, section):
+    """
+    Checks the channels and message templates of one guild section.
+
+    * prefix (str) - path of the section for error messages
+    * section (dict) - the section
+    """
+
+    for key in ("CONTROL_CHANNEL", "SIGNUP_CHANNEL"):
+        if key in section and not isinstance(section[key], int):
+            raise ConfigError(f"{prefix}{key} must be an integer")
+    for name in ("SIGNUP", "GROUP_LINE"):
+        template = section.get("MESSAGES", {}).get(name)
+        if template is None:
+            continue
+        try:
+            template.format(code="", name_en="", name_fi="", emoji="")
+        except (AttributeError, IndexError, KeyError, ValueError) as e:
+            raise ConfigError(
+                f"{prefix}MESSAGES.{name} is not a valid template: {e!r}"
+            )
+
+def _validate_numbers(config):
+    """
+    Checks options that must be positive numbers.
+
+    * config (dict) - configuration dictionary
+    """
+
+    for section, key in (
+            ("BULK", "CONCURRENCY"), ("IMPORT", "WINDOW"),
+            ("RELOAD", "INTERVAL"), ("RERENDER", "EDIT_RATE"),
+            ("RERENDER", "EDIT_BURST"), ("JOURNAL", "BACKOFF"),
+            ("JOURNAL", "MAX_BACKOFF"), ("JOURNAL", "MAX_ATTEMPTS"),
+            ("JOURNAL", "POLL_INTERVAL"), ("SHUTDOWN", "DRAIN_DEADLINE"),
+            ("ROLLOVER", "DELETE_RATE"), ("ROLLOVER", "DELETE_BURST")):
+        value = config[section][key]
+        if not isinstance(value, (int, float)) or value <= 0:
+            raise ConfigError(f"{section}.{key} must be a positive number")
+
+def _validate_pack(config):
+    """
+    Checks the options for packing courses into grouped signup messages.
+
+    * config (dict) - configuration dictionary
+    """
+
+    emojis = config["PACK"]["EMOJIS"]
+    if (not isinstance(emojis, list) or not emojis
+            or len(set(emojis)) != len(emojis)
+            or not all(isinstance(e, str) and e for e in emojis)):
+        raise ConfigError("PACK.EMOJIS must be a list of different emojis")
+    if (not isinstance(config["PACK"]["GROUP_SIZE"], int)
+            or config["PACK"]["GROUP_SIZE"] <= 0):
+        raise ConfigError("PACK.GROUP_SIZE must be a positive integer")
+
 def write_config_file(path):
     """
     Writes factory configuration to path. If the file exists, its contents are
@@ -44,7 +270,7 @@ def write_config_file(path):
         config = load_config(path)
     except FileNotFoundError:
         print("No existing configuration, writing fresh file")
-        config = FACTORY.copy()
+        config = copy.deepcopy(FACTORY)
         os.makedirs(os.path.dirname(path), exist_ok=True)
         
     with open(path, "w", encoding="utf-8") as f:
@@ -52,16 +278,20 @@ def write_config_file(path):
 
 def load_config(path):
     """
-    Loads configuration from path. The loaded configuration is updated on top
-    top of the factory configuration in this file to ensure that the resulting
-    dictionary has all of the required keys.
+    Loads configuration from path. The loaded configuration is merged on top
+    of the factory configuration in this file to ensure that the resulting
+    dictionary has all of the required keys, and validated. Raises
+    ConfigError if the file is not valid.
 
     * path (str) - path to the configuration file
     """
 
     with open(path, encoding="utf-8") as f:
-        local = json.load(f)
-    
-    config = FACTORY.copy()
-    config.update(local)
+        try:
+            local = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ConfigError(f"Invalid JSON in {path}: {e}")
+
+    config = merge(FACTORY, local)
+    validate_config(config)
     return config
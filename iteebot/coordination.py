@@ -0,0 +1,153 @@
+"""
+Coordination between several bot processes that share one database. When a
+bot is too large for a single process, the shards are split between
+processes, and jobs that must only run once (role resets, course imports and
+reconciliation passes) are guarded so that only one process runs them.
+
+Both use leases stored in the database. A lease is held by one process until
+it expires, and the holding process renews all of its leases periodically.
+If a process dies, its leases expire after the lease TTL and another process
+can take over. A process that can't claim any shards waits as a standby until
+some become free.
+"""
+
+import asyncio
+import logging
+import math
+import os
+import socket
+from contextlib import asynccontextmanager
+
+class Coordinator:
+    """
+    Acquires, renews and releases leases for one bot process. Leases that
+    the process holds are kept in the held attribute.
+    """
+
+    def __init__(self, database, holder=None, ttl=30):
+        """
+        * database (AsyncDatabase) - database access layer
+        * holder (str) - identifier of this process, hostname:pid by default
+        * ttl (float) - seconds until a lease expires unless renewed
+        """
+
+        self._db = database
+        self.holder = holder or f"{socket.gethostname()}:{os.getpid()}"
+        self.ttl = ttl
+        self.held = set()
+
+    async def acquire(self, name):
+        """
+        Tries to acquire a lease. Returns True if this process now holds it.
+
+        * name (str) - lease name
+        """
+
+        if await self._db.acquire_lease(name, self.holder, self.ttl):
+            self.held.add(name)
+            return True
+        return False
+
+    async def release(self, name):
+        """
+        Releases a lease held by this process.
+
+        * name (str) - lease name
+        """
+
+        self.held.discard(name)
+        await self._db.release_lease(name, self.holder)
+
+    async def release_all(self):
+        """
+        Releases all leases held by this process.
+        """
+
+        for name in list(self.held):
+            await self.release(name)
+
+    async def renew(self):
+        """
+        Renews all held leases. Returns the names of leases that could not be
+        renewed because another process had taken them over.
+        """
+
+        lost = [
+            name for name in list(self.held)
+            if not await self._db.acquire_lease(name, self.holder, self.ttl)
+        ]
+        self.held.difference_update(lost)
+        return lost
+
+    async def run_renewal(self, on_lost):
+        """
+        Renews held leases every third of the TTL until cancelled. Calls
+        on_lost with the lost lease names if any leases were lost. Failed
+        renewals are logged and retried, but if the leases can't be renewed
+        before they expire, all held leases count as lost.
+
+        * on_lost (coroutine function) - called with a list of lease names
+        """
+
+        loop = asyncio.get_running_loop()
+        interval = self.ttl / 3
+        renewed = loop.time()
+        while True:
+            await asyncio.sleep(interval)
+            started = loop.time()
+            try:
+                lost = await self.renew()
+            except Exception as e:
+                logging.warning(f"{self.holder} failed to renew leases: {e}")
+                if started + interval - renewed < self.ttl:
+                    continue
+                lost = list(self.held)
+                self.held.clear()
+            else:
+                renewed = started
+            if lost:
+                try:
+                    await on_lost(lost)
+                except Exception:
+                    logging.exception("Handling lost leases failed")
+
+    async def claim_shards(self, shard_count, processes):
+        """
+        Claims shards for this process, at most an equal share of the shard
+        count between the given number of processes. Waits until at least
+        one shard can be claimed. Returns the claimed shard IDs.
+
+        * shard_count (int) - total number of shards
+        * processes (int) - number of processes the shards are split between
+        """
+
+        share = math.ceil(shard_count / max(processes, 1))
+        while True:
+            shard_ids = []
+            for shard_id in range(shard_count):
+                if len(shard_ids) >= share:
+                    break
+                if await self.acquire(f"shard:{shard_id}"):
+                    shard_ids.append(shard_id)
+            if shard_ids:
+                logging.info(f"{self.holder} claimed shards {shard_ids}")
+                return shard_ids
+            logging.info(f"{self.holder} waiting for free shards")
+            await asyncio.sleep(self.ttl / 3)
+
+    @asynccontextmanager
+    async def exclusive(self, name):
+        """
+        Async context manager that holds a lease for the duration of a job.
+        Yields True if the lease was acquired, False if another process
+        holds it and the job should be skipped.
+
+        * name (str) - lease name
+        """
+
+        acquired = await self.acquire(name)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await self.release(name)
@@ -0,0 +1,72 @@
+"""
+Per-course signup counters for ITEEBot. Counting the members of a course's
+role means going through every member that has the role, which gets
+expensive over a hundred courses. Instead a counter is kept for each course
+role: it starts from the member count of the course's last
+reconciliation checkpoint, is adjusted whenever the role change queue adds
+the role to a member or removes it, and is set to the real member count
+whenever the course is reconciled. Repeated reactions by a member who already
+has the role don't change the count. Between reconciliations the counters can
+drift a little, e.g. when a role is changed by hand.
+"""
+
+class SignupCounters:
+    """
+    Maps course role IDs to signup counts. Courses that have not been counted
+    yet have no count. Counting by role keeps a course's count in one place
+    even if it can be signed up for from several messages.
+    """
+
+    def __init__(self):
+        self._counts = {}
+
+    def load(self, checkpoints):
+        """
+        Replaces all counts with the member counts of reconciliation
+        checkpoints.
+
+        * checkpoints (iterable) - checkpoint objects from the database
+        """
+
+        self._counts = {c.role_id: c.member_count for c in checkpoints}
+
+    def get(self, role_id):
+        """
+        Returns the count for a course role, or None if it's not known.
+
+        * role_id (int) - ID of the course's role
+        """
+
+        return self._counts.get(role_id)
+
+    def set(self, role_id, count):
+        """
+        Sets the count for a course role, e.g. after reconciliation.
+
+        * role_id (int) - ID of the course's role
+        * count (int) - number of members with the course's role
+        """
+
+        self._counts[role_id] = count
+
+    def change(self, role_id, delta):
+        """
+        Adjusts a known count by delta, never going below zero. Unknown
+        counts are left unknown until the course is reconciled.
+
+        * role_id (int) - ID of the course's role
+        * delta (int) - change in signups, 1 or -1
+        """
+
+        count = self._counts.get(role_id)
+        if count is not None:
+            self._counts[role_id] = max(0, count + delta)
+
+    def remove(self, role_id):
+        """
+        Forgets the count of a course role.
+
+        * role_id (int) - ID of the course's role
+        """
+
+        self._counts.pop(role_id, None)
@@ -0,0 +1,271 @@
+"""
+Resident index of registered courses for ITEEBot. The reaction handlers only
+need to know which role belongs to a signup message, so instead of querying
+the database for every reaction, the bot keeps a compact in-memory mapping
+from signup message ID to course entries. The index is loaded once at
+startup and updated in place by every handler that writes courses to the
+database.
+
+A signup message can hold several courses, each with its own reaction emoji.
+The courses of a message are kept in a small dictionary keyed by emoji, so
+resolving a reaction is two dictionary accesses however many courses share
+the message. Courses with an empty emoji match any reaction on their message.
+
+Message IDs that were looked up but did not match any course are cached as
+negatives so that reactions to unrelated messages in the signup channel don't
+cause repeated database queries either.
+
+Packing courses leaves a role with more than one signup message, so the
+index also maps each role to the IDs of its signup messages. The reaction
+handlers use it to check a member's other signups before removing the role.
+"""
+
+from collections import namedtuple
+
+CourseEntry = namedtuple(
+    "CourseEntry",
+    ["role_id", "code", "name_en", "name_fi", "guild_id", "emoji"]
+)
+
+# Returned by CourseIndex.get when the message ID has not been seen yet
+UNKNOWN = object()
+
+class CourseIndex:
+    """
+    Maps signup message IDs to dictionaries of emoji to CourseEntry tuples.
+    Known negatives are stored in the same dictionary with None as their
+    value, which keeps lookups to a single dictionary access per message.
+    Hit and miss counters are kept for monitoring how well the index is
+    serving the reaction handlers.
+    """
+
+    def __init__(self, negative_limit=10000):
+        """
+        * negative_limit (int) - maximum number of negative entries to keep
+        """
+
+        self._entries = {}
+        self._roles = {}
+        self._courses = 0
+        self._negatives = 0
+        self._negative_limit = negative_limit
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return self._courses
+
+    @staticmethod
+    def entry_from_course(course):
+        """
+        Creates a compact index entry from a database course object.
+
+        * course (Course) - course object from the database module
+        """
+
+        return CourseEntry(
+            course.role_id,
+            course.code,
+            course.name_en,
+            course.name_fi,
+            course.guild_id,
+            course.emoji or ""
+        )
+
+    def load(self, courses):
+        """
+        Replaces the contents of the index with the given courses. Negative
+        entries and counters are reset as well.
+
+        * courses (iterable) - course objects from the database module
+        """
+
+        self._entries = {}
+        self._roles = {}
+        self._courses = 0
+        self._negatives = 0
+        for course in courses:
+            self.add(course.message_id, course)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def resolve(targets, emoji):
+        """
+        Returns the entry in a message's emoji dictionary that matches a
+        reaction emoji, or None. A course with the exact emoji is preferred
+        over one that matches any emoji.
+
+        * targets (dict) - emoji to course entry, or None
+        * emoji (str) - the reaction emoji as a string
+        """
+
+        if not targets:
+            return None
+        entry = targets.get(emoji)
+        if entry is None:
+            entry = targets.get("")
+        return entry
+
+    def get(self, message_id, emoji=""):
+        """
+        Looks up the course entry for a reaction. Returns the entry if found,
+        None if the message is known to not be a signup message or has no
+        course for the emoji, or UNKNOWN if the message ID has not been seen
+        before. In the last case the caller should consult the database and
+        store the result.
+
+        * message_id (int) - ID of the reacted message
+        * emoji (str) - the reaction emoji as a string
+        """
+
+        targets = self._entries.get(message_id, UNKNOWN)
+        if targets is UNKNOWN:
+            self.misses += 1
+            return UNKNOWN
+        entry = self.resolve(targets, emoji)
+        if entry is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def get_all(self, message_id):
+        """
+        Looks up all courses of a message. Returns a dictionary of emoji to
+        course entry, None for known negatives, or UNKNOWN like get.
+
+        * message_id (int) - ID of the message
+        """
+
+        targets = self._entries.get(message_id, UNKNOWN)
+        if targets is UNKNOWN:
+            self.misses += 1
+        elif targets is None:
+            self.negative_hits += 1
+        else:
+            self.hits += 1
+        return targets
+
+    def store(self, message_id, courses):
+        """
+        Stores the result of a database lookup. If courses is empty, the
+        message ID is cached as a negative. Returns the stored dictionary of
+        emoji to course entry (or None).
+
+        * message_id (int) - ID of the looked up message
+        * courses (list) - course objects from the database module
+        """
+
+        if not courses:
+            if self._negatives >= self._negative_limit:
+                self._drop_negatives()
+            if message_id not in self._entries:
+                self._negatives += 1
+            self._entries[message_id] = None
+            return None
+
+        for course in courses:
+            self.add(message_id, course)
+        return self._entries[message_id]
+
+    def add(self, message_id, course):
+        """
+        Adds or replaces a course in the index. Replaces a negative entry for
+        the same message ID if one exists. Returns the stored entry.
+
+        * message_id (int) - ID of the course's signup message
+        * course (Course) - course object from the database module
+        """
+
+        targets = self._entries.get(message_id)
+        if targets is None:
+            if message_id in self._entries:
+                self._negatives -= 1
+            targets = self._entries[message_id] = {}
+        entry = self.entry_from_course(course)
+        old = targets.get(entry.emoji)
+        if old is None:
+            self._courses += 1
+        targets[entry.emoji] = entry
+        if old is not None and old.role_id != entry.role_id:
+            self._unlink(message_id, old.role_id, targets)
+        self._roles.setdefault(entry.role_id, set()).add(message_id)
+        return entry
+
+    def signups(self, role_id):
+        """
+        Returns (message ID, course entry) pairs for all signups of a role.
+
+        * role_id (int) - ID of the course role
+        """
+
+        return [
+            (message_id, entry)
+            for message_id in self._roles.get(role_id, ())
+            for entry in self._entries[message_id].values()
+            if entry.role_id == role_id
+        ]
+
+    def entries(self):
+        """
+        Returns (message ID, course entry) pairs for all courses in the
+        index.
+        """
+
+        return [
+            (message_id, entry)
+            for message_id, targets in self._entries.items() if targets
+            for entry in targets.values()
+        ]
+
+    def remove(self, message_id):
+        """
+        Removes a message ID and all of its courses from the index, positive
+        or negative.
+
+        * message_id (int) - ID of the message to forget
+        """
+
+        targets = self._entries.pop(message_id, UNKNOWN)
+        if targets is None:
+            self._negatives -= 1
+        elif targets is not UNKNOWN:
+            self._courses -= len(targets)
+            for entry in targets.values():
+                self._unlink(message_id, entry.role_id, {})
+
+    def _unlink(self, message_id, role_id, targets):
+        if any(entry.role_id == role_id for entry in targets.values()):
+            return
+        messages = self._roles.get(role_id, set())
+        messages.discard(message_id)
+        if not messages:
+            self._roles.pop(role_id, None)
+
+    def stats(self):
+        """
+        Returns a dictionary of index size and lookup counters, including the
+        hit rate as a fraction of all lookups.
+        """
+
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "courses": len(self),
+            "negatives": self._negatives,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "hit_rate": (
+                (self.hits + self.negative_hits) / lookups if lookups else 0.0
+            ),
+        }
+
+    def _drop_negatives(self):
+        self._entries = {
+            key: value for key, value in self._entries.items()
+            if value is not None
+        }
+        self._negatives = 0
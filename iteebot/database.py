@@ -1,17 +1,44 @@
 """
-ITEEBot database module. Currently the bot only uses one table for registering
-courses. In the current implemenation the database is hardcoded for courses that
-have names in two different languages.
+ITEEBot database module. The main table registers courses, other tables hold
+bookkeeping data for the bot's background jobs. In the current implemenation
+the database is hardcoded for courses that have names in two different
+languages.
 
-SQLALchemy ORM is used to manage the database.
+SQLALchemy ORM is used to manage the database. The bot itself accesses the
+database through AsyncDatabase, which runs the synchronous SQLAlchemy calls in
+a bounded thread pool so that slow queries or commits never block the asyncio
+event loop. The query functions in this module take a session as their first
+argument and can be used both directly and through AsyncDatabase.run.
+
+The DB configuration option can be a plain engine string, or a dictionary
+with the engine string in URL and connection pool and SQLite options, see
+get_engine.
 """
 
-from sqlalchemy import Column, Integer, String
-from sqlalchemy import create_engine
-from sqlalchemy.orm import declarative_base
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import Column, DateTime, Index, Integer, MetaData, String
+from sqlalchemy import Table
+from sqlalchemy import create_engine, event, insert, inspect, or_, text
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import declarative_base, Session
 
 Base = declarative_base()
 
+# Current schema version, must equal len(MIGRATIONS)
+SCHEMA_VERSION = 8
+
+def utcnow():
+    """
+    Returns the current UTC time as a naive datetime, which is how times are
+    stored in the database.
+    """
+
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
 class Course(Base):
     """
     Table for courses. Attributes:
@@ -20,30 +47,695 @@ class Course(Base):
     * name_en (str) - course name in English (optional)
     * message_id (int) - Discord message ID for the course's signup message
     * role_id (int) - ID for the Discord role that will be given to students    
+    * guild_id (int) - ID of the guild the course belongs to (optional, courses
+      created before multi-guild support have none)
+    * emoji (str) - reaction emoji of the course on a signup message shared
+      by several courses, empty if any reaction on the message signs up
+    * rendered (str) - digest of the signup message's content when the bot
+      last posted, edited or checked it (optional)
+
+    A signup message and emoji together identify a course. The same course
+    (role) can have more than one signup, e.g. after packing.
     """
 
     __tablename__ = "course_table"
+    __table_args__ = (
+        Index("ix_course_table_message_emoji", "message_id", "emoji",
+              unique=True),
+    )
     
     id = Column(Integer, primary_key=True)
     code = Column(String, nullable=False)
     name_fi = Column(String, nullable=True)
     name_en = Column(String, nullable=True)
+    message_id = Column(Integer, nullable=False, index=True)
+    role_id = Column(Integer, nullable=False, index=True)
+    guild_id = Column(Integer, nullable=True, index=True)
+    emoji = Column(String, nullable=False, default="", server_default="")
+    rendered = Column(String, nullable=True)
+
+
+class ArchivedCourse(Base):
+    """
+    Table for courses archived at a semester rollover. Archived courses are
+    moved out of course_table so that it only holds the courses that can
+    be signed up for. Attributes:
+    * code (str) - course code
+    * name_fi (str) - course name in Finnish (optional)
+    * name_en (str) - course name in English (optional)
+    * message_id (int) - Discord message ID of the course's signup message
+    * role_id (int) - ID of the course's Discord role
+    * guild_id (int) - ID of the guild the course belonged to (optional)
+    * emoji (str) - reaction emoji of the course on its signup message
+    * archived_at (datetime) - time the course was archived (UTC)
+    """
+
+    __tablename__ = "course_archive"
+
+    id = Column(Integer, primary_key=True)
+    code = Column(String, nullable=False, index=True)
+    name_fi = Column(String, nullable=True)
+    name_en = Column(String, nullable=True)
     message_id = Column(Integer, nullable=False)
     role_id = Column(Integer, nullable=False)
+    guild_id = Column(Integer, nullable=True)
+    emoji = Column(String, nullable=False, default="")
+    archived_at = Column(DateTime, nullable=False)
+
+
+class CourseCheckpoint(Base):
+    """
+    Table for reconciliation checkpoints, one per course role. Records what
+    the course's signups and role looked like when reactions and role
+    members were last compared. Attributes:
+    * role_id (int) - Discord role ID of the course
+    * reaction_count (int) - total number of signup reactions for the role
+    * member_count (int) - number of members with the course's role
+    * checked_at (datetime) - time of the comparison (UTC)
+    """
+
+    __tablename__ = "course_checkpoint"
+
+    role_id = Column(Integer, primary_key=True)
+    reaction_count = Column(Integer, nullable=False)
+    member_count = Column(Integer, nullable=False)
+    checked_at = Column(DateTime, nullable=False)
+
+
+class SignupEvent(Base):
+    """
+    Table for signup events recorded from reactions to signup messages.
+    Attributes:
+    * message_id (int) - Discord message ID of the signup message
+    * role_id (int) - Discord role ID of the course
+    * guild_id (int) - Discord guild ID (optional)
+    * user_id (int) - Discord user ID, None when all reactions were cleared
+    * action (str) - add, remove or clear
+    * created_at (datetime) - time of the reaction event (UTC)
+    """
+
+    __tablename__ = "signup_event"
+
+    id = Column(Integer, primary_key=True)
+    message_id = Column(Integer, nullable=False, index=True)
+    role_id = Column(Integer, nullable=False)
+    guild_id = Column(Integer, nullable=True)
+    user_id = Column(Integer, nullable=True)
+    action = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True)
+
+
+class Lease(Base):
+    """
+    Table for leases that coordinate several bot processes sharing the same
+    database. A lease is held by one process until it expires, and the holder
+    keeps renewing it while it needs it. Attributes:
+    * name (str) - name of the leased resource, e.g. shard:0 or job:import
+    * holder (str) - identifier of the process holding the lease
+    * expires_at (datetime) - time when the lease expires (UTC)
+    """
+
+    __tablename__ = "lease"
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+
+class SchemaVersion(Base):
+    """
+    Single row table that records the schema version of the database. Used by
+    migrate to determine which migrations need to be applied. Attributes:
+    * version (int) - schema version number
+    """
+
+    __tablename__ = "schema_version"
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+
+# Connection pool options in the DB configuration and their engine arguments
+POOL_OPTIONS = {
+    "POOL_SIZE": "pool_size",
+    "MAX_OVERFLOW": "max_overflow",
+    "POOL_RECYCLE": "pool_recycle",
+    "PRE_PING": "pool_pre_ping",
+}
+
+def _set_sqlite_pragmas(dbapi_conn, sqlite_cfg):
+    cursor = dbapi_conn.cursor()
+    if sqlite_cfg.get("WAL"):
+        cursor.execute("PRAGMA journal_mode=WAL")
+    if sqlite_cfg.get("SYNCHRONOUS"):
+        cursor.execute(f"PRAGMA synchronous={sqlite_cfg['SYNCHRONOUS']}")
+    if sqlite_cfg.get("MMAP_SIZE") is not None:
+        cursor.execute(f"PRAGMA mmap_size={int(sqlite_cfg['MMAP_SIZE'])}")
+    cursor.close()
 
 def get_engine(engine_str):
     """
-    Utility function for getting the SQLALchemy engine.
-    * engine_str (str) - SQLALchemy engine string
+    Utility function for getting the SQLALchemy engine. Options that are
+    None are left to SQLAlchemy's defaults. If engine_str is a dictionary,
+    it can have the following keys:
+    * URL (str) - SQLAlchemy engine string
+    * POOL_SIZE (int) - number of connections kept in the pool
+    * MAX_OVERFLOW (int) - connections allowed on top of the pool size
+    * POOL_RECYCLE (int) - seconds after which connections are replaced
+    * PRE_PING (bool) - test connections when they are taken from the pool
+    * SQLITE (dict) - WAL (bool), SYNCHRONOUS (str) and MMAP_SIZE (int)
+      pragmas set on every new SQLite connection
+
+    * engine_str (str or dict) - SQLALchemy engine string or DB options
     """
-    
-    return create_engine(engine_str)
+
+    if isinstance(engine_str, str):
+        return create_engine(engine_str)
+
+    options = {
+        arg: engine_str[key] for key, arg in POOL_OPTIONS.items()
+        if engine_str.get(key) is not None
+    }
+    engine = create_engine(engine_str["URL"], **options)
+    sqlite_cfg = engine_str.get("SQLITE")
+    if engine.dialect.name == "sqlite" and sqlite_cfg:
+        if engine.url.database in (None, "", ":memory:"):
+            sqlite_cfg = dict(sqlite_cfg, WAL=False)
+        event.listen(
+            engine,
+            "connect",
+            lambda conn, record: _set_sqlite_pragmas(conn, sqlite_cfg)
+        )
+    return engine
     
 def init_db(engine_str):
     """
-    Utility function for creating the database table(s).
-    * engine_str (str) - SQLALchemy engine string
+    Utility function for creating the database table(s). Existing databases
+    are upgraded to the current schema version.
+    * engine_str (str or dict) - SQLALchemy engine string or DB options
+    """
+
+    migrate(engine_str)
+
+class MigrationError(Exception):
+    """
+    Raised when a database can't be upgraded without changes from the
+    operator. Nothing is changed in the database.
+    """
+
+
+def _table(name, *columns):
+    """
+    Returns a standalone table definition for DDL in migrations. Migrations
+    describe tables as they were at their schema version, so that later
+    changes to the models don't change what old migrations do.
+    * name (str) - table name
+    * columns (Column) - columns of the table
+    """
+
+    return Table(name, MetaData(), *columns)
+
+def _migrate_1(conn):
+    """
+    Makes course_table.message_id unique and indexes it, and indexes role_id.
+    Refuses to migrate if several courses share a message ID, listing the
+    rows so that the operator can decide which ones to keep.
+    """
+
+    duplicates = conn.execute(text(
+        "SELECT id, code, message_id, role_id FROM course_table "
+        "WHERE message_id IN (SELECT message_id FROM course_table "
+        "GROUP BY message_id HAVING COUNT(*) > 1) ORDER BY message_id, id"
+    )).all()
+    if duplicates:
+        rows = "\n".join(
+            f"id {row.id}: code {row.code}, message_id {row.message_id}, "
+            f"role_id {row.role_id}"
+            for row in duplicates
+        )
+        raise MigrationError(
+            "Several courses share a signup message, delete all but one "
+            f"course of each message from course_table and migrate again:\n"
+            f"{rows}"
+        )
+    table = _table(
+        "course_table",
+        Column("message_id", Integer),
+        Column("role_id", Integer),
+    )
+    Index("ix_course_table_message_id", table.c.message_id, unique=True)\
+        .create(conn, checkfirst=True)
+    Index("ix_course_table_role_id", table.c.role_id)\
+        .create(conn, checkfirst=True)
+
+def _migrate_2(conn):
+    """
+    Adds the course_checkpoint table, with one checkpoint per signup message.
+    """
+
+    _table(
+        "course_checkpoint",
+        Column("message_id", Integer, primary_key=True),
+        Column("reaction_count", Integer, nullable=False),
+        Column("member_count", Integer, nullable=False),
+        Column("checked_at", DateTime, nullable=False),
+    ).create(conn, checkfirst=True)
+
+def _migrate_3(conn):
+    """
+    Adds the guild_id column to course_table. Existing courses are left
+    without a guild.
+    """
+
+    conn.execute(text("ALTER TABLE course_table ADD COLUMN guild_id INTEGER"))
+    table = _table("course_table", Column("guild_id", Integer))
+    Index("ix_course_table_guild_id", table.c.guild_id)\
+        .create(conn, checkfirst=True)
+
+def _migrate_4(conn):
+    """
+    Adds the lease table.
+    """
+
+    _table(
+        "lease",
+        Column("name", String, primary_key=True),
+        Column("holder", String, nullable=False),
+        Column("expires_at", DateTime, nullable=False),
+    ).create(conn, checkfirst=True)
+
+def _migrate_5(conn):
+    """
+    Adds the signup event table.
+    """
+
+    table = _table(
+        "signup_event",
+        Column("id", Integer, primary_key=True),
+        Column("message_id", Integer, nullable=False),
+        Column("role_id", Integer, nullable=False),
+        Column("guild_id", Integer, nullable=True),
+        Column("user_id", Integer, nullable=True),
+        Column("action", String, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+    )
+    Index("ix_signup_event_message_id", table.c.message_id)
+    Index("ix_signup_event_created_at", table.c.created_at)
+    table.create(conn, checkfirst=True)
+
+def _migrate_6(conn):
+    """
+    Adds the emoji column to course_table, and replaces the unique index of
+    message_id with a unique index of message_id and emoji. Existing courses
+    get an empty emoji, so any reaction on their message still signs up.
+    Checkpoints are recreated per role, and the old ones are dropped, which
+    only means that the next reconciliation compares every course in full.
+    """
+
+    conn.execute(text(
+        "ALTER TABLE course_table ADD COLUMN emoji VARCHAR NOT NULL DEFAULT ''"
+    ))
+    table = _table(
+        "course_table",
+        Column("message_id", Integer),
+        Column("emoji", String),
+    )
+    Index("ix_course_table_message_id", table.c.message_id, unique=True)\
+        .drop(conn, checkfirst=True)
+    Index("ix_course_table_message_id", table.c.message_id)\
+        .create(conn)
+    Index(
+        "ix_course_table_message_emoji", table.c.message_id, table.c.emoji,
+        unique=True
+    ).create(conn, checkfirst=True)
+    conn.execute(text("DROP TABLE IF EXISTS course_checkpoint"))
+    _table(
+        "course_checkpoint",
+        Column("role_id", Integer, primary_key=True),
+        Column("reaction_count", Integer, nullable=False),
+        Column("member_count", Integer, nullable=False),
+        Column("checked_at", DateTime, nullable=False),
+    ).create(conn)
+
+def _migrate_7(conn):
+    """
+    Adds the rendered column to course_table. Existing signup messages have
+    no digest, so the first re-render checks all of them.
+    """
+
+    conn.execute(text("ALTER TABLE course_table ADD COLUMN rendered VARCHAR"))
+
+def _migrate_8(conn):
+    """
+    Adds the course archive table.
+    """
+
+    table = _table(
+        "course_archive",
+        Column("id", Integer, primary_key=True),
+        Column("code", String, nullable=False),
+        Column("name_fi", String, nullable=True),
+        Column("name_en", String, nullable=True),
+        Column("message_id", Integer, nullable=False),
+        Column("role_id", Integer, nullable=False),
+        Column("guild_id", Integer, nullable=True),
+        Column("emoji", String, nullable=False),
+        Column("archived_at", DateTime, nullable=False),
+    )
+    Index("ix_course_archive_code", table.c.code)
+    table.create(conn, checkfirst=True)
+
+# Migration functions, MIGRATIONS[n] upgrades from version n to n + 1
+MIGRATIONS = [
+    _migrate_1,
+    _migrate_2,
+    _migrate_3,
+    _migrate_4,
+    _migrate_5,
+    _migrate_6,
+    _migrate_7,
+    _migrate_8,
+]
+
+def get_schema_version(conn):
+    """
+    Returns the schema version of the database behind conn. Databases created
+    before versioning was introduced are version 0, and None is returned for
+    empty databases.
+    * conn (Connection) - SQLAlchemy connection
+    """
+
+    inspector = inspect(conn)
+    if inspector.has_table(SchemaVersion.__tablename__):
+        row = conn.execute(
+            SchemaVersion.__table__.select()
+        ).first()
+        if row is not None:
+            return row.version
+    if inspector.has_table(Course.__tablename__):
+        return 0
+    return None
+
+def _set_schema_version(conn, version):
+    table = SchemaVersion.__table__
+    table.create(conn, checkfirst=True)
+    conn.execute(table.delete())
+    conn.execute(table.insert().values(id=1, version=version))
+
+def migrate(engine_str):
+    """
+    Upgrades the database to the current schema version in place, applying
+    migrations one version at a time within a single transaction. Empty
+    databases are created directly at the current version. Returns a tuple of
+    the schema versions before and after the upgrade. Raises MigrationError,
+    leaving the database as it was, if a migration needs the operator to
+    fix the data first.
+    * engine_str (str or dict) - SQLALchemy engine string or DB options
     """
 
     engine = get_engine(engine_str)
-    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        current = get_schema_version(conn)
+        if current is None:
+            Base.metadata.create_all(conn)
+            _set_schema_version(conn, SCHEMA_VERSION)
+            return None, SCHEMA_VERSION
+
+        for version in range(current, SCHEMA_VERSION):
+            MIGRATIONS[version](conn)
+        _set_schema_version(conn, SCHEMA_VERSION)
+    return current, SCHEMA_VERSION
+
+def find_courses(session, message_id):
+    """
+    Returns a list of the courses associated with a signup message, empty if
+    the message is not a signup message.
+    * session (Session) - SQLAlchemy session
+    * message_id (int) - Discord message ID
+    """
+
+    return session.query(Course).filter_by(message_id=message_id).all()
+
+def all_courses(session):
+    """
+    Returns a list of all registered courses.
+    * session (Session) - SQLAlchemy session
+    """
+
+    return session.query(Course).all()
+
+def add_course(session, **fields):
+    """
+    Creates and commits a new course record, and returns it.
+    * session (Session) - SQLAlchemy session
+    * fields - column values for the new Course
+    """
+
+    course = Course(**fields)
+    session.add(course)
+    session.commit()
+    return course
+
+def add_courses(session, rows):
+    """
+    Creates course records from a list of column value dictionaries in a
+    single transaction, and returns them.
+    * session (Session) - SQLAlchemy session
+    * rows (list) - column values for each new Course
+    """
+
+    courses = [Course(**fields) for fields in rows]
+    session.add_all(courses)
+    session.commit()
+    return courses
+
+def set_rendered(session, message_id, digest):
+    """
+    Stores the content digest of a signup message for all of its courses.
+    * session (Session) - SQLAlchemy session
+    * message_id (int) - Discord message ID
+    * digest (str) - digest of the message's content
+    """
+
+    session.execute(
+        update(Course)
+        .where(Course.message_id == message_id)
+        .values(rendered=digest)
+    )
+    session.commit()
+
+def archive_courses(session, ids):
+    """
+    Moves courses to the course archive in one transaction, and drops the
+    checkpoints of roles that have no courses left. Returns the archived
+    courses.
+    * session (Session) - SQLAlchemy session
+    * ids (list) - IDs of the courses
+    """
+
+    courses = session.query(Course).filter(Course.id.in_(ids)).all()
+    now = utcnow()
+    session.add_all(
+        ArchivedCourse(
+            code=course.code,
+            name_fi=course.name_fi,
+            name_en=course.name_en,
+            message_id=course.message_id,
+            role_id=course.role_id,
+            guild_id=course.guild_id,
+            emoji=course.emoji,
+            archived_at=now,
+        )
+        for course in courses
+    )
+    for course in courses:
+        session.delete(course)
+    roles = {course.role_id for course in courses}
+    remaining = {
+        role_id for role_id, in
+        session.query(Course.role_id).filter(Course.role_id.in_(roles))
+    }
+    session.query(CourseCheckpoint).filter(
+        CourseCheckpoint.role_id.in_(roles - remaining)
+    ).delete()
+    session.commit()
+    return courses
+
+def get_checkpoints(session):
+    """
+    Returns all reconciliation checkpoints as a dictionary keyed by role ID.
+    * session (Session) - SQLAlchemy session
+    """
+
+    return {c.role_id: c for c in session.query(CourseCheckpoint).all()}
+
+def save_checkpoints(session, rows):
+    """
+    Creates or updates reconciliation checkpoints in one transaction.
+    * session (Session) - SQLAlchemy session
+    * rows (list) - column values for each CourseCheckpoint
+    """
+
+    for fields in rows:
+        session.merge(CourseCheckpoint(**fields))
+    session.commit()
+
+def add_signup_events(session, rows):
+    """
+    Inserts signup events with a single multi-row insert.
+    * session (Session) - SQLAlchemy session
+    * rows (list) - column values for each SignupEvent
+    """
+
+    if rows:
+        session.execute(insert(SignupEvent), rows)
+        session.commit()
+
+def acquire_lease(session, name, holder, ttl):
+    """
+    Tries to acquire or renew a lease. Succeeds if the lease doesn't exist,
+    has expired, or is already held by the same holder. Returns True if the
+    holder now has the lease.
+    * session (Session) - SQLAlchemy session
+    * name (str) - lease name
+    * holder (str) - identifier of the process
+    * ttl (float) - seconds until the lease expires unless renewed
+    """
+
+    now = utcnow()
+    expires_at = now + datetime.timedelta(seconds=ttl)
+    result = session.execute(
+        update(Lease)
+        .where(Lease.name == name)
+        .where(or_(Lease.holder == holder, Lease.expires_at < now))
+        .values(holder=holder, expires_at=expires_at)
+    )
+    if result.rowcount:
+        session.commit()
+        return True
+
+    session.add(Lease(name=name, holder=holder, expires_at=expires_at))
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        return False
+    return True
+
+def release_lease(session, name, holder):
+    """
+    Releases a lease if it's held by the given holder.
+    * session (Session) - SQLAlchemy session
+    * name (str) - lease name
+    * holder (str) - identifier of the process
+    """
+
+    session.query(Lease).filter_by(name=name, holder=holder).delete()
+    session.commit()
+
+
+class AsyncDatabase:
+    """
+    Asynchronous access layer for the bot. Each operation gets its own
+    session and runs in a bounded thread pool, so at most max_workers
+    database calls are in progress at once, and the event loop is free to
+    process other events while they wait. Objects are returned detached from
+    their session with their attributes loaded.
+    """
+
+    def __init__(self, engine, max_workers=4, metrics=None):
+        """
+        * engine (Engine) - SQLAlchemy engine object
+        * max_workers (int) - size of the database thread pool
+        * metrics (Metrics) - optional registry for recording query latency
+        """
+
+        self.engine = engine
+        self._metrics = metrics
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers,
+            thread_name_prefix="iteebot-db"
+        )
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs func(session, *args, **kwargs) in the thread pool with a fresh
+        session and returns its result.
+
+        * func (callable) - function that takes a session as first argument
+        """
+
+        loop = asyncio.get_running_loop()
+        if self._metrics is None:
+            return await loop.run_in_executor(
+                self._executor,
+                lambda: self._call(func, args, kwargs)
+            )
+        with self._metrics.timer("db_query_seconds", query=func.__name__):
+            return await loop.run_in_executor(
+                self._executor,
+                lambda: self._call(func, args, kwargs)
+            )
+
+    def _call(self, func, args, kwargs):
+        with Session(self.engine, expire_on_commit=False) as s:
+            return func(s, *args, **kwargs)
+
+    async def find_courses(self, message_id):
+        return await self.run(find_courses, message_id)
+
+    async def all_courses(self):
+        return await self.run(all_courses)
+
+    async def add_course(self, **fields):
+        return await self.run(add_course, **fields)
+
+    async def add_courses(self, rows):
+        return await self.run(add_courses, rows)
+
+    async def set_rendered(self, message_id, digest):
+        return await self.run(set_rendered, message_id, digest)
+
+    async def archive_courses(self, ids):
+        return await self.run(archive_courses, ids)
+
+    async def get_checkpoints(self):
+        return await self.run(get_checkpoints)
+
+    async def save_checkpoints(self, rows):
+        return await self.run(save_checkpoints, rows)
+
+    async def add_signup_events(self, rows):
+        return await self.run(add_signup_events, rows)
+
+    async def acquire_lease(self, name, holder, ttl):
+        return await self.run(acquire_lease, name, holder, ttl)
+
+    async def release_lease(self, name, holder):
+        return await self.run(release_lease, name, holder)
+
+    def close(self):
+        """
+        Shuts down the thread pool after pending operations have finished.
+        """
+
+        self._executor.shutdown(wait=True)
+
+async def get_async_engine(engine_str, max_workers=4):
+    """
+    Asynchronous counterpart of get_engine. Returns an AsyncDatabase wrapping
+    a new engine.
+    * engine_str (str or dict) - SQLALchemy engine string or DB options
+    * max_workers (int) - size of the database thread pool
+    """
+
+    engine = await asyncio.to_thread(get_engine, engine_str)
+    return AsyncDatabase(engine, max_workers)
+
+async def init_db_async(engine_str):
+    """
+    Asynchronous counterpart of init_db. Creates the database table(s) in a
+    worker thread.
+    * engine_str (str or dict) - SQLALchemy engine string or DB options
+    """
+
+    await asyncio.to_thread(init_db, engine_str)
@@ -0,0 +1,131 @@
+"""
+Course file parsing for bulk imports. Courses can be imported from CSV files
+with a header row, or JSON files containing a list of objects (optionally
+under a "courses" key). Both use the same fields:
+
+* role_id - ID of the course's Discord role (required)
+* code - course code (required)
+* name_en - course name in English, empty if not given
+* name_fi - course name in Finnish, empty if not given
+
+Signup messages are rendered from the message templates with the functions
+at the end of this module.
+"""
+
+import csv
+import hashlib
+import io
+import json
+
+FIELDS = ("role_id", "code", "name_en", "name_fi")
+
+class CourseFileError(ValueError):
+    """
+    Raised when a course file can't be parsed.
+    """
+
+
+def parse_courses(data, filename):
+    """
+    Parses course file contents into a list of course dictionaries with the
+    keys in FIELDS. The format is chosen by the file extension. Rows that
+    repeat an earlier role ID and code combination are dropped.
+
+    * data (bytes or str) - file contents
+    * filename (str) - name of the file, used for detecting the format
+    """
+
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig")
+
+    courses = []
+    seen = set()
+    for number, row in enumerate(_read_rows(data, filename), start=1):
+        course = _parse_row(number, row)
+        key = (course["role_id"], course["code"])
+        if key not in seen:
+            seen.add(key)
+            courses.append(course)
+    return courses
+
+def _read_rows(data, filename):
+    """
+    Reads the rows of a course file in the format given by the file
+    extension.
+
+    * data (str) - file contents
+    * filename (str) - name of the file
+    """
+
+    if filename.lower().endswith(".json"):
+        try:
+            rows = json.loads(data)
+        except json.JSONDecodeError as e:
+            raise CourseFileError(f"Invalid JSON: {e}")
+        if isinstance(rows, dict):
+            rows = rows.get("courses", [])
+        return rows
+    if filename.lower().endswith(".csv"):
+        return list(csv.DictReader(io.StringIO(data)))
+    raise CourseFileError(f"Unsupported file type: {filename}")
+
+def _parse_row(number, row):
+    """
+    Converts a row of a course file into a course dictionary.
+
+    * number (int) - row number for error messages
+    * row (dict) - the row
+    """
+
+    if not isinstance(row, dict):
+        raise CourseFileError(f"Row {number} is not an object")
+    try:
+        return {
+            "role_id": int(row["role_id"]),
+            "code": str(row["code"]).strip(),
+            "name_en": str(row.get("name_en") or "").strip(),
+            "name_fi": str(row.get("name_fi") or "").strip(),
+        }
+    except (KeyError, TypeError, ValueError):
+        raise CourseFileError(
+            f"Row {number} needs an integer role_id and a code"
+        )
+
+def render_signup(template, course, emoji=""):
+    """
+    Renders the signup message, or a line of a grouped signup message, for a
+    course dictionary. Missing names are rendered empty.
+
+    * template (str) - signup message template from configuration
+    * course (dict) - course with code, name_en and name_fi keys
+    * emoji (str) - the course's reaction emoji in a grouped message
+    """
+
+    return template.format(
+        code=course["code"],
+        name_en=course["name_en"] or "",
+        name_fi=course["name_fi"] or "",
+        emoji=emoji,
+    )
+
+def render_group(template, courses):
+    """
+    Renders a signup message shared by several courses, one line per course.
+
+    * template (str) - line template from configuration
+    * courses (list) - (emoji, course dictionary) pairs
+    """
+
+    return "\n".join(
+        render_signup(template, course, emoji) for emoji, course in courses
+    )
+
+def content_digest(content):
+    """
+    Returns a digest of a signup message's content, stored to remember what
+    the message was last rendered as.
+
+    * content (str) - message content
+    """
+
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
@@ -0,0 +1,487 @@
+"""
+Durable journal of role operations for ITEEBot. Role changes made by the
+role change queue and by bulk operations like role resets only live in
+memory while their API calls are waiting or in flight, so they are lost if
+the process is killed. With the journal enabled (JOURNAL option), every role
+operation is written to a small local SQLite file before its API call is
+made, and deleted when the call has succeeded.
+
+Operations that fail are retried with exponential backoff by the bot's
+journal worker, and after JOURNAL.MAX_ATTEMPTS attempts they are kept as dead
+letters that can be listed and requeued with commands. Operations that were
+in flight when the process stopped are retried when it starts again. A new
+operation for the same member and role replaces older ones, so a retry never
+undoes a newer change. Changes that turn out to need no API call still
+supersede older operations for the same member and role, and clearing a role
+drops the role's operations, except those of members who keep the role.
+
+Operations are idempotent, so the deletes of finished operations are
+written behind in batches: after a crash a few finished operations may be
+made again, which doesn't change anything. The journal is local to the
+process, processes that share a database (CLUSTER option) each need their
+own journal file.
+"""
+
+import asyncio
+import datetime
+import logging
+import os
+
+from sqlalchemy import Boolean, Column, DateTime, Index, Integer, String
+from sqlalchemy import delete, select, tuple_, update
+from sqlalchemy.orm import declarative_base
+
+from . import database as db
+
+JournalBase = declarative_base()
+
+PENDING = "pending"
+DEAD = "dead"
+
+# Maximum number of rows in one statement's IN clause
+CHUNK = 500
+
+class RoleOperation(JournalBase):
+    """
+    Table for journaled role operations. Attributes:
+    * guild_id (int) - Discord guild ID
+    * user_id (int) - Discord user ID
+    * role_id (int) - Discord role ID
+    * add (bool) - True to add the role, False to remove it
+    * source (str) - what caused the operation, e.g. reaction or a reset
+    * state (str) - pending or dead
+    * attempts (int) - failed attempts so far
+    * next_attempt (datetime) - when the operation is retried (UTC), None
+      while it's in flight
+    * error (str) - error of the last failed attempt
+    * created_at (datetime) - time the operation was journaled (UTC)
+    """
+
+    __tablename__ = "role_operation"
+    __table_args__ = (
+        Index("ix_role_operation_target", "guild_id", "user_id", "role_id"),
+        Index("ix_role_operation_due", "state", "next_attempt"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(Integer, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    role_id = Column(Integer, nullable=False)
+    add = Column(Boolean, nullable=False)
+    source = Column(String, nullable=True)
+    state = Column(String, nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt = Column(DateTime, nullable=True)
+    error = Column(String, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+
+def open_journal(session):
+    """
+    Creates the journal table if needed, and makes operations that were in
+    flight when the previous process stopped due for a retry. Returns the
+    number of pending operations.
+    * session (Session) - SQLAlchemy session
+    """
+
+    JournalBase.metadata.create_all(session.get_bind())
+    session.execute(
+        update(RoleOperation)
+        .where(RoleOperation.state == PENDING)
+        .where(RoleOperation.next_attempt.is_(None))
+        .values(next_attempt=db.utcnow())
+    )
+    session.commit()
+    return session.query(RoleOperation).filter_by(state=PENDING).count()
+
+def record_operations(session, rows):
+    """
+    Journals new role operations in flight, replacing older operations for
+    the same member and role. Returns the IDs of the new operations.
+    * session (Session) - SQLAlchemy session
+    * rows (list) - (guild ID, user ID, role ID, add, source) tuples
+    """
+
+    _delete_targets(session, {row[:3] for row in rows})
+    now = db.utcnow()
+    operations = [
+        RoleOperation(
+            guild_id=guild_id, user_id=user_id, role_id=role_id, add=add,
+            source=source, state=PENDING, attempts=0, created_at=now
+        )
+        for guild_id, user_id, role_id, add, source in rows
+    ]
+    session.add_all(operations)
+    session.commit()
+    return [operation.id for operation in operations]
+
+def supersede_operations(session, keys):
+    """
+    Deletes the operations for members and roles whose latest change needs
+    no API call, so that retries don't undo it.
+    * session (Session) - SQLAlchemy session
+    * keys (list) - (guild ID, user ID, role ID) tuples
+    """
+
+    _delete_targets(session, set(keys))
+    session.commit()
+
+def discard_role_operations(session, guild_id, role_id, keep=()):
+    """
+    Deletes the operations for a role, pending and dead, when the role is
+    cleared. Returns the number of deleted operations.
+    * session (Session) - SQLAlchemy session
+    * guild_id (int) - Discord guild ID
+    * role_id (int) - Discord role ID
+    * keep (set) - IDs of users whose operations are kept
+    """
+
+    if keep:
+        users = session.scalars(
+            select(RoleOperation.user_id)
+            .where(RoleOperation.guild_id == guild_id)
+            .where(RoleOperation.role_id == role_id)
+        ).all()
+        targets = [
+            (guild_id, user_id, role_id)
+            for user_id in set(users) - set(keep)
+        ]
+        _delete_targets(session, targets)
+        session.commit()
+        return len(targets)
+    result = session.execute(
+        delete(RoleOperation)
+        .where(RoleOperation.guild_id == guild_id)
+        .where(RoleOperation.role_id == role_id)
+    )
+    session.commit()
+    return result.rowcount
+
+def _delete_targets(session, keys):
+    target = tuple_(
+        RoleOperation.guild_id, RoleOperation.user_id, RoleOperation.role_id
+    )
+    keys = list(keys)
+    for i in range(0, len(keys), CHUNK):
+        session.execute(delete(RoleOperation).where(
+            target.in_(keys[i:i + CHUNK])
+        ))
+
+def finish_operations(session, ids):
+    """
+    Deletes finished operations.
+    * session (Session) - SQLAlchemy session
+    * ids (list) - operation IDs
+    """
+
+    for i in range(0, len(ids), CHUNK):
+        session.execute(delete(RoleOperation).where(
+            RoleOperation.id.in_(ids[i:i + CHUNK])
+        ))
+    session.commit()
+
+def fail_operations(session, ids, error, backoff, max_backoff, max_attempts):
+    """
+    Records a failed attempt of operations and schedules their retries, or
+    makes them dead letters after max_attempts attempts. Returns the number
+    of new dead letters.
+    * session (Session) - SQLAlchemy session
+    * ids (list) - operation IDs
+    * error (str) - description of the failure
+    * backoff (float) - seconds before the first retry, doubled every time
+    * max_backoff (float) - maximum seconds between retries
+    * max_attempts (int) - attempts before giving up
+    """
+
+    now = db.utcnow()
+    dead = 0
+    for operation in session.query(RoleOperation).filter(
+            RoleOperation.id.in_(ids)):
+        operation.attempts += 1
+        operation.error = error
+        if operation.attempts >= max_attempts:
+            operation.state = DEAD
+            operation.next_attempt = None
+            dead += 1
+        else:
+            delay = min(max_backoff, backoff * 2 ** (operation.attempts - 1))
+            operation.next_attempt = now + datetime.timedelta(seconds=delay)
+    session.commit()
+    return dead
+
+def take_due_operations(session, limit):
+    """
+    Returns pending operations whose retry is due, oldest first, and marks
+    them in flight.
+    * session (Session) - SQLAlchemy session
+    * limit (int) - maximum number of operations
+    """
+
+    operations = (
+        session.query(RoleOperation)
+        .filter(RoleOperation.state == PENDING)
+        .filter(RoleOperation.next_attempt <= db.utcnow())
+        .order_by(RoleOperation.id)
+        .limit(limit)
+        .all()
+    )
+    for operation in operations:
+        operation.next_attempt = None
+    session.commit()
+    return operations
+
+def dead_operations(session, guild_id, limit):
+    """
+    Returns a guild's dead letters, oldest first, and the total number of
+    them.
+    * session (Session) - SQLAlchemy session
+    * guild_id (int) - Discord guild ID
+    * limit (int) - maximum number of operations to return
+    """
+
+    query = session.query(RoleOperation).filter_by(
+        state=DEAD, guild_id=guild_id
+    )
+    return query.order_by(RoleOperation.id).limit(limit).all(), query.count()
+
+def requeue_dead_operations(session, guild_id):
+    """
+    Makes a guild's dead letters pending again with their attempts reset.
+    Returns the number of requeued operations.
+    * session (Session) - SQLAlchemy session
+    * guild_id (int) - Discord guild ID
+    """
+
+    result = session.execute(
+        update(RoleOperation)
+        .where(RoleOperation.state == DEAD)
+        .where(RoleOperation.guild_id == guild_id)
+        .values(state=PENDING, attempts=0, next_attempt=db.utcnow())
+    )
+    session.commit()
+    return result.rowcount
+
+
+class RoleJournal:
+    """
+    Journal of role operations in a local SQLite file. Writes go through a
+    single database thread. Counters (attributes):
+    * recorded (int) - operations journaled
+    * finished (int) - operations that succeeded
+    * failed (int) - failed attempts
+    * dead (int) - operations that became dead letters
+    """
+
+    def __init__(self, path, backoff=5.0, max_backoff=600.0, max_attempts=8,
+                 flush_interval=0.5):
+        """
+        * path (str) - journal file
+        * backoff (float) - seconds before the first retry, doubled every time
+        * max_backoff (float) - maximum seconds between retries
+        * max_attempts (int) - attempts before an operation is a dead letter
+        * flush_interval (float) - seconds finished operations can wait
+          before they are deleted
+        """
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._db = db.AsyncDatabase(db.get_engine({
+            "URL": f"sqlite:///{path}",
+            "SQLITE": {"WAL": True, "SYNCHRONOUS": "NORMAL"},
+        }), max_workers=1)
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._max_attempts = max_attempts
+        self._interval = flush_interval
+        self._finished = []
+        self._timer = None
+        self._flush_task = None
+        self.recorded = 0
+        self.finished = 0
+        self.failed = 0
+        self.dead = 0
+
+    async def open(self):
+        """
+        Opens the journal. Returns the number of pending operations, which
+        includes the operations left in flight by the previous process.
+        """
+
+        pending = await self._db.run(open_journal)
+        if pending:
+            logging.info(f"Role journal has {pending} pending operations")
+        return pending
+
+    async def record(self, rows):
+        """
+        Journals role operations before their API calls are made. Returns
+        their IDs.
+
+        * rows (list) - (guild ID, user ID, role ID, add, source) tuples
+        """
+
+        if not rows:
+            return []
+        ids = await self._db.run(record_operations, rows)
+        self.recorded += len(ids)
+        return ids
+
+    async def supersede(self, keys):
+        """
+        Drops operations that are replaced by changes that need no API call.
+
+        * keys (list) - (guild ID, user ID, role ID) tuples
+        """
+
+        if keys:
+            await self._db.run(supersede_operations, keys)
+
+    async def discard_role(self, guild_id, role_id, keep=()):
+        """
+        Drops the operations for a role that is being cleared, except those
+        of the users in keep.
+
+        * guild_id (int) - Discord guild ID
+        * role_id (int) - Discord role ID
+        * keep (set) - IDs of users whose operations are kept
+        """
+
+        return await self._db.run(
+            discard_role_operations, guild_id, role_id, keep
+        )
+
+    async def track(self, ids, call):
+        """
+        Awaits an API call that makes journaled operations, and records its
+        result: the operations are finished if the call succeeds, and
+        scheduled for a retry if it raises. The exception is raised again.
+
+        * ids (list) - IDs of the operations made by the call
+        * call (coroutine) - the API call
+        """
+
+        try:
+            result = await call
+        except Exception as e:
+            await self.fail(ids, e)
+            raise
+        self.finish(ids)
+        return result
+
+    def finish(self, ids):
+        """
+        Marks operations finished. They are deleted from the journal with
+        the next batch.
+
+        * ids (list) - operation IDs
+        """
+
+        self.finished += len(ids)
+        self._finished.extend(ids)
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._interval, self._start_flush
+            )
+
+    def _start_flush(self):
+        self._timer = None
+        self._flush_task = asyncio.create_task(self._run_flush())
+
+    async def _run_flush(self):
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.warning(f"Deleting finished role operations failed: {e}")
+
+    async def flush(self):
+        """
+        Deletes the operations that have finished since the last flush. If
+        the delete fails, they are kept for the next flush.
+        """
+
+        ids, self._finished = self._finished, []
+        if ids:
+            try:
+                await self._db.run(finish_operations, ids)
+            except Exception:
+                self._finished.extend(ids)
+                raise
+
+    async def fail(self, ids, error):
+        """
+        Records a failed attempt of operations.
+
+        * ids (list) - operation IDs
+        * error (Exception or str) - the failure
+        """
+
+        self.failed += len(ids)
+        dead = await self._db.run(
+            fail_operations, ids, str(error), self._backoff,
+            self._max_backoff, self._max_attempts
+        )
+        if dead:
+            self.dead += dead
+            logging.error(f"{dead} role operations failed for good: {error}")
+
+    async def due(self, limit=100):
+        """
+        Returns operations that are due for a retry, and marks them in
+        flight. Each of them must be passed to track or fail.
+
+        * limit (int) - maximum number of operations
+        """
+
+        return await self._db.run(take_due_operations, limit)
+
+    async def dead_letters(self, guild_id, limit=20):
+        """
+        Returns a tuple of up to limit dead letters of a guild and their
+        total number.
+
+        * guild_id (int) - Discord guild ID
+        * limit (int) - maximum number of operations to return
+        """
+
+        return await self._db.run(dead_operations, guild_id, limit)
+
+    async def requeue_dead(self, guild_id):
+        """
+        Makes a guild's dead letters pending again. Returns their number.
+
+        * guild_id (int) - Discord guild ID
+        """
+
+        return await self._db.run(requeue_dead_operations, guild_id)
+
+    async def close(self):
+        """
+        Writes pending deletes and closes the journal.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flush_task is not None:
+            await self._flush_task
+            self._flush_task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"Deleting finished role operations failed: {e}")
+        self._db.close()
+        self._db.engine.dispose()
+
+    def stats(self):
+        """
+        Returns a dictionary of the journal's counters.
+        """
+
+        return {
+            "recorded": self.recorded,
+            "finished": self.finished,
+            "failed": self.failed,
+            "dead": self.dead,
+        }
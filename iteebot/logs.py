@@ -0,0 +1,124 @@
+"""
+Logging setup for ITEEBot. Log records are put into a queue by the logging
+calls, and written out by a listener thread, so that formatting, file writes
+and log rotation never happen in the bot's event loop. Logs can be written
+as plain text lines or as JSON objects, one per line. Records can carry event
+and handler fields (given with the extra argument of logging calls), which
+are included as separate fields in the JSON format.
+"""
+
+import copy
+import json
+import logging
+import os
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from logging.handlers import TimedRotatingFileHandler
+
+TEXT_FORMAT = "%(asctime)s %(name)s %(levelname)-8s %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Optional structured fields copied from records into JSON output
+FIELDS = ("event", "handler")
+
+_installed = None
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single line JSON objects with time, level, logger and
+    message fields, the structured fields in FIELDS if the record has them,
+    and the formatted exception if there is one.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(QueueHandler):
+    """
+    QueueHandler that keeps the formatted exception in exc_text instead of
+    merging it into the message, so that the target handler's formatter
+    decides how it is written.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info
+            )
+            record.exc_info = None
+        return record
+
+
+def setup_logging(log_cfg, debug=False):
+    """
+    Routes the root logger through a queue to a background listener. In
+    debug mode records are written to stderr at DEBUG level, otherwise to a
+    time rotating log file at INFO level, keeping LOG.BACKUPS old files.
+    Replaces the handler installed by an earlier call. Returns the file or
+    stream handler that the listener writes to.
+
+    * log_cfg (dict) - the LOG section of the configuration
+    * debug (bool) - log to stderr at debug level
+    """
+
+    stop_logging()
+    if debug:
+        target = logging.StreamHandler()
+    else:
+        os.makedirs(os.path.dirname(log_cfg["FILE"]), exist_ok=True)
+        target = TimedRotatingFileHandler(
+            log_cfg["FILE"],
+            when=log_cfg["ROTATE"][0],
+            interval=log_cfg["ROTATE"][1],
+            backupCount=log_cfg["BACKUPS"],
+        )
+    if log_cfg.get("FORMAT") == "json":
+        target.setFormatter(JsonFormatter())
+    else:
+        target.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+
+    records = queue.SimpleQueue()
+    handler = _QueueHandler(records)
+    listener = QueueListener(records, target, respect_handler_level=True)
+    listener.start()
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG if debug else logging.INFO)
+
+    global _installed
+    _installed = (handler, listener, target)
+    return target
+
+def stop_logging():
+    """
+    Removes the queue handler installed by setup_logging from the root
+    logger, writes out records that are still queued and closes the target
+    handler.
+    """
+
+    global _installed
+    if _installed is None:
+        return
+    handler, listener, target = _installed
+    _installed = None
+    logging.getLogger().removeHandler(handler)
+    listener.stop()
+    target.close()
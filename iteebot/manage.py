@@ -1,12 +1,15 @@
 """
 Command line management utilities for ITEEBot. This module's command line
 interface will act as the bot's entry point when installed.
+
+Each command imports the modules it needs when it runs, so that commands
+that don't talk to Discord don't pay for importing discord.py, and the
+configuration commands don't import SQLAlchemy either. Use
+benchmarks/startup.py to check the import cost of each command.
 """
 
 import click
 from . import configurator as conf
-from . import database as db
-from .bot import ITEEBot
 
 @click.group()
 def cli():
@@ -48,8 +51,45 @@ def init_db(config_path):
     iteebot init-db /home/donkey/.iteebot/config.json
     """
 
+    from . import database as db
+
+    config = conf.load_config(config_path)
+    try:
+        db.init_db(config["DB"])
+    except db.MigrationError as e:
+        raise click.ClickException(str(e))
+
+@click.command("migrate")
+@click.argument(
+    "config_path",
+    default="instance/config.json",
+    type=click.Path(exists=True)
+)
+def migrate(config_path):
+    """
+    Upgrades the database defined in the configuration's DB option to the
+    current schema version. Databases created before schema versioning are
+    upgraded from version 0. 
+
+    * config_path (str) - Path to the configuration file
+    
+    Example:
+    iteebot migrate /home/donkey/.iteebot/config.json
+    """
+
+    from . import database as db
+
     config = conf.load_config(config_path)
-    db.init_db(config["DB"])
+    try:
+        old, new = db.migrate(config["DB"])
+    except db.MigrationError as e:
+        raise click.ClickException(str(e))
+    if old is None:
+        click.echo(f"Created new database at schema version {new}")
+    elif old == new:
+        click.echo(f"Database is up to date at schema version {new}")
+    else:
+        click.echo(f"Upgraded database from schema version {old} to {new}")
 
 @click.command("run")
 @click.option("--debug", default=False, help="Run in debug mode")
@@ -71,13 +111,192 @@ def run(debug, config_path):
     iteebot run --debug /home/donkey/.iteebot/config.json
     """
 
+    from .bot import create_bot
+
     config = conf.load_config(config_path)
-    bot = ITEEBot(config, debug=debug)
+    bot = create_bot(config, debug=debug, config_path=config_path)
     bot.run()
 
+@click.command("import-courses")
+@click.argument(
+    "course_file",
+    type=click.Path(exists=True)
+)
+@click.argument(
+    "config_path",
+    default="instance/config.json",
+    type=click.Path(exists=True)
+)
+@click.option(
+    "--guild-id",
+    type=int,
+    default=None,
+    help="Guild to import to, if configured in GUILDS"
+)
+def import_courses(course_file, config_path, guild_id):
+    """
+    Imports courses from a CSV or JSON file, posting their signup messages to
+    the signup channel and registering them in the database. Courses that
+    are already registered are skipped, so the import can be rerun after a
+    partial failure.
+
+    * course_file (str) - Path to the CSV or JSON file
+    * config_path (str) - Path to the configuration file
+    * guild_id (int) - Guild to import to
+    
+    Example:
+    iteebot import-courses courses.csv /home/donkey/.iteebot/config.json
+    """
+
+    import asyncio
+    from .bot import create_bot
+    from .commands import CommandError
+    from .importer import CourseFileError, parse_courses
+
+    config = conf.load_config(config_path)
+    with open(course_file, "rb") as f:
+        try:
+            courses = parse_courses(f.read(), course_file)
+        except CourseFileError as e:
+            raise click.ClickException(str(e))
+    bot = create_bot(config)
+    try:
+        counts = asyncio.run(
+            bot.run_once(bot.import_courses, courses, None, guild_id)
+        )
+    except CommandError as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        "{added} added ({adopted} reused existing messages), "
+        "{skipped} already registered, {failed} failed".format(**counts)
+    )
+
+@click.command("rollover")
+@click.argument(
+    "config_path",
+    default="instance/config.json",
+    type=click.Path(exists=True)
+)
+@click.option(
+    "--code",
+    "codes",
+    multiple=True,
+    help="Code of a course to archive, can be given several times"
+)
+@click.option(
+    "--all",
+    "archive_all",
+    is_flag=True,
+    help="Archive all of the guild's courses"
+)
+@click.option(
+    "--guild-id",
+    type=int,
+    default=None,
+    help="Guild whose courses to archive, if configured in GUILDS"
+)
+def rollover(config_path, codes, archive_all, guild_id):
+    """
+    Archives courses at the end of a semester: deletes their signup messages,
+    clears their roles from all members and moves them to the course
+    archive. An interrupted rollover can be rerun.
+
+    * config_path (str) - Path to the configuration file
+    * codes (tuple) - Codes of the courses to archive
+    * archive_all (bool) - Archive all courses instead
+    * guild_id (int) - Guild whose courses to archive
+
+    Example:
+    iteebot rollover /home/donkey/.iteebot/config.json --code 521141P
+    """
+
+    import asyncio
+    from .bot import create_bot
+    from .commands import CommandError
+
+    if bool(codes) == archive_all:
+        raise click.UsageError("Give either --code options or --all")
+    config = conf.load_config(config_path)
+    bot = create_bot(config)
+    try:
+        counts = asyncio.run(bot.run_once(
+            bot.rollover, None if archive_all else codes, None, guild_id
+        ))
+    except CommandError as e:
+        raise click.ClickException(str(e))
+    click.echo(
+        "{archived} courses archived, {deleted} signup messages deleted "
+        "({bulk_deleted} in bulk), {missing} missing, {failed} failed, "
+        "{kept} kept for other courses. Cleared {roles} roles from "
+        "{cleared} members, {clear_failed} failed".format(**counts)
+    )
+
+@click.command("replay")
+@click.argument(
+    "recording",
+    type=click.Path(exists=True)
+)
+@click.argument(
+    "config_path",
+    default="instance/config.json",
+    type=click.Path(exists=True)
+)
+@click.option(
+    "--timing",
+    type=click.Choice(["fast", "original"]),
+    default="fast",
+    help="Replay as fast as possible or at the recorded times"
+)
+@click.option(
+    "--speed",
+    type=float,
+    default=1.0,
+    help="Speed-up factor for original timing"
+)
+@click.option(
+    "--latency",
+    type=float,
+    default=0.0,
+    help="Simulated API latency in seconds"
+)
+@click.option(
+    "--unpaced",
+    is_flag=True,
+    help="Don't pace API calls with the OUTBOUND options"
+)
+def replay_recording(recording, config_path, timing, speed, latency, unpaced):
+    """
+    Replays an event recording through the bot's handlers against stand-ins
+    for Discord, and prints a JSON report of throughput, latency and users
+    whose roles differ from what the events should have left them with. The
+    configuration should have the recorded bot's channels and guilds, its
+    database is not used.
+
+    * recording (str) - Path to the recording file
+    * config_path (str) - Path to the configuration file
+
+    Example:
+    iteebot replay events.jsonl /home/donkey/.iteebot/config.json
+    """
+
+    import asyncio
+    import json
+    from .replay import load_recording, run_replay
+
+    config = conf.load_config(config_path)
+    report = asyncio.run(run_replay(
+        load_recording(recording), config, timing, speed, latency,
+        not unpaced
+    ))
+    click.echo(json.dumps(report, indent=2))
+
 cli.add_command(create_config)
 cli.add_command(init_db)
+cli.add_command(migrate)
+cli.add_command(import_courses)
+cli.add_command(rollover)
 cli.add_command(run)
+cli.add_command(replay_recording)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,143 @@
+"""
+Member lookups for ITEEBot. By default discord.py keeps every member of
+every guild in memory and requests all of them when the bot starts, which
+is slow and takes a lot of memory on large servers. The bot only needs
+members in a few places: removing a role when a reaction is removed, and
+scanning role membership for bulk operations and reconciliation.
+
+MemberCache hides where members come from. In the default mode it reads
+discord.py's member cache. In low-memory mode discord.py doesn't cache
+members, and MemberCache instead keeps a bounded LRU of members fetched on
+demand, and scans role membership by paging through the guild's members
+with the API.
+"""
+
+import logging
+from collections import OrderedDict
+
+import discord
+
+from .scheduler import BULK, INTERACTIVE
+
+class MemberCache:
+    """
+    Looks up members and role memberships either from discord.py's member
+    cache or, in low-memory mode, from a bounded LRU and the API. Counters
+    (attributes):
+    * hits (int) - members found in the LRU
+    * fetches (int) - members fetched from the API
+    * scans (int) - member list scans for role memberships
+    """
+
+    def __init__(self, outbound=None, size=10000, low_memory=False):
+        """
+        * outbound (OutboundScheduler) - scheduler for API calls, optional
+        * size (int) - maximum number of members kept in the LRU
+        * low_memory (bool) - use the LRU and API instead of discord.py's
+          member cache
+        """
+
+        self._outbound = outbound
+        self._size = size
+        self.low_memory = low_memory
+        self._lru = OrderedDict()
+        self.hits = 0
+        self.fetches = 0
+        self.scans = 0
+
+    def put(self, member):
+        """
+        Stores a member that arrived with an event, so that it doesn't need
+        to be fetched later. Does nothing outside low-memory mode.
+
+        * member (Member) - member to store
+        """
+
+        if not self.low_memory or member is None:
+            return
+        key = (member.guild.id, member.id)
+        self._lru[key] = member
+        self._lru.move_to_end(key)
+        if len(self._lru) > self._size:
+            self._lru.popitem(last=False)
+
+    async def get(self, guild, user_id):
+        """
+        Returns a guild member, or None if the user is not a member.
+
+        * guild (Guild) - the guild
+        * user_id (int) - ID of the user
+        """
+
+        member = guild.get_member(user_id)
+        if member is not None or not self.low_memory:
+            return member
+
+        key = (guild.id, user_id)
+        member = self._lru.get(key)
+        if member is not None:
+            self.hits += 1
+            self._lru.move_to_end(key)
+            return member
+
+        self.fetches += 1
+        try:
+            if self._outbound is None:
+                member = await guild.fetch_member(user_id)
+            else:
+                member = await self._outbound.call(
+                    INTERACTIVE, guild.fetch_member, user_id
+                )
+        except discord.NotFound:
+            return None
+        self.put(member)
+        return member
+
+    async def role_members(self, guild, role_ids, scan=False):
+        """
+        Returns a dictionary from role ID to a list of the members that have
+        the role. In low-memory mode the guild's members are paged through
+        once for all of the roles, and only the members of the given roles
+        are kept.
+
+        * guild (Guild) - the guild
+        * role_ids (iterable) - IDs of the roles
+        * scan (bool) - page through the members in any mode, e.g. when the
+          client isn't connected to the gateway and has no cached members
+        """
+
+        members = {role_id: [] for role_id in role_ids}
+        if not self.low_memory and not scan:
+            for role_id in members:
+                role = guild.get_role(role_id)
+                if role is not None:
+                    members[role_id] = role.members
+            return members
+
+        self.scans += 1
+        scanned = 0
+        if self._outbound is None:
+            listing = guild.fetch_members(limit=None)
+        else:
+            listing = self._outbound.pages(
+                BULK, guild.fetch_members, "after", size=1000
+            )
+        async for member in listing:
+            scanned += 1
+            for role in member.roles:
+                if role.id in members:
+                    members[role.id].append(member)
+        logging.info(f"Scanned {scanned} members of guild {guild.id}")
+        return members
+
+    def stats(self):
+        """
+        Returns a dictionary of the LRU size and counters.
+        """
+
+        return {
+            "cached": len(self._lru),
+            "hits": self.hits,
+            "fetches": self.fetches,
+            "scans": self.scans,
+        }
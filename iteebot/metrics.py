@@ -0,0 +1,278 @@
+"""
+Runtime metrics for ITEEBot. The bot records counters and latency histograms
+for its event handlers, database queries and outbound API calls into a
+Metrics object. Other components that keep their own counters (the course
+index, role queue and outbound scheduler) are registered as collectors and
+read when metrics are rendered.
+
+Metrics can be read from the control channel with the stats command, or
+through an optional HTTP endpoint that serves them in the Prometheus text
+format. The endpoint is meant to be bound to localhost for a local scraper
+and is disabled by default.
+"""
+
+import functools
+import logging
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+PREFIX = "iteebot_"
+
+# Histogram bucket upper bounds in seconds
+BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. Keeps the number of observations
+    per bucket, the total count and the sum of observed values.
+    """
+
+    __slots__ = ("counts", "count", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """
+        Records one observation.
+
+        * value (float) - observed value in seconds
+        """
+
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction):
+        """
+        Returns the upper bound of the bucket that contains the given
+        quantile, which is an upper estimate of the real value. Returns
+        infinity if the quantile falls in the overflow bucket.
+
+        * fraction (float) - quantile as a fraction, e.g. 0.95
+        """
+
+        target = fraction * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target and cumulative:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return 0.0
+
+
+class Metrics:
+    """
+    Registry of counters, histograms and collectors. Counters and histograms
+    are identified by name and a set of label values given as keyword
+    arguments.
+    """
+
+    def __init__(self):
+        self._counters = {}
+        self._histograms = {}
+        self._collectors = []
+
+    def inc(self, name, value=1, **labels):
+        """
+        Increments a counter.
+
+        * name (str) - counter name
+        * value (int) - amount to add
+        """
+
+        key = (name, _label_key(labels))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a latency observation into a histogram.
+
+        * name (str) - histogram name
+        * seconds (float) - observed latency
+        """
+
+        key = (name, _label_key(labels))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = Histogram()
+        histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """
+        Context manager that records the duration of its block into a
+        histogram, and counts exceptions raised from it in a counter named
+        name_errors.
+
+        * name (str) - histogram name
+        """
+
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.inc(f"{name}_errors", **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def collect(self, name, func, **labels):
+        """
+        Registers a collector. The function is called whenever metrics are
+        rendered and it should return a flat dictionary of numeric values,
+        which are reported as name_key.
+
+        * name (str) - name prefix for the collected values
+        * func (callable) - function returning a dictionary
+        """
+
+        self._collectors.append((name, func, _label_key(labels)))
+
+    def histograms(self, name):
+        """
+        Returns (labels, histogram) pairs for all histograms with the given
+        name.
+
+        * name (str) - histogram name
+        """
+
+        return [
+            (dict(key), histogram)
+            for (hname, key), histogram in sorted(self._histograms.items())
+            if hname == name
+        ]
+
+    def render(self):
+        """
+        Renders all metrics in the Prometheus text exposition format.
+        """
+
+        lines = []
+        for (name, key), value in sorted(self._counters.items()):
+            lines.append(f"{PREFIX}{name}_total{_format_labels(key)} {value}")
+        for (name, key), histogram in sorted(self._histograms.items()):
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                labels = _format_labels(key, [("le", bound)])
+                lines.append(f"{PREFIX}{name}_bucket{labels} {cumulative}")
+            labels = _format_labels(key)
+            lines.append(f"{PREFIX}{name}_sum{labels} {histogram.sum}")
+            lines.append(f"{PREFIX}{name}_count{labels} {histogram.count}")
+        for name, func, key in self._collectors:
+            for field, value in func().items():
+                if isinstance(value, (int, float)):
+                    lines.append(
+                        f"{PREFIX}{name}_{field}{_format_labels(key)} {value}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def summary(self, name):
+        """
+        Returns a list of human readable summary lines for histograms with
+        the given name.
+
+        * name (str) - histogram name
+        """
+
+        lines = []
+        for labels, histogram in self.histograms(name):
+            if not histogram.count:
+                continue
+            label = "/".join(str(value) for value in labels.values())
+            lines.append(
+                f"{label}: {histogram.count} calls, "
+                f"avg {histogram.sum / histogram.count * 1000:.1f}ms, "
+                f"p95 <= {histogram.quantile(0.95) * 1000:.1f}ms"
+            )
+        return lines
+
+
+def instrumented(func):
+    """
+    Decorator for ITEEBot event handler methods. Records the handler's
+    latency in the handler_seconds histogram of the bot's _metrics, labeled
+    with the handler's name.
+
+    * func (coroutine function) - handler method to wrap
+    """
+
+    name = func.__name__
+
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        with self._metrics.timer("handler_seconds", handler=name):
+            return await func(self, *args, **kwargs)
+
+    return wrapper
+
+
+class MetricsServer:
+    """
+    Minimal HTTP server that serves rendered metrics from /metrics.
+    """
+
+    def __init__(self, metrics, host="127.0.0.1", port=9108):
+        """
+        * metrics (Metrics) - the metrics registry to serve
+        * host (str) - address to bind to
+        * port (int) - port to listen on, 0 to pick a free port
+        """
+
+        self._metrics = metrics
+        self._host = host
+        self._port = port
+        self._runner = None
+        self.port = None
+
+    async def _handle(self, request):
+        return web.Response(
+            text=self._metrics.render(),
+            content_type="text/plain",
+        )
+
+    async def start(self):
+        """
+        Starts serving. The actual port is stored in the port attribute.
+        """
+
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self._host, self._port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        logging.info(f"Serving metrics on {self._host}:{self.port}")
+
+    async def stop(self):
+        """
+        Stops the server.
+        """
+
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
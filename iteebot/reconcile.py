@@ -0,0 +1,238 @@
+"""
+Startup reconciliation between signup reactions and role membership. Reaction
+events that arrive while the bot is offline are lost, so when the bot comes
+online it compares the users that have reacted to each course's signups with
+the members of the course's role, and gives the role to users who have
+reacted but don't have it. Roles are only removed from members who haven't
+reacted if removing is enabled, as course roles may also be given by hand.
+Courses are compared per role, with the reactions of every signup message
+and emoji of the course, and each message is fetched only once even if it's
+shared by several courses.
+
+Listing every user that has reacted to a large signup message is expensive,
+so a checkpoint is stored for each course after it has been compared. If the
+reaction count of the course's signups and the role's member count are both
+unchanged since the checkpoint, the course is assumed to be in sync and the
+full comparison is skipped. Checkpoints older than a maximum age are not
+trusted, so every course gets a full comparison every now and then.
+"""
+
+import datetime
+import logging
+
+import discord
+
+from .bulk import BulkRoleOperation
+from .database import utcnow
+from .members import MemberCache
+from .scheduler import BULK
+
+class Reconciler:
+    """
+    Compares signup reactions with role members for a set of courses and
+    applies the differences as bulk role operations. Counters (attributes):
+    * checked (int) - courses that were compared in full
+    * unchanged (int) - courses skipped based on their checkpoint
+    * missing (int) - courses whose message or role was not found
+    * added (int) - roles given to users who had reacted
+    * removed (int) - roles removed from users who had not reacted
+    """
+
+    def __init__(self, database, outbound, user=None, members=None,
+                 counters=None, concurrency=4, max_age=86400, remove=False):
+        """
+        * database (AsyncDatabase) - database access layer
+        * outbound (OutboundScheduler) - scheduler for API calls
+        * user (ClientUser) - the bot's own user, whose reactions are ignored
+        * members (MemberCache) - member lookups, discord.py's cache if None
+        * counters (SignupCounters) - signup counters to correct, optional
+        * concurrency (int) - concurrency of the bulk role operations
+        * max_age (float) - maximum age of a trusted checkpoint in seconds
+        * remove (bool) - whether to remove the role from members who have
+          not reacted
+        """
+
+        self._db = database
+        self._outbound = outbound
+        self._user = user
+        self._members = members or MemberCache(outbound)
+        self._counters = counters
+        self._concurrency = concurrency
+        self._max_age = datetime.timedelta(seconds=max_age)
+        self._remove = remove
+        self.checked = 0
+        self.unchanged = 0
+        self.missing = 0
+        self.added = 0
+        self.removed = 0
+
+    async def reconcile(self, channel, courses):
+        """
+        Reconciles the given courses, whose signup messages are in channel,
+        and stores new checkpoints for them. Returns a summary text.
+
+        * channel (TextChannel) - the signup channel
+        * courses (list) - course objects from the database
+        """
+
+        checkpoints = await self._db.get_checkpoints()
+        signups = {}
+        for course in courses:
+            signups.setdefault(course.role_id, []).append(course)
+        role_members = await self._members.role_members(
+            channel.guild, signups
+        )
+        messages = {}
+        updates = []
+        for role_id, role_courses in signups.items():
+            try:
+                update = await self._reconcile_role(
+                    channel,
+                    role_courses,
+                    checkpoints.get(role_id),
+                    role_members[role_id],
+                    messages
+                )
+            except discord.HTTPException as e:
+                logging.warning(
+                    f"Reconciliation failed for {role_courses[0].code}: {e}"
+                )
+                update = None
+            if update is not None:
+                updates.append(update)
+        await self._db.save_checkpoints(updates)
+        summary = (
+            f"Reconciliation: {self.checked} courses checked, "
+            f"{self.unchanged} unchanged, {self.missing} missing, "
+            f"{self.added} roles added, {self.removed} roles removed"
+        )
+        logging.info(summary)
+        return summary
+
+    def _count(self, role_id, member_count):
+        if self._counters is not None:
+            self._counters.set(role_id, member_count)
+
+    async def _fetch(self, channel, message_id, messages):
+        """
+        Fetches a signup message once per pass, messages shared by several
+        courses are taken from the messages dictionary after the first
+        fetch. Returns None for deleted messages.
+        """
+
+        if message_id not in messages:
+            try:
+                messages[message_id] = await self._outbound.call(
+                    BULK, channel.fetch_message, message_id
+                )
+            except discord.NotFound:
+                messages[message_id] = None
+        return messages[message_id]
+
+    async def _signup_reactions(self, channel, courses, messages):
+        """
+        Returns the reactions that count as signups for a course role, from
+        all of its signup messages that still exist, or None if none of them
+        exist.
+        """
+
+        reactions = []
+        found = False
+        for signup in courses:
+            message = await self._fetch(channel, signup.message_id, messages)
+            if message is None:
+                continue
+            found = True
+            reactions.extend(
+                r for r in message.reactions
+                if not signup.emoji or str(r.emoji) == signup.emoji
+            )
+        return reactions if found else None
+
+    async def _reactors(self, reactions):
+        """
+        Returns the IDs of the users who have reacted with any of the
+        reactions, other than the bot itself.
+        """
+
+        reactors = set()
+        for reaction in reactions:
+            async for user in self._outbound.pages(
+                BULK, reaction.users, "after"
+            ):
+                if self._user is None or user.id != self._user.id:
+                    reactors.add(user.id)
+        return reactors
+
+    async def _apply(self, course, role, members, add):
+        """
+        Adds a course's role to members, or removes it from them, as a bulk
+        operation. Returns the number of members that were changed.
+        """
+
+        if not members:
+            return 0
+        operation = BulkRoleOperation(
+            f"Reconciling {course.code} ({'add' if add else 'remove'})",
+            members,
+            lambda m: self._outbound.call(
+                BULK, m.add_roles if add else m.remove_roles, role
+            ),
+            concurrency=self._concurrency,
+        )
+        await operation.run()
+        return operation.done
+
+    async def _reconcile_role(self, channel, courses, checkpoint, members,
+                              messages):
+        """
+        Reconciles one course role against the reactions on all of its
+        signups. A member should have the role if they have reacted to any
+        of them with the signup's emoji, or with any emoji on a signup that
+        has none.
+        """
+
+        guild = channel.guild
+        course = courses[0]
+        role = guild.get_role(course.role_id)
+        reactions = await self._signup_reactions(channel, courses, messages)
+        if reactions is None or role is None:
+            self.missing += 1
+            return None
+
+        reaction_count = sum(
+            r.count - (1 if r.me else 0) for r in reactions
+        )
+        now = utcnow()
+        if (checkpoint is not None
+                and checkpoint.reaction_count == reaction_count
+                and checkpoint.member_count == len(members)
+                and now - checkpoint.checked_at < self._max_age):
+            self.unchanged += 1
+            self._count(role.id, len(members))
+            return None
+
+        reactors = await self._reactors(reactions)
+        member_ids = {m.id for m in members}
+        to_add = []
+        for user_id in reactors - member_ids:
+            member = await self._members.get(guild, user_id)
+            if member is not None:
+                to_add.append(member)
+        to_remove = []
+        if self._remove:
+            to_remove = [m for m in members if m.id not in reactors]
+        self.checked += 1
+
+        added = await self._apply(course, role, to_add, True)
+        removed = await self._apply(course, role, to_remove, False)
+        self.added += added
+        self.removed += removed
+        member_count = len(members) + added - removed
+        self._count(role.id, member_count)
+        return {
+            "role_id": role.id,
+            "reaction_count": reaction_count,
+            "member_count": member_count,
+            "checked_at": now,
+        }
@@ -0,0 +1,155 @@
+"""
+Event recorder for ITEEBot. When enabled (RECORD option), the reaction and
+command events handled by the bot are appended to a JSON lines file, so that
+production incidents like signup rushes or mass reaction clears can be
+replayed offline with the replay command, see the replay module.
+
+Each line is one event with short keys to keep recordings compact:
+* t - seconds since the recording started
+* e - event: add, remove, clear, clear_emoji or message
+* m - message ID
+* c - channel ID
+* g - guild ID
+* u - user ID (add, remove and message)
+* x - emoji as a string (add, remove and clear_emoji)
+* s - message content (message)
+
+The first line of a recording has the event start, the wall clock time it
+started at (at) and the courses registered at that time (courses), each with
+the keys m, x, g, r (role ID) and code. Lines are written through the file's
+buffer and flushed once a second, so recording doesn't wait for the disk in
+the event handlers.
+"""
+
+import asyncio
+import datetime
+import json
+import logging
+import os
+import time
+
+# Format version of recordings
+VERSION = 1
+
+def reaction_fields(event):
+    """
+    Returns the recorded fields of a raw reaction event.
+
+    * event (RawReactionEvent) - reaction event from discord.py
+    """
+
+    fields = {"m": event.message_id, "c": event.channel_id, "g": event.guild_id}
+    user_id = getattr(event, "user_id", None)
+    if user_id is not None:
+        fields["u"] = user_id
+    emoji = getattr(event, "emoji", None)
+    if emoji is not None:
+        fields["x"] = str(emoji)
+    return fields
+
+def message_fields(message):
+    """
+    Returns the recorded fields of a message. Attachments are not recorded.
+
+    * message (Message) - a discord.py message object
+    """
+
+    return {
+        "m": message.id,
+        "c": message.channel.id,
+        "g": message.guild.id if message.guild is not None else None,
+        "u": message.author.id,
+        "s": message.content,
+    }
+
+
+class EventRecorder:
+    """
+    Appends events to a recording file. Counters (attributes):
+    * recorded (int) - events recorded
+    """
+
+    def __init__(self, path, flush_interval=1.0):
+        """
+        * path (str) - recording file, appended to if it exists
+        * flush_interval (float) - seconds between flushes to the file
+        """
+
+        self.path = path
+        self._interval = flush_interval
+        self._file = None
+        self._start = None
+        self._timer = None
+        self.recorded = 0
+
+    def start(self, courses):
+        """
+        Opens the recording file and writes the start line.
+
+        * courses (iterable) - (message ID, CourseEntry) pairs from the
+          course index
+        """
+
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._start = time.monotonic()
+        self._write({
+            "t": 0.0,
+            "e": "start",
+            "v": VERSION,
+            "at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "courses": [
+                {
+                    "m": message_id,
+                    "x": course.emoji,
+                    "g": course.guild_id,
+                    "r": course.role_id,
+                    "code": course.code,
+                }
+                for message_id, course in courses
+            ],
+        })
+        logging.info(f"Recording events to {self.path}")
+
+    def record(self, event, fields):
+        """
+        Appends one event to the recording. Does nothing if the recording
+        hasn't been started.
+
+        * event (str) - event name
+        * fields (dict) - event fields, see reaction_fields and
+          message_fields
+        """
+
+        if self._file is None:
+            return
+        self.recorded += 1
+        self._write(dict(
+            t=round(time.monotonic() - self._start, 6), e=event, **fields
+        ))
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._interval, self._flush
+            )
+
+    def _write(self, line):
+        self._file.write(json.dumps(line, separators=(",", ":")) + "\n")
+
+    def _flush(self):
+        self._timer = None
+        if self._file is not None:
+            self._file.flush()
+
+    def close(self):
+        """
+        Flushes and closes the recording file.
+        """
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,370 @@
+"""
+Offline replay of event recordings for ITEEBot, see the recorder module for
+the recording format. Recorded events are fed through the real event
+handlers of a bot that talks to stand-ins instead of Discord, the same ones
+the test suite uses, see the standins module. Every recorded user is a
+member of the guild, and roles and members are created when they are first
+needed.
+
+The bot gets a fresh database in a temporary directory, filled with the
+courses from the recording's start lines. Events are dispatched as tasks in
+recorded order, either as fast as possible or at their original timing
+(optionally sped up), like discord.py dispatches each event as a task.
+
+The replay reports throughput, handler latency per event type, API calls and
+role queue counters. It also computes the roles every recorded user should
+end up with from the events alone (assuming they had none of the course roles
+when the recording started) and reports every user whose roles differ at the
+end of the replay, which catches lost or reordered role changes.
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from sqlalchemy.orm import Session
+
+from . import database as db
+from .bot import ITEEBot
+from .commands import CommandRegistry
+from .configurator import merge
+from .courseindex import CourseIndex
+from .standins import MockAPI, MockChannel, MockGuild, MockMessage
+
+# Event types of recordings, in report order
+EVENTS = ("add", "remove", "clear", "clear_emoji", "message")
+# Maximum number of state differences listed in the report
+DIFF_LIMIT = 20
+
+def load_recording(path):
+    """
+    Reads a recording file. A file can hold several recordings appended
+    after each other. Their events are returned in order with times relative
+    to the start of the first recording, and the courses of all of their
+    start lines are combined. Returns a tuple of the course dictionaries and
+    the events.
+
+    * path (str) - recording file
+    """
+
+    courses = {}
+    events = []
+    offset = 0.0
+    last = 0.0
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            event = json.loads(line)
+            if event["e"] == "start":
+                offset = last
+                for course in event["courses"]:
+                    courses[(course["m"], course["x"])] = course
+                continue
+            event["t"] += offset
+            last = event["t"]
+            events.append(event)
+    return list(courses.values()), events
+
+
+class ReplayGuild(MockGuild):
+    """
+    Stand-in for guilds. Roles and members are created on first access.
+    """
+
+    def get_role(self, role_id):
+        if role_id not in self._roles:
+            self.create_role(role_id)
+        return self._roles[role_id]
+
+    def get_member(self, user_id):
+        if user_id not in self._members:
+            self.create_member(user_id)
+        return self._members[user_id]
+
+    async def fetch_member(self, user_id):
+        self.get_member(user_id)
+        return await super().fetch_member(user_id)
+
+
+class ReplayClient(ITEEBot):
+    """
+    ITEEBot that doesn't connect to Discord. Channels and guilds are
+    stand-ins created on first access.
+    """
+
+    def __init__(self, config, api, **kwargs):
+        """
+        * config (dict) - configuration dictionary
+        * api (MockAPI) - simulated API shared by all stand-ins
+        """
+
+        super().__init__(config, **kwargs)
+        self.api = api
+        self._channels = {}
+        self._guilds = {}
+
+    def get_guild(self, guild_id):
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = ReplayGuild(guild_id, self.api)
+        return guild
+
+    def get_channel(self, channel_id):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            guild_cfg = (
+                self._signup_channels.get(channel_id)
+                or self._control_channels.get(channel_id)
+            )
+            guild = None
+            if guild_cfg is not None and guild_cfg["GUILD_ID"] is not None:
+                guild = self.get_guild(guild_cfg["GUILD_ID"])
+            channel = MockChannel(channel_id, self.api, guild)
+            self._channels[channel_id] = channel
+        return channel
+
+    async def fetch_channel(self, channel_id):
+        return self.get_channel(channel_id)
+
+    async def dispatch_recorded(self, event):
+        """
+        Calls the handler of a recorded event.
+
+        * event (dict) - event from a recording
+        """
+
+        name = event["e"]
+        guild = self.get_guild(event["g"]) if event["g"] is not None else None
+        if name == "message":
+            channel = self.get_channel(event["c"])
+            author = (
+                guild.get_member(event["u"]) if guild is not None
+                else SimpleNamespace(id=event["u"])
+            )
+            message = MockMessage(
+                event["m"], event["s"], author, guild=guild, channel=channel
+            )
+            await self.on_message(message)
+            return
+
+        raw = SimpleNamespace(
+            message_id=event["m"],
+            channel_id=event["c"],
+            guild_id=event["g"],
+            user_id=event.get("u"),
+            member=None,
+            emoji=event.get("x"),
+        )
+        if name == "add":
+            raw.member = guild.get_member(event["u"])
+            await self.on_raw_reaction_add(raw)
+        elif name == "remove":
+            await self.on_raw_reaction_remove(raw)
+        elif name == "clear":
+            await self.on_raw_reaction_clear(raw)
+        elif name == "clear_emoji":
+            await self.on_raw_reaction_clear_emoji(raw)
+
+
+def expected_roles(courses, events, sep):
+    """
+    Computes the course roles each recorded user should have after the
+    events, starting from no roles. Reset commands remove their role from
+    everyone. Returns a dictionary from (guild ID, user ID) to a set of role
+    IDs.
+
+    * courses (list) - course dictionaries from the recording
+    * events (list) - events from the recording
+    * sep (str) - command argument separator
+    """
+
+    signups = {}
+    for course in courses:
+        signups.setdefault(course["m"], {})[course["x"]] = course
+    roles = {}
+    for event in events:
+        name = event["e"]
+        targets = signups.get(event["m"])
+        if name in ("add", "remove"):
+            _expect_reaction(roles, targets, event)
+        elif name in ("clear", "clear_emoji") and targets:
+            for course in targets.values():
+                if course["g"] not in (None, event["g"]):
+                    continue
+                if name == "clear" or course["x"] == event.get("x"):
+                    _expect_clear(roles, event["g"], course["r"])
+        elif name == "message":
+            role_id = _reset_role(event["s"], sep)
+            if role_id is not None:
+                _expect_clear(roles, event["g"], role_id)
+    return roles
+
+def _expect_reaction(roles, targets, event):
+    course = CourseIndex.resolve(targets, event.get("x", ""))
+    if course is None or course["g"] not in (None, event["g"]):
+        return
+    user_roles = roles.setdefault((event["g"], event["u"]), set())
+    if event["e"] == "add":
+        user_roles.add(course["r"])
+    else:
+        user_roles.discard(course["r"])
+
+def _expect_clear(roles, guild_id, role_id):
+    for (guild, user), user_roles in roles.items():
+        if guild == guild_id:
+            user_roles.discard(role_id)
+
+def _reset_role(content, sep):
+    content = content.lstrip("<@0123456789> ")
+    if not content.startswith("!"):
+        return None
+    command, args = CommandRegistry.split(content[1:], sep)
+    if command != "resetrole" or not args:
+        return None
+    try:
+        return int(args[0])
+    except ValueError:
+        return None
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1,
+                      round(fraction * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+def _summarize(samples):
+    samples = sorted(samples)
+    return {
+        "count": len(samples),
+        "p50_ms": _percentile(samples, 0.50) * 1000,
+        "p95_ms": _percentile(samples, 0.95) * 1000,
+        "p99_ms": _percentile(samples, 0.99) * 1000,
+        "max_ms": (samples[-1] if samples else 0.0) * 1000,
+    }
+
+def _replay_config(config, workdir, paced):
+    overrides = {
+        "DB": f"sqlite:///{os.path.join(workdir, 'replay.db')}",
+        "CLUSTER": {"ENABLED": False},
+        "RECONCILE": {"ENABLED": False},
+        "RECORD": {"ENABLED": False},
+        "JOURNAL": {"ENABLED": False},
+        "METRICS": {"ENABLED": False},
+        "LOG": {"FILE": os.path.join(workdir, "log", "iteebot.log")},
+    }
+    if not paced:
+        overrides["OUTBOUND"] = {"RATE": 1e9, "BURST": 1e9}
+    return merge(config, overrides)
+
+def _role_diffs(bot, courses, expected):
+    course_roles = {course["r"] for course in courses}
+    actual = {}
+    for guild in bot._guilds.values():
+        for member in guild._members.values():
+            actual[(guild.id, member.id)] = {
+                role.id for role in member.roles if role.id in course_roles
+            }
+    users = set(expected) | set(actual)
+    diffs = []
+    for key in sorted(users, key=str):
+        want = expected.get(key, set())
+        have = actual.get(key, set())
+        if want != have:
+            diffs.append({
+                "guild": key[0],
+                "user": key[1],
+                "missing": sorted(want - have),
+                "extra": sorted(have - want),
+            })
+    return len(users), diffs
+
+async def run_replay(recording, config, timing="fast", speed=1.0,
+                     latency=0.0, paced=True):
+    """
+    Replays a recording through a bot with stand-ins and returns a report
+    dictionary.
+
+    * recording (tuple) - courses and events from load_recording
+    * config (dict) - configuration of the bot, its channels and GUILDS
+      should match the recorded bot's
+    * timing (str) - fast, or original to keep the recorded event times
+    * speed (float) - speed-up factor of original timing
+    * latency (float) - simulated API latency in seconds
+    * paced (bool) - pace API calls with the OUTBOUND options, otherwise
+      the outbound scheduler doesn't limit the rate
+    """
+
+    courses, events = recording
+    with tempfile.TemporaryDirectory() as workdir:
+        config = _replay_config(config, workdir, paced)
+        db.init_db(config["DB"])
+        with Session(db.get_engine(config["DB"])) as s:
+            db.add_courses(s, [
+                {
+                    "code": course["code"],
+                    "message_id": course["m"],
+                    "emoji": course["x"],
+                    "role_id": course["r"],
+                    "guild_id": course["g"],
+                }
+                for course in courses
+            ])
+
+        api = MockAPI(latency)
+        bot = ReplayClient(config, api)
+        await bot.setup_hook()
+        samples = {name: [] for name in EVENTS}
+        errors = 0
+
+        async def dispatch(event):
+            nonlocal errors
+            start = time.perf_counter()
+            try:
+                await bot.dispatch_recorded(event)
+            except Exception:
+                errors += 1
+                await bot.on_error(event["e"], event)
+            samples[event["e"]].append(time.perf_counter() - start)
+
+        tasks = []
+        start = time.perf_counter()
+        for event in events:
+            if timing == "original":
+                delay = event["t"] / speed - (time.perf_counter() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(dispatch(event)))
+        await asyncio.gather(*tasks)
+        await bot._roles.drain()
+        duration = time.perf_counter() - start
+
+        users, diffs = _role_diffs(
+            bot, courses,
+            expected_roles(courses, events, config["COMMAND_SEP"])
+        )
+
+        report = {
+            "events": len(events),
+            "timing": timing,
+            "duration_s": duration,
+            "events_per_s": len(events) / duration if duration else 0.0,
+            "latency": {
+                name: _summarize(values)
+                for name, values in samples.items() if values
+            },
+            "errors": errors,
+            "api_calls": api.calls,
+            "role_queue": bot._roles.stats(),
+            "state": {
+                "users": users,
+                "differences": len(diffs),
+                "diffs": diffs[:DIFF_LIMIT],
+            },
+        }
+        await bot.close()
+    return report
@@ -0,0 +1,321 @@
+"""
+Per-member role change buffering for ITEEBot. During signup rushes students
+often react and unreact within seconds, or sign up to several courses in a
+row. Instead of making one API call per reaction, role changes are collected
+per member for a short settle window. When the window closes, only the final
+desired state of each role is compared against the member's current roles,
+which drops opposing add/remove pairs and changes that would not do anything.
+Whatever remains is sent as a single role edit, through the outbound
+scheduler's interactive lane if a scheduler is given. The comparison is made
+again when the scheduler dispatches the edit, so that the edit is built from
+the member's roles at that time rather than when it was queued.
+
+A member has at most one flush running at a time. Changes whose window closes
+while the member's previous flush is still running are flushed after it, on
+top of the roles it set.
+
+Members that are not kept up to date by discord.py's member cache (in
+low-memory mode) may have stale roles, so for them the final state of each
+role is sent as is, with one add or remove call per role. These calls don't
+send the member's other roles, so a stale member object can't undo changes
+made since it was fetched.
+
+If a change listener is given, it is told about each role change the queue
+has made, so that it doesn't need to guess which of the submitted changes did
+anything. For members whose roles can't be trusted this is based on their
+roles when the changes were flushed.
+
+If a journal is given, the changes of each flush are journaled before their
+API calls are made, so that they are retried if the calls fail or the
+process stops before they have finished, see the journal module.
+"""
+
+import asyncio
+import logging
+
+import discord
+
+from .scheduler import INTERACTIVE
+
+class RoleChangeQueue:
+    """
+    Buffers role changes per member. Counters (attributes):
+    * requested (int) - number of role changes submitted
+    * settled (int) - number of submitted changes whose window has closed
+    * calls (int) - number of API calls made
+    * skipped (int) - flushes that turned out to be no-ops
+    * failed (int) - API calls that failed
+    """
+
+    def __init__(self, settle=1.0, scheduler=None, trust_roles=True,
+                 journal=None, on_change=None):
+        """
+        * settle (float) - seconds to wait for more changes after the first
+          change for a member before flushing
+        * scheduler (OutboundScheduler) - scheduler for making the API calls
+        * trust_roles (bool) - whether members' roles are up to date and can
+          be used to skip changes that would not do anything
+        * journal (RoleJournal) - journal for the role changes, if any
+        * on_change (function) - called with a role ID and 1 or -1 for each
+          role that was added to or removed from a member
+        """
+
+        self._settle = settle
+        self._scheduler = scheduler
+        self._trust_roles = trust_roles
+        self._journal = journal
+        self._on_change = on_change
+        self._pending = {}
+        self._flushing = set()
+        self._inflight = set()
+        self._applied = {}
+        self.requested = 0
+        self.settled = 0
+        self.calls = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @staticmethod
+    def _key(member):
+        return (member.guild.id, member.id)
+
+    def add(self, member, role):
+        """
+        Queues adding role to member.
+
+        * member (Member) - member to give the role to
+        * role (Role) - role to add
+        """
+
+        self._submit(member, role, True)
+
+    def remove(self, member, role):
+        """
+        Queues removing role from member.
+
+        * member (Member) - member to remove the role from
+        * role (Role) - role to remove
+        """
+
+        self._submit(member, role, False)
+
+    def discard_role(self, role_id, keep=()):
+        """
+        Drops the pending changes for a role, e.g. when the role is being
+        cleared, except those of the members in keep.
+
+        * role_id (int) - ID of the role
+        * keep (set) - IDs of members whose changes are kept
+        """
+
+        for (guild_id, member_id), pending in self._pending.items():
+            if member_id not in keep:
+                pending["changes"].pop(role_id, None)
+
+    def _submit(self, member, role, add):
+        self.requested += 1
+        key = self._key(member)
+        pending = self._pending.get(key)
+        if pending is None:
+            pending = {"member": member, "changes": {}, "count": 0}
+            self._pending[key] = pending
+            loop = asyncio.get_running_loop()
+            pending["timer"] = loop.call_later(
+                self._settle, self._start_flush, key
+            )
+        else:
+            pending["member"] = member
+        pending["changes"][role.id] = (role, add)
+        pending["count"] += 1
+
+    def _start_flush(self, key):
+        pending = self._pending.get(key)
+        if pending is None:
+            return
+        if key in self._inflight:
+            # flushed when the member's current flush has finished
+            pending["due"] = True
+            return
+        del self._pending[key]
+        pending["timer"].cancel()
+        self.settled += pending["count"]
+        self._inflight.add(key)
+        task = asyncio.create_task(self._run_flush(key, pending))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _run_flush(self, key, pending):
+        try:
+            await self._flush(key, pending)
+        finally:
+            self._inflight.discard(key)
+            following = self._pending.get(key)
+            if following is None:
+                self._applied.pop(key, None)
+            elif following.get("due"):
+                self._start_flush(key)
+
+    async def _flush(self, key, pending):
+        member = pending["member"]
+        changes = list(pending["changes"].values())
+        if self._trust_roles and not any(self._diff(key, member, changes)):
+            self.skipped += 1
+            await self._supersede(member, changes)
+            return
+
+        wanted = [role for role, add in changes if add]
+        unwanted = [role for role, add in changes if not add]
+        add_ids, remove_ids = await self._record(member, wanted, unwanted)
+        if not self._trust_roles:
+            await self._flush_atomic(
+                member, wanted, unwanted, add_ids, remove_ids
+            )
+            return
+        try:
+            await self._call(
+                add_ids + remove_ids, self._role_editor(key, member, changes)
+            )
+        except discord.HTTPException as e:
+            self.failed += 1
+            logging.warning(f"Role update failed for member {member.id}: {e}")
+            return
+        self._applied.setdefault(key, {}).update(pending["changes"])
+
+    def _current_roles(self, key, member):
+        # discord.py updates cached members only when the gateway reports
+        # the change, which can be after the member's next flush starts
+        roles = set(member.roles)
+        for role, add in self._applied.get(key, {}).values():
+            if add:
+                roles.add(role)
+            else:
+                roles.discard(role)
+        return roles
+
+    def _diff(self, key, member, changes):
+        current = self._current_roles(key, member)
+        adds = [role for role, add in changes if add and role not in current]
+        removes = [
+            role for role, add in changes if not add and role in current
+        ]
+        return adds, removes
+
+    def _role_editor(self, key, member, changes):
+        """
+        Returns a function that compares the changes against the member's
+        roles when the scheduler dispatches it, and makes the remaining
+        changes with a single role edit.
+        """
+
+        async def edit_roles():
+            adds, removes = self._diff(key, member, changes)
+            if not adds and not removes:
+                self.skipped += 1
+                return
+            self.calls += 1
+            roles = [
+                role for role in self._current_roles(key, member)
+                if not role.is_default() and role not in removes
+            ]
+            await member.edit(roles=roles + adds)
+            self._changed(adds, removes)
+
+        return edit_roles
+
+    def _changed(self, adds, removes):
+        if self._on_change is None:
+            return
+        for role in adds:
+            self._on_change(role.id, 1)
+        for role in removes:
+            self._on_change(role.id, -1)
+
+    async def _flush_atomic(self, member, adds, removes, add_ids, remove_ids):
+        """
+        Makes role changes with one API call per role, for members whose
+        roles can't be trusted.
+        """
+
+        current = set(member.roles)
+        try:
+            if adds:
+                self.calls += len(adds)
+                try:
+                    await self._call(add_ids, member.add_roles, *adds)
+                except discord.HTTPException as e:
+                    if remove_ids:
+                        await self._journal.fail(remove_ids, e)
+                    raise
+                self._changed([r for r in adds if r not in current], [])
+            if removes:
+                self.calls += len(removes)
+                await self._call(remove_ids, member.remove_roles, *removes)
+                self._changed([], [r for r in removes if r in current])
+        except discord.HTTPException as e:
+            self.failed += 1
+            logging.warning(f"Role update failed for member {member.id}: {e}")
+
+    async def _record(self, member, adds, removes):
+        if self._journal is None:
+            return [], []
+        rows = [
+            (member.guild.id, member.id, role.id, add, "reaction")
+            for roles, add in ((adds, True), (removes, False))
+            for role in roles
+        ]
+        try:
+            ids = await self._journal.record(rows)
+        except Exception as e:
+            logging.warning(
+                f"Journaling role changes for member {member.id} failed: {e}"
+            )
+            return [], []
+        return ids[:len(adds)], ids[len(adds):]
+
+    async def _supersede(self, member, changes):
+        # a failed operation waiting for a retry must not undo these changes
+        if self._journal is None:
+            return
+        try:
+            await self._journal.supersede([
+                (member.guild.id, member.id, role.id) for role, add in changes
+            ])
+        except Exception as e:
+            logging.warning(
+                f"Journaling role changes for member {member.id} failed: {e}"
+            )
+
+    async def _call(self, ids, func, *args, **kwargs):
+        if self._scheduler is None:
+            call = func(*args, **kwargs)
+        else:
+            call = self._scheduler.call(INTERACTIVE, func, *args, **kwargs)
+        if not ids:
+            return await call
+        return await self._journal.track(ids, call)
+
+    async def drain(self):
+        """
+        Flushes all pending changes immediately and waits until all flushes
+        have finished.
+        """
+
+        for key in list(self._pending):
+            self._start_flush(key)
+        while self._flushing:
+            await asyncio.gather(*self._flushing)
+
+    def stats(self):
+        """
+        Returns a dictionary of the queue's counters. Saved calls are the
+        settled changes that did not need their own API call.
+        """
+
+        return {
+            "pending": len(self._pending),
+            "requested": self.requested,
+            "calls": self.calls,
+            "saved": self.settled - self.calls,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
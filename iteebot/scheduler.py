@@ -0,0 +1,241 @@
+"""
+Outbound request scheduling for ITEEBot. All calls the bot makes to the
+Discord API go through OutboundScheduler, which paces them with a token
+bucket so that the bot stays under the global rate limit, and orders them by
+priority lane. Interactive work (role changes from reactions and replies to
+commands) is always dispatched before bulk admin jobs, so a large role reset
+can't starve students that are signing up at the same time.
+
+Paginated listings (channel history, reaction users and guild members) are
+read with OutboundScheduler.pages, which schedules every page request as a
+call of its own instead of iterating discord.py's listing in one call.
+"""
+
+import asyncio
+import collections
+import logging
+import time
+
+INTERACTIVE = 0
+BULK = 1
+LANE_NAMES = ("interactive", "bulk")
+
+class TokenBucket:
+    """
+    Token bucket for pacing calls. Tokens are added at a constant rate up to
+    a maximum burst size, and each call consumes one token.
+    """
+
+    def __init__(self, rate, burst):
+        """
+        * rate (float) - tokens added per second
+        * burst (int) - maximum number of tokens stored
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.burst,
+            self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self):
+        """
+        Waits until a token is available and consumes it.
+        """
+
+        self._refill()
+        while self._tokens < 1:
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+            self._refill()
+        self._tokens -= 1
+
+
+class OutboundScheduler:
+    """
+    Dispatches API calls from priority lanes. Each lane is a FIFO queue, and
+    the dispatcher always takes the next call from the highest priority lane
+    that has calls waiting. Dispatching is paced by a token bucket, and the
+    number of calls in flight is limited. The dispatcher task is started when
+    the first call is submitted.
+    """
+
+    def __init__(self, rate=40, burst=10, concurrency=8, metrics=None):
+        """
+        * rate (float) - calls per second on average
+        * burst (int) - calls that can be made at once after idle time
+        * concurrency (int) - maximum number of calls in flight
+        * metrics (Metrics) - optional registry for recording call latency
+        """
+
+        self._metrics = metrics
+        self._bucket = TokenBucket(rate, burst)
+        self._concurrency = concurrency
+        self._lanes = [collections.deque() for name in LANE_NAMES]
+        self._lane_stats = [
+            {"submitted": 0, "dispatched": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for name in LANE_NAMES
+        ]
+        self._dispatcher = None
+        self._wakeup = None
+        self._slots = None
+        self._running = set()
+
+    async def call(self, lane, func, *args, **kwargs):
+        """
+        Queues func(*args, **kwargs) in the given lane, waits until it has
+        been dispatched and completed, and returns its result.
+
+        * lane (int) - INTERACTIVE or BULK
+        * func (coroutine function) - the API call to make
+        """
+
+        self._ensure_dispatcher()
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append(
+            (func, args, kwargs, future, time.monotonic())
+        )
+        self._lane_stats[lane]["submitted"] += 1
+        self._wakeup.set()
+        return await future
+
+    async def pages(self, lane, fetch, cursor, size=100, limit=None):
+        """
+        Iterates over a paginated listing, e.g. channel history, scheduling
+        each page request in the given lane. fetch is called with the page
+        size as limit, and after the first page with the last item of the
+        previous page as the cursor argument.
+
+        * lane (int) - INTERACTIVE or BULK
+        * fetch (function) - returns an async iterator of items
+        * cursor (str) - argument of fetch that continues from an item,
+          e.g. before for history
+        * size (int) - items per page, at most what one request returns
+        * limit (int) - maximum number of items, None for all
+        """
+
+        async def page(**kwargs):
+            return [item async for item in fetch(**kwargs)]
+
+        page.__name__ = fetch.__name__
+        last = None
+        while limit is None or limit > 0:
+            kwargs = {"limit": size if limit is None else min(size, limit)}
+            if last is not None:
+                kwargs[cursor] = last
+            items = await self.call(lane, page, **kwargs)
+            for item in items:
+                yield item
+            if len(items) < kwargs["limit"]:
+                return
+            if limit is not None:
+                limit -= len(items)
+            last = items[-1]
+
+    def _ensure_dispatcher(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._slots = asyncio.Semaphore(self._concurrency)
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    def _next(self):
+        for lane, queue in enumerate(self._lanes):
+            while queue:
+                item = queue.popleft()
+                if not item[3].done():
+                    return lane, item
+        return None
+
+    async def _dispatch(self):
+        while True:
+            if not any(self._lanes):
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            await self._slots.acquire()
+            await self._bucket.acquire()
+            selected = self._next()
+            if selected is None:
+                self._slots.release()
+                continue
+
+            lane, (func, args, kwargs, future, queued) = selected
+            waited = time.monotonic() - queued
+            stats = self._lane_stats[lane]
+            stats["dispatched"] += 1
+            stats["wait_total"] += waited
+            stats["wait_max"] = max(stats["wait_max"], waited)
+            task = asyncio.create_task(
+                self._execute(lane, func, args, kwargs, future)
+            )
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _execute(self, lane, func, args, kwargs, future):
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception as e:
+            if self._metrics is not None:
+                self._metrics.inc(
+                    "outbound_call_errors",
+                    lane=LANE_NAMES[lane], call=func.__name__
+                )
+            if not future.done():
+                future.set_exception(e)
+        else:
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._slots.release()
+            if self._metrics is not None:
+                self._metrics.observe(
+                    "outbound_call_seconds",
+                    time.perf_counter() - start,
+                    lane=LANE_NAMES[lane], call=func.__name__
+                )
+
+    def stats(self):
+        """
+        Returns queue depth, call counts and wait times (in seconds) for each
+        lane as a dictionary keyed by lane name.
+        """
+
+        result = {}
+        for name, queue, stats in zip(LANE_NAMES, self._lanes, self._lane_stats):
+            dispatched = stats["dispatched"]
+            result[name] = {
+                "depth": len(queue),
+                "submitted": stats["submitted"],
+                "dispatched": dispatched,
+                "wait_avg": stats["wait_total"] / dispatched if dispatched else 0.0,
+                "wait_max": stats["wait_max"],
+            }
+        return result
+
+    async def close(self):
+        """
+        Stops the dispatcher after waiting for calls in flight. Calls still in
+        the queues are cancelled.
+        """
+
+        if self._running:
+            await asyncio.gather(*self._running, return_exceptions=True)
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        for queue in self._lanes:
+            while queue:
+                queue.popleft()[3].cancel()
+        logging.debug("Outbound scheduler closed")
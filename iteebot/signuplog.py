@@ -0,0 +1,132 @@
+"""
+Signup event log for ITEEBot. Every reaction handled on a signup message is
+recorded as a signup event so that signups can be counted per course and
+period afterwards. Writing a row for each reaction would add a database
+round trip to every reaction, so events are collected into an in-memory
+buffer that is written behind the handlers: in one multi-row insert when
+the flush interval has passed since the first buffered event, or as soon as
+the buffer reaches its batch size. Writes are made one at a time, in the
+order the events were recorded. The buffer is flushed when the bot shuts
+down.
+
+If a write fails, the events are put back into the buffer and written with
+the next flush. Events beyond a limit of ten batches are dropped and
+counted, so that a database outage can't grow the buffer without bounds.
+"""
+
+import asyncio
+import logging
+
+from .database import utcnow
+
+class SignupLog:
+    """
+    Write-behind buffer of signup events. Counters (attributes):
+    * recorded (int) - events recorded
+    * written (int) - events written to the database
+    * flushes (int) - inserts made
+    * dropped (int) - events dropped after failed writes
+    """
+
+    def __init__(self, database, flush_interval=5.0, batch_size=500):
+        """
+        * database (AsyncDatabase) - database access layer
+        * flush_interval (float) - seconds an event can wait in the buffer
+        * batch_size (int) - number of buffered events that causes a flush
+        """
+
+        self._db = database
+        self._interval = flush_interval
+        self._batch_size = batch_size
+        self._limit = batch_size * 10
+        self._buffer = []
+        self._timer = None
+        self._flushing = set()
+        self._write_lock = asyncio.Lock()
+        self._closed = False
+        self.recorded = 0
+        self.written = 0
+        self.flushes = 0
+        self.dropped = 0
+
+    def record(self, action, message_id, role_id, guild_id=None,
+               user_id=None):
+        """
+        Buffers one signup event. Doesn't wait for the database.
+
+        * action (str) - add, remove or clear
+        * message_id (int) - ID of the signup message
+        * role_id (int) - ID of the course's role
+        * guild_id (int) - ID of the guild
+        * user_id (int) - ID of the reacting user
+        """
+
+        self.recorded += 1
+        self._buffer.append({
+            "action": action,
+            "message_id": message_id,
+            "role_id": role_id,
+            "guild_id": guild_id,
+            "user_id": user_id,
+            "created_at": utcnow(),
+        })
+        if len(self._buffer) >= self._batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                self._interval, self._start_flush
+            )
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        rows, self._buffer = self._buffer, []
+        task = asyncio.create_task(self._flush(rows))
+        self._flushing.add(task)
+        task.add_done_callback(self._flushing.discard)
+
+    async def _flush(self, rows):
+        try:
+            async with self._write_lock:
+                await self._db.add_signup_events(rows)
+        except Exception as e:
+            logging.warning(f"Writing {len(rows)} signup events failed: {e}")
+            self._buffer[:0] = rows
+            if len(self._buffer) > self._limit:
+                excess = len(self._buffer) - self._limit
+                del self._buffer[:excess]
+                self.dropped += excess
+            if self._timer is None and not self._closed:
+                self._timer = asyncio.get_running_loop().call_later(
+                    self._interval, self._start_flush
+                )
+            return
+        self.flushes += 1
+        self.written += len(rows)
+
+    async def close(self):
+        """
+        Writes all buffered events and waits until all writes have finished.
+        Events that fail to be written at this point are lost.
+        """
+
+        self._closed = True
+        self._start_flush()
+        while self._flushing:
+            await asyncio.gather(*self._flushing)
+
+    def stats(self):
+        """
+        Returns a dictionary of the buffer size and counters.
+        """
+
+        return {
+            "pending": len(self._buffer),
+            "recorded": self.recorded,
+            "written": self.written,
+            "flushes": self.flushes,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,386 @@
+"""
+Stand-ins for the parts of the discord.py interface the bot uses: guilds,
+channels, messages, roles and members that live in memory instead of on
+Discord. They are used by the test suite and by the replay command, and are
+part of the package so that the replay command works wherever the bot is
+installed. Stand-ins that make API calls in the real interface share a
+MockAPI object, which can be configured to inject latency and random
+failures into those calls.
+"""
+
+import asyncio
+import itertools
+import random
+
+import discord
+
+_message_ids = itertools.count(1000000)
+
+
+class MockAPI:
+    """
+    Simulated API conditions. Each simulated API call waits for the
+    configured latency and then fails with the given probability. Calls and
+    failures are counted.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        """
+        * latency (float) - seconds each call takes
+        * failure_rate (float) - probability of a call failing
+        * seed (int) - seed for the failure random generator
+        """
+
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self.failures = 0
+        self._random = random.Random(seed)
+
+    async def call(self):
+        """
+        Simulates making an API call. Raises MockHTTPException for injected
+        failures.
+        """
+
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self._random.random() < self.failure_rate:
+            self.failures += 1
+            raise MockHTTPException()
+
+
+class MockHTTPException(discord.HTTPException):
+    """
+    Mockup for API errors. Doesn't need a response object.
+    """
+
+    def __init__(self, text="mock API failure", status=500):
+        Exception.__init__(self, text)
+        self.text = text
+        self.status = status
+        self.code = 0
+
+class MockNotFound(MockHTTPException, discord.NotFound):
+    """
+    Mockup for not found errors.
+    """
+
+    def __init__(self, text="mock not found"):
+        super().__init__(text, 404)
+
+
+class MockMessage:
+    """
+    Mockup for Message. Messages sent by the mock client have None as their
+    author, matching the user attribute of a client that hasn't logged in.
+    Messages in a channel get their guild and API from the channel unless
+    given.
+    """
+    
+    def __init__(self, msg_id, content, author=None, attachments=(),
+                 guild=None, api=None, channel=None):
+        self.content = content
+        self.id = msg_id
+        self.channel = channel
+        if guild is None and channel is not None:
+            guild = channel.guild
+        self.guild = guild
+        self.author = author
+        self.attachments = list(attachments)
+        self.reactions = []
+        if api is None and channel is not None:
+            api = channel._api
+        self._api = api or MockAPI()
+
+    async def edit(self, content=None):
+        """
+        Simulates editing the message's content.
+        """
+
+        await self._api.call()
+        if content is not None:
+            self.content = content
+
+    async def add_reaction(self, emoji):
+        """
+        Simulates the bot reacting to the message.
+        """
+
+        await self._api.call()
+        self.reactions.append(MockReaction([], me=True, emoji=emoji))
+
+
+class MockReaction:
+    """
+    Mockup for message reactions. Holds the users that have reacted, other
+    than the bot, whose reaction is only included in the count.
+    """
+
+    def __init__(self, users, me=False, emoji="\N{WHITE HEAVY CHECK MARK}"):
+        self._users = list(users)
+        self.me = me
+        self.emoji = emoji
+
+    @property
+    def count(self):
+        return len(self._users) + (1 if self.me else 0)
+
+    async def users(self, limit=None, after=None):
+        """
+        Simulates listing reactors, in the order of their IDs like the API.
+        """
+
+        users = sorted(self._users, key=lambda user: user.id)
+        if after is not None:
+            users = [user for user in users if user.id > after.id]
+        for user in users[:limit]:
+            yield user
+
+
+class MockChannel:
+    """
+    Mockup for channel. Has a mockup send method that appends messages sent by
+    the bot to a list, making them accessible for verification. Bulk deletes
+    are counted in bulk_deletes.
+    """
+    
+    def __init__(self, channel_id, api=None, guild=None):
+        self.id = channel_id
+        self.guild = guild
+        self.bulk_deletes = 0
+        self._log = []
+        self._api = api or MockAPI()
+
+    async def send(self, message):
+        """
+        Simulates sending a message, by appending a message objects to the
+        channel's log list.
+        """
+    
+        await self._api.call()
+        msg_obj = MockMessage(
+            next(_message_ids),
+            message,
+            channel=self
+        )
+        self._log.append(msg_obj)
+        return msg_obj
+
+    async def fetch_message(self, msg_id):
+        """
+        Simulates fetching a message by its ID.
+        """
+
+        await self._api.call()
+        for msg_obj in self._log:
+            if msg_obj.id == msg_id:
+                return msg_obj
+        raise MockNotFound()
+
+    async def delete_messages(self, messages):
+        """
+        Simulates the bulk delete API, which deletes 2 to 100 messages
+        younger than two weeks in one call.
+        """
+
+        await self._api.call()
+        self.bulk_deletes += 1
+        ids = {m.id for m in messages}
+        self._log = [m for m in self._log if m.id not in ids]
+
+    def get_partial_message(self, msg_id):
+        """
+        Returns a stand-in for a message that can be deleted by its ID.
+        """
+
+        return MockPartialMessage(self, msg_id)
+
+    async def history(self, limit=100, before=None):
+        """
+        Simulates reading channel history, newest messages first, from the
+        message before the given one if any.
+        """
+
+        await self._api.call()
+        messages = self._log[::-1]
+        if before is not None:
+            ids = [msg_obj.id for msg_obj in messages]
+            messages = messages[ids.index(before.id) + 1:]
+        for msg_obj in messages[:limit]:
+            yield msg_obj
+
+
+class MockPartialMessage:
+    """
+    Mockup for PartialMessage, only supports deleting the message.
+    """
+
+    def __init__(self, channel, msg_id):
+        self.channel = channel
+        self.id = msg_id
+
+    async def delete(self):
+        """
+        Simulates deleting the message from its channel.
+        """
+
+        await self.channel._api.call()
+        ids = [m.id for m in self.channel._log]
+        if self.id not in ids:
+            raise MockNotFound()
+        del self.channel._log[ids.index(self.id)]
+
+
+class MockRole:
+    """
+    Mockup class for simulating roles.
+    """
+
+    def __init__(self, role_id, guild=None):
+        self.id = role_id
+        self.guild = guild
+
+    def is_default(self):
+        return False
+
+    @property
+    def members(self):
+        """
+        Members of the role's guild that have this role.
+        """
+
+        if self.guild is None:
+            return []
+        return [m for m in self.guild._members.values() if self in m.roles]
+
+
+class MockGuild:
+    """
+    Mockup for guild objects. Has methods for adding roles and members, as well
+    as the get and fetch methods that are part of a real guild object's
+    interface. If cache_members is False, get_member finds nothing like in
+    the bot's low-memory mode, and members need to be fetched.
+    """
+
+    cache_members = True
+    
+    def __init__(self, guild_id, api=None):
+        self.id = guild_id
+        self._roles = {}
+        self._members = {}
+        self._api = api or MockAPI()
+        
+    def create_role(self, role_id):
+        """
+        Creates and returns a new mock role object with the given ID. The role
+        is stored internally with its ID in the roles dictionary.
+        
+        * role_id (int) - ID number for the new role
+        """
+    
+        role = MockRole(role_id, self)
+        self._roles[role_id] = role
+        return role
+        
+    def create_member(self, user_id):
+        """
+        Creates and returns a mock member object with the given ID. The member is
+        is stored internally with its ID in the members dictionary.
+        
+        * user_id (intt) - ID number for the new member
+        """
+        
+        member = MockMember(user_id, self)
+        self._members[user_id] = member
+        return member
+        
+    def get_role(self, role_id):
+        """
+        Returns a role object that corresponds to role_id
+        
+        * role_id (int) - ID number for role lookup
+        """
+        return self._roles.get(role_id)
+    
+    def get_member(self, user_id):
+        """
+        Returns a member object that corresponds to user_id
+        
+        * user_id (int) - ID number for member lookup
+        """
+    
+        if not self.cache_members:
+            return None
+        return self._members.get(user_id)
+
+    async def fetch_member(self, user_id):
+        await self._api.call()
+        member = self._members.get(user_id)
+        if member is None:
+            raise MockNotFound()
+        return member.snapshot()
+
+    async def fetch_members(self, limit=None, after=None):
+        # one API call per page of 1000 members like the real endpoint, in
+        # the order of their IDs
+        members = sorted(self._members.values(), key=lambda m: m.id)
+        if after is not None:
+            members = [m for m in members if m.id > after.id]
+        for i, member in enumerate(members[:limit]):
+            if i % 1000 == 0:
+                await self._api.call()
+            yield member.snapshot()
+
+
+class MockMember:
+    """
+    Mockup for guild members. The members created by the guild hold the
+    member's state on the server, and fetched members are snapshots of it
+    that aren't updated afterwards, like discord.py's member objects outside
+    the member cache. Role API calls change the server state: atomic calls
+    one role at a time, and other calls by sending the full role list built
+    from the calling object's roles, like discord.py. Role API calls are
+    counted in the calls attribute of the server state.
+    """
+    
+    def __init__(self, user_id, guild=None):
+        self.roles = set()
+        self.id = user_id
+        self.guild = guild
+        self.calls = 0
+        self._api = guild._api if guild is not None else MockAPI()
+        self._server = self
+
+    def snapshot(self):
+        """
+        Returns a copy of the member as the API would return it now.
+        """
+
+        member = MockMember(self.id, self.guild)
+        member.roles = set(self._server.roles)
+        member._server = self._server
+        return member
+        
+    async def add_roles(self, *roles, atomic=True):
+        self._server.calls += 1
+        await self._api.call()
+        if atomic:
+            self._server.roles.update(roles)
+        else:
+            self._server.roles = self.roles | set(roles)
+        
+    async def remove_roles(self, *roles, atomic=True):
+        self._server.calls += 1
+        await self._api.call()
+        if atomic:
+            self._server.roles.difference_update(roles)
+        else:
+            self._server.roles = self.roles - set(roles)
+
+    async def edit(self, roles=None):
+        self._server.calls += 1
+        await self._api.call()
+        if roles is not None:
+            self._server.roles = set(roles)
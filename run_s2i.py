@@ -1,6 +1,6 @@
 import os
 import iteebot.database as db
-from iteebot.bot import ITEEBot
+from iteebot.bot import create_bot
 from iteebot.configurator import load_config
 
 if __name__ == "__main__":
@@ -8,9 +8,12 @@ if __name__ == "__main__":
     
     # add values from secrets
     config["TOKEN"] = os.environ["DISCORD_TOKEN"]
-    config["DB"]= os.environ["DB_STRING"]
+    if isinstance(config["DB"], dict):
+        config["DB"]["URL"] = os.environ["DB_STRING"]
+    else:
+        config["DB"] = os.environ["DB_STRING"]
     
     db.init_db(config["DB"])
-    bot = ITEEBot(config)
+    bot = create_bot(config, config_path=os.environ["CONFIG_PATH"])
     bot.run()
     
@@ -7,20 +7,35 @@ instead. This class has mockup methods for the interface functions the bot is
 trying to call.
 """
 
+import asyncio
+import datetime
+import discord
 import json
+import multiprocessing
 import os
 import pytest
 import random
+import signal
 import tempfile
+import time
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import Session
 from click.testing import CliRunner
 from iteebot import database
 from iteebot.configurator import FACTORY, load_config
-from iteebot.manage import init_db, create_config
+from iteebot.coordination import Coordinator
+from iteebot.logs import setup_logging, stop_logging
+from iteebot.bot import ShardedITEEBot, create_bot
+from iteebot.metrics import MetricsServer
+from iteebot.journal import RoleJournal, RoleOperation
+from iteebot.rolequeue import RoleChangeQueue
+from iteebot.scheduler import OutboundScheduler, INTERACTIVE, BULK
+from iteebot.manage import init_db, create_config, migrate, replay_recording
 
 from tests.mocks import *
 
 TEST_CHANNEL = 7357
+CONTROL_CHANNEL = 7358
 TEST_MESSAGE = 4451
 
 @pytest.fixture
@@ -35,6 +50,7 @@ def config_path():
     local = {
         "DB": f"sqlite:///{db_name}",
         "SIGNUP_CHANNEL": TEST_CHANNEL,
+        "CONTROL_CHANNEL": CONTROL_CHANNEL,
     }
     with os.fdopen(cfg_fd, "w") as cfg_file:
         json.dump(local, cfg_file)
@@ -44,7 +60,7 @@ def config_path():
     os.unlink(cfg_name)
 
 @pytest.fixture
-def bot(config_path):
+async def bot(config_path):
     """
     Bot fixture for getting an instance of the bot. A derived MockClient class
     is used instead of ITEEBot.
@@ -57,6 +73,7 @@ def bot(config_path):
     bot = MockClient(config, debug=True)
     bot.run()
     yield bot
+    await bot.close()
 
 def populate_db(engine):
     """
@@ -94,6 +111,62 @@ def test_db_init(config_path):
     runner = CliRunner()
     result = runner.invoke(init_db, [config_path])
     assert result.exit_code == 0
+
+def test_migrate_legacy_db(config_path):
+    """
+    Tests that the migrate command upgrades a database created before schema
+    versioning. Duplicate message IDs make the migration fail without
+    changes, listing the rows. Once they have been removed, the database is
+    upgraded to the same tables and indexes as a new database.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    config = load_config(config_path)
+    engine = create_engine(config["DB"])
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE course_table (id INTEGER PRIMARY KEY, "
+            "code VARCHAR NOT NULL, name_fi VARCHAR, name_en VARCHAR, "
+            "message_id INTEGER NOT NULL, role_id INTEGER NOT NULL)"
+        ))
+        for i in range(3):
+            conn.execute(text(
+                "INSERT INTO course_table (code, message_id, role_id) "
+                f"VALUES ('c{i}', {TEST_MESSAGE}, {i})"
+            ))
+    runner = CliRunner()
+    result = runner.invoke(migrate, [config_path])
+    assert result.exit_code == 1
+    assert "id 2: code c1, message_id 4451, role_id 1" in result.output
+    with engine.begin() as conn:
+        assert database.get_schema_version(conn) == 0
+        conn.execute(text("DELETE FROM course_table WHERE id > 1"))
+    result = runner.invoke(migrate, [config_path])
+    assert result.exit_code == 0
+    assert "from schema version 0" in result.output
+
+    def schema(engine):
+        inspector = inspect(engine)
+        return {
+            table: (
+                {c["name"] for c in inspector.get_columns(table)},
+                {
+                    (i["name"], tuple(i["column_names"]), bool(i["unique"]))
+                    for i in inspector.get_indexes(table)
+                },
+            )
+            for table in inspector.get_table_names()
+        }
+
+    fresh = create_engine("sqlite://")
+    database.Base.metadata.create_all(fresh)
+    with engine.connect() as conn:
+        assert database.get_schema_version(conn) == database.SCHEMA_VERSION
+    assert schema(engine) == schema(fresh)
+    with Session(engine) as s:
+        assert s.query(database.Course).one().role_id == 0
+    result = runner.invoke(migrate, [config_path])
+    assert "up to date" in result.output
     
 @pytest.mark.asyncio
 async def test_command_test(bot):
@@ -138,6 +211,1280 @@ async def test_reaction(bot):
     member = guild.create_member(1)
     reaction = MockReactionEvent(msg, TEST_CHANNEL, guild.id, member)
     await bot.on_raw_reaction_add(reaction)
+    await bot._roles.drain()
     assert role in member.roles
     await bot.on_raw_reaction_remove(reaction)
+    await bot._roles.drain()
     assert role not in member.roles
+
+@pytest.mark.asyncio
+async def test_course_index(bot):
+    """
+    Tests that reactions are resolved from the course index after the first
+    lookup, that unknown messages are cached as negatives, and that adding a
+    course updates the index without a database lookup.
+
+    * bot (fixture) - configured testable bot object
+    """
+    populate_db(bot._engine)
+    msg = MockMessage(TEST_MESSAGE, "placeholder")
+    other = MockMessage(TEST_MESSAGE + 1, "placeholder")
+    guild = bot.create_guild(1)
+    role = guild.create_role(1)
+    member = guild.create_member(1)
+    for i in range(3):
+        await bot.on_raw_reaction_add(
+            MockReactionEvent(msg, TEST_CHANNEL, guild.id, member)
+        )
+        await bot.on_raw_reaction_add(
+            MockReactionEvent(other, TEST_CHANNEL, guild.id, member)
+        )
+    stats = bot._courses.stats()
+    assert stats["misses"] == 2
+    assert stats["hits"] == 2
+    assert stats["negative_hits"] == 2
+    await bot._roles.drain()
+    assert member.roles == {role}
+
+    bot.create_channel(TEST_CHANNEL)
+    await bot._parse_command(MockMessage(2, "!addcourse,2,code,name,nimi"))
+    signup = bot.get_channel(TEST_CHANNEL)._log[-1]
+    assert bot._courses.get(signup.id).role_id == 2
+
+@pytest.mark.asyncio
+async def test_slow_db_does_not_block(bot, monkeypatch):
+    """
+    Tests that a slow database call made by a reaction handler does not delay
+    other handlers, as database access runs outside the event loop.
+
+    * bot (fixture) - configured testable bot object
+    """
+
+    def slow_find_courses(session, message_id):
+        time.sleep(0.5)
+        return []
+
+    monkeypatch.setattr(database, "find_courses", slow_find_courses)
+    guild = bot.create_guild(1)
+    member = guild.create_member(1)
+    reaction = MockReactionEvent(
+        MockMessage(TEST_MESSAGE, "placeholder"), TEST_CHANNEL, guild.id, member
+    )
+    slow = asyncio.create_task(bot.on_raw_reaction_add(reaction))
+    await asyncio.sleep(0)
+    start = time.perf_counter()
+    await bot._parse_command(MockMessage(1, "!test"))
+    assert time.perf_counter() - start < 0.1
+    assert not slow.done()
+    await slow
+
+@pytest.mark.asyncio
+async def test_command_resetrole(bot):
+    """
+    Tests the !resetrole command. The role should be removed from all members
+    except the one whose removal fails, and a summary should be reported to
+    the control channel.
+
+    * bot (fixture) - configured testable bot object
+    """
+    control = bot.create_channel(CONTROL_CHANNEL)
+    guild = bot.create_guild(1)
+    role = guild.create_role(1)
+    for i in range(50):
+        member = guild.create_member(i)
+        member.roles.add(role)
+
+    async def fail(*roles):
+        raise MockHTTPException()
+
+    guild.get_member(7).remove_roles = fail
+    msg = MockMessage(1, "!resetrole,1")
+    msg.guild = guild
+    await bot._parse_command(msg)
+    assert role.members == [guild.get_member(7)]
+    assert "49/50 done, 1 failed" in control._log[-1].content
+
+@pytest.mark.asyncio
+async def test_reaction_coalescing(bot):
+    """
+    Tests that role changes from quick successive reactions by one member are
+    combined into a single API call, and that a react-unreact pair makes no
+    API calls at all.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    member = guild.create_member(1)
+    events = []
+    with Session(bot._engine) as s:
+        for i in range(1, 4):
+            guild.create_role(i)
+            s.add(database.Course(code=str(i), message_id=i, role_id=i))
+            events.append(MockReactionEvent(
+                MockMessage(i, "signup"), TEST_CHANNEL, guild.id, member
+            ))
+        s.commit()
+    old = guild.create_role(4)
+    member.roles.add(old)
+    for event in events:
+        await bot.on_raw_reaction_add(event)
+    await bot.on_raw_reaction_remove(events[0])
+    await bot.on_raw_reaction_add(events[0])
+    await bot.on_raw_reaction_remove(events[2])
+    await bot._roles.drain()
+    assert member.roles == {guild.get_role(1), guild.get_role(2), old}
+    assert member.calls == 1
+
+    await bot.on_raw_reaction_remove(events[1])
+    await bot.on_raw_reaction_add(events[1])
+    await bot._roles.drain()
+    assert member.calls == 1
+    stats = bot._roles.stats()
+    assert stats["saved"] == 7
+    assert stats["skipped"] == 1
+
+@pytest.mark.asyncio
+async def test_role_queue_slow_api():
+    """
+    Tests that a member's role changes whose window closes while the
+    member's previous flush is still waiting for a slow API are flushed after
+    it, on top of the roles it set, even before the member object is updated,
+    and that role edits are built from the member's roles when the scheduler
+    dispatches them.
+    """
+    guild = MockGuild(1, MockAPI(latency=0.1))
+    member = guild.create_member(1)
+    cached = member.snapshot()
+    first, second, old = (guild.create_role(i) for i in range(1, 4))
+    member.roles.add(old)
+    cached.roles.add(old)
+    scheduler = OutboundScheduler()
+    queue = RoleChangeQueue(settle=0.01, scheduler=scheduler)
+
+    queue.add(cached, first)
+    await asyncio.sleep(0.05)
+    queue.add(cached, second)
+    queue.remove(cached, old)
+    await asyncio.sleep(0.05)
+    assert queue.stats()["pending"] == 1
+    await queue.drain()
+    assert member.roles == {first, second}
+    assert member.calls == 2
+    await scheduler.close()
+
+    scheduler = OutboundScheduler(rate=10, burst=1)
+    await scheduler.call(INTERACTIVE, asyncio.sleep, 0)
+    queue = RoleChangeQueue(settle=0.01, scheduler=scheduler)
+    queue.remove(member, second)
+    await asyncio.sleep(0.03)
+    member.roles.add(old)
+    await queue.drain()
+    assert member.roles == {first, old}
+    await scheduler.close()
+
+@pytest.mark.asyncio
+async def test_scheduler_priority():
+    """
+    Tests that the outbound scheduler dispatches interactive calls ahead of
+    queued bulk calls, and paces calls with its token bucket.
+    """
+    scheduler = OutboundScheduler(rate=20, burst=1, concurrency=4)
+    order = []
+
+    async def call(name):
+        order.append(name)
+
+    start = time.perf_counter()
+    bulk = [
+        asyncio.create_task(scheduler.call(BULK, call, f"bulk{i}"))
+        for i in range(4)
+    ]
+    await asyncio.sleep(0.01)
+    await scheduler.call(INTERACTIVE, call, "interactive")
+    await asyncio.gather(*bulk)
+    assert order.index("interactive") <= 2
+    assert time.perf_counter() - start >= 0.15
+    stats = scheduler.stats()
+    assert stats["bulk"]["dispatched"] == 4
+    assert stats["interactive"]["depth"] == 0
+    await scheduler.close()
+
+async def test_scheduler_pages():
+    """
+    Tests that paginated listings are read one scheduled call per page, and
+    that interactive calls are dispatched between the pages.
+    """
+    scheduler = OutboundScheduler(rate=100, burst=1)
+    channel = MockChannel(1)
+    for i in range(250):
+        await channel.send(f"message {i}")
+    order = []
+
+    async def call(name):
+        order.append(name)
+
+    async def read(limit=None):
+        async for message in scheduler.pages(
+            BULK, channel.history, "before", limit=limit
+        ):
+            order.append(message.content)
+
+    reading = asyncio.create_task(read())
+    await asyncio.sleep(0.005)
+    await scheduler.call(INTERACTIVE, call, "interactive")
+    await reading
+    assert order[0] == "message 249" and order[-1] == "message 0"
+    assert 0 < order.index("interactive") < 250
+    assert scheduler.stats()["bulk"]["dispatched"] == 3
+
+    order.clear()
+    await read(limit=150)
+    assert order[-1] == "message 100"
+    assert scheduler.stats()["bulk"]["dispatched"] == 5
+    await scheduler.close()
+
+@pytest.mark.asyncio
+async def test_reaction_storm_benchmark():
+    """
+    Runs a small reaction storm benchmark with injected API latency and
+    failures to check that the benchmark suite works and that handlers keep
+    going past failed API calls.
+    """
+    from benchmarks.reaction_storm import parse_args, run_benchmark
+
+    options = parse_args([
+        "--events", "2000", "--members", "100", "--courses", "10",
+        "--latency", "0.001", "--failure-rate", "0.1",
+    ])
+    results = await run_benchmark(options)
+    assert sum(h["count"] for h in results["handlers"].values()) == 2000
+    assert results["api"]["failures"] > 0
+    assert results["role_queue"]["failed"] > 0
+    assert results["handlers"]["on_raw_reaction_add"]["p99_ms"] >= 0
+
+@pytest.mark.asyncio
+async def test_metrics(bot):
+    """
+    Tests that handler, database and API call latencies are recorded, that
+    the stats command summarizes them, and that the HTTP endpoint serves them
+    in the Prometheus text format.
+
+    * bot (fixture) - configured testable bot object
+    """
+    import aiohttp
+
+    populate_db(bot._engine)
+    control = bot.create_channel(CONTROL_CHANNEL)
+    guild = bot.create_guild(1)
+    guild.create_role(1)
+    member = guild.create_member(1)
+    reaction = MockReactionEvent(
+        MockMessage(TEST_MESSAGE, "placeholder"), TEST_CHANNEL, guild.id, member
+    )
+    await bot.on_raw_reaction_add(reaction)
+    await bot._roles.drain()
+    await bot._parse_command(MockMessage(1, "!stats"))
+    report = control._log[-1].content
+    assert "on_raw_reaction_add: 1 calls" in report
+    assert "find_courses: 1 calls" in report
+    assert "edit_roles/interactive: 1 calls" in report
+
+    server = MetricsServer(bot._metrics, port=0)
+    await server.start()
+    try:
+        url = f"http://127.0.0.1:{server.port}/metrics"
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                text = await response.text()
+    finally:
+        await server.stop()
+    assert 'iteebot_handler_seconds_count{handler="on_raw_reaction_add"} 1' in text
+    assert 'iteebot_commands_total{command="stats"} 1' in text
+    assert "iteebot_course_index_hits" in text
+    assert 'iteebot_outbound_depth{lane="bulk"} 0' in text
+
+@pytest.mark.asyncio
+async def test_command_validation(bot):
+    """
+    Tests that commands with wrong argument counts or types are rejected with
+    a usage message instead of an error, and that a second resetrole is
+    rejected while the first one is still running.
+
+    * bot (fixture) - configured testable bot object
+    """
+    control = bot.create_channel(CONTROL_CHANNEL)
+    await bot._parse_command(MockMessage(1, "!addcourse,123,code"))
+    assert "Usage: !addcourse,role_id,course_code" in control._log[-1].content
+    await bot._parse_command(MockMessage(1, "!resetrole,abc"))
+    assert "Invalid value for role_id" in control._log[-1].content
+
+    bot.api.latency = 0.01
+    guild = bot.create_guild(1)
+    role = guild.create_role(1)
+    for i in range(10):
+        guild.create_member(i).roles.add(role)
+    msg = MockMessage(1, "!resetrole,1")
+    msg.guild = guild
+    first = asyncio.create_task(bot._parse_command(msg))
+    await asyncio.sleep(0.005)
+    await bot._parse_command(msg)
+    assert "resetrole is already running" in control._log[-1].content
+    await first
+    assert not role.members
+
+@pytest.mark.asyncio
+async def test_command_importcourses(bot):
+    """
+    Tests importing courses from an attached CSV file. A message left behind
+    by an interrupted import is reused, missing names are left empty, a
+    failed send is reported, and a rerun only posts the course that failed.
+
+    * bot (fixture) - configured testable bot object
+    """
+    control = bot.create_channel(CONTROL_CHANNEL)
+    signup = bot.create_channel(TEST_CHANNEL)
+    csv_data = "role_id,code,name_en,name_fi\n" + "".join(
+        f"{i},C{i},Course {i},Kurssi {i}\n" for i in range(1, 6)
+    ) + "6,C6,,\n"
+    await signup.send("C1 Course 1 / Kurssi 1")
+    send = signup.send
+
+    async def flaky_send(content):
+        if content.startswith("C3 "):
+            raise MockHTTPException()
+        return await send(content)
+
+    signup.send = flaky_send
+    msg = MockMessage(
+        1, "!importcourses", attachments=[MockAttachment("c.csv", csv_data)]
+    )
+    await bot._parse_command(msg)
+    assert "5 added (1 reused existing messages)" in control._log[-1].content
+    assert "1 failed" in control._log[-1].content
+    assert len(signup._log) == 5
+    assert signup._log[-1].content == "C6  / "
+
+    signup.send = send
+    await bot._parse_command(msg)
+    assert "1 added" in control._log[-1].content
+    assert "5 already registered" in control._log[-1].content
+    assert len(signup._log) == 6
+    with Session(bot._engine) as s:
+        assert s.query(database.Course).count() == 6
+    assert len(bot._courses) == 6
+
+@pytest.mark.asyncio
+async def test_reconcile(bot):
+    """
+    Tests startup reconciliation: users who reacted while the bot was offline
+    get the role, members without a reaction keep it unless removing is
+    enabled, and a second pass is skipped based on the stored checkpoint
+    until the reactions change.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    signup = bot.create_channel(TEST_CHANNEL, guild)
+    role = guild.create_role(1)
+    members = [guild.create_member(i) for i in range(6)]
+    msg = await signup.send("signup")
+    reaction = MockReaction(members[:3])
+    msg.reactions.append(reaction)
+    members[2].roles.add(role)
+    members[3].roles.add(role)
+    with Session(bot._engine) as s:
+        s.add(database.Course(code="C", message_id=msg.id, role_id=1))
+        s.commit()
+
+    summary, = await bot._reconcile()
+    assert "1 courses checked" in summary
+    assert set(role.members) == set(members[:4])
+    with Session(bot._engine) as s:
+        checkpoint = s.get(database.CourseCheckpoint, role.id)
+        assert checkpoint.reaction_count == 3
+        assert checkpoint.member_count == 4
+
+    summary, = await bot._reconcile()
+    assert "0 courses checked, 1 unchanged" in summary
+
+    bot._cfg["RECONCILE"]["REMOVE"] = True
+    reaction._users.append(members[5])
+    summary, = await bot._reconcile()
+    assert "1 courses checked" in summary
+    assert set(role.members) == set(members[:3] + members[5:])
+
+@pytest.mark.asyncio
+async def test_multi_guild(config_path):
+    """
+    Tests per-guild configuration: commands post to their own guild's signup
+    channel with the guild's template, and reactions are only handled for
+    courses of the guild they happen in. Also checks that a sharded bot is
+    created when sharding is enabled.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    config = load_config(config_path)
+    config["GUILDS"] = {
+        "2": {
+            "CONTROL_CHANNEL": 21,
+            "SIGNUP_CHANNEL": 22,
+            "MESSAGES": {"SIGNUP": "{code}!"}
+        },
+    }
+    database.init_db(config["DB"])
+    bot = MockClient(config, debug=True)
+    bot.run()
+    guild_a = bot.create_guild(1)
+    guild_b = bot.create_guild(2)
+    bot.create_channel(TEST_CHANNEL, guild_a)
+    control_b = bot.create_channel(21, guild_b)
+    signup_b = bot.create_channel(22, guild_b)
+    role_b = guild_b.create_role(5)
+    member_b = guild_b.create_member(1)
+    guild_a.create_role(5)
+    member_a = guild_a.create_member(1)
+
+    await bot._parse_command(
+        MockMessage(1, "!addcourse,5,B1,name,nimi", guild=guild_b)
+    )
+    signup = signup_b._log[-1]
+    assert signup.content == "B1!"
+    await bot._parse_command(MockMessage(1, "!stats", guild=guild_b))
+    assert control_b._log[-1].content.startswith("Course index")
+
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(signup, TEST_CHANNEL, guild_a.id, member_a)
+    )
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(signup, 22, guild_b.id, member_b)
+    )
+    await bot._roles.drain()
+    assert not member_a.roles
+    assert member_b.roles == {role_b}
+    await bot.close()
+
+    config["SHARDING"] = {"ENABLED": True, "SHARD_COUNT": 2}
+    sharded = create_bot(config, debug=True)
+    assert isinstance(sharded, ShardedITEEBot)
+    assert sharded.shard_count == 2
+    sharded._db.close()
+
+
+def claim_worker(db_url, holder):
+    """
+    Runs in a separate process for test_cluster_leases. Claims a share of six
+    shards split between three processes, and tries to take a job lease.
+
+    * db_url (str) - shared database URL
+    * holder (str) - lease holder name of the process
+    """
+
+    async def claim():
+        async_db = database.AsyncDatabase(database.get_engine(db_url))
+        coordinator = Coordinator(async_db, holder, ttl=30)
+        shard_ids = await coordinator.claim_shards(6, 3)
+        job = await coordinator.acquire("job:reconcile:None")
+        async_db.close()
+        return shard_ids, job
+
+    return asyncio.run(claim())
+
+def test_cluster_leases(config_path):
+    """
+    Tests that processes sharing a database claim disjoint shares of the
+    shards, that only one of them gets a job lease, and that expired leases
+    can be taken over.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+
+    config = load_config(config_path)
+    database.init_db(config["DB"])
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(3) as pool:
+        results = pool.starmap(
+            claim_worker, [(config["DB"], f"p{i}") for i in range(3)]
+        )
+    shards = [shard_id for shard_ids, job in results for shard_id in shard_ids]
+    assert sorted(shards) == list(range(6))
+    assert all(len(shard_ids) == 2 for shard_ids, job in results)
+    assert [job for shard_ids, job in results].count(True) == 1
+
+    engine = database.get_engine(config["DB"])
+    with Session(engine) as s:
+        assert not database.acquire_lease(s, "shard:0", "p3", 30)
+        s.query(database.Lease).update(
+            {"expires_at": database.utcnow() - datetime.timedelta(seconds=1)}
+        )
+        s.commit()
+        assert database.acquire_lease(s, "shard:0", "p3", 30)
+    engine.dispose()
+
+    config["CLUSTER"]["ENABLED"] = True
+    with pytest.raises(ValueError):
+        create_bot(config, debug=True)
+
+@pytest.mark.asyncio
+async def test_run_once(config_path):
+    """
+    Tests that jobs run from the command line set up the bot for the job
+    without starting the metrics endpoint or signal handlers.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    config = load_config(config_path)
+    config["METRICS"].update(ENABLED=True, PORT=0)
+    database.init_db(config["DB"])
+    bot = MockClient(config, debug=True)
+    bot.run()
+
+    async def login(token):
+        await bot.setup_hook()
+
+    async def job(value):
+        return value, bot._metrics_server
+
+    bot.login = login
+    assert await bot.run_once(job, 1) == (1, None)
+    loop = asyncio.get_running_loop()
+    assert not loop.remove_signal_handler(signal.SIGTERM)
+
+@pytest.mark.asyncio
+async def test_lease_renewal_failure():
+    """
+    Tests that failed lease renewals are retried, and that all held leases
+    are reported lost when they can't be renewed before the TTL ends.
+    """
+
+    class FailingDatabase:
+        async def acquire_lease(self, name, holder, ttl):
+            raise OSError("database is down")
+
+    coordinator = Coordinator(FailingDatabase(), "p0", ttl=0.3)
+    coordinator.held.update({"shard:0", "shard:1"})
+    lost = []
+
+    async def on_lost(names):
+        lost.append(sorted(names))
+
+    task = asyncio.create_task(coordinator.run_renewal(on_lost))
+    await asyncio.sleep(0.15)
+    assert not lost and len(coordinator.held) == 2
+    await asyncio.sleep(0.1)
+    assert lost == [["shard:0", "shard:1"]]
+    assert not coordinator.held
+    task.cancel()
+
+async def test_leases_lost(config_path):
+    """
+    Tests that losing the leases shuts the bot down from the lease renewal
+    task, and that role changes pending at that point are still made.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+
+    config = load_config(config_path)
+    config["ROLE_QUEUE"]["SETTLE"] = 0.05
+    database.init_db(config["DB"])
+    bot = MockClient(config, debug=True)
+    bot.api = MockAPI(latency=0.05)
+    bot.run()
+    guild = bot.create_guild(1)
+    role = guild.create_role(1)
+    member = guild.create_member(1)
+    await bot.setup_hook()
+    bot._roles.add(member, role)
+    bot._lease_task = asyncio.create_task(bot._leases_lost(["shard:0"]))
+    await bot._lease_task
+    await bot._shutdown_task
+    assert bot.is_closed()
+    assert role in member.roles
+
+async def test_config_reload(bot, config_path):
+    """
+    Tests that configuration is deep merged over the factory configuration,
+    that a reload swaps in new channels and templates, and that an invalid
+    file or a change to a restart-only option doesn't take effect.
+
+    * bot (fixture) - bot instance
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+
+    local = {
+        "SIGNUP_CHANNEL": 42,
+        "BULK": {"CONCURRENCY": 2},
+        "MESSAGES": {"SIGNUP": "{code}?"},
+        "DB": "sqlite:///other.db",
+    }
+    with open(config_path, "w") as f:
+        json.dump(local, f)
+    config = load_config(config_path)
+    assert config["BULK"] == {
+        "CONCURRENCY": 2,
+        "PROGRESS_INTERVAL": FACTORY["BULK"]["PROGRESS_INTERVAL"]
+    }
+
+    bot._config_path = config_path
+    old_db = bot._cfg["DB"]
+    assert bot.reload_config()
+    assert 42 in bot._signup_channels
+    assert TEST_CHANNEL not in bot._signup_channels
+    assert bot._guild_config(None)["MESSAGES"]["SIGNUP"] == "{code}?"
+    assert bot._cfg["DB"] == old_db
+
+    with open(config_path, "w") as f:
+        json.dump({"MESSAGES": {"SIGNUP": "{course}"}}, f)
+    assert not bot.reload_config()
+    assert 42 in bot._signup_channels
+
+async def test_logging(bot, tmp_path):
+    """
+    Tests that logs are written through the background writer in the JSON
+    format with structured fields and tracebacks, that the configured number
+    of backups is used, and that on_error handles keyword arguments.
+
+    * bot (fixture) - bot instance
+    * tmp_path (fixture) - temporary directory for the log file
+    """
+
+    log_cfg = dict(
+        FACTORY["LOG"], FILE=str(tmp_path / "iteebot.log"), FORMAT="json"
+    )
+    target = setup_logging(log_cfg)
+    assert target.backupCount == FACTORY["LOG"]["BACKUPS"]
+    try:
+        raise RuntimeError("boom")
+    except RuntimeError:
+        await bot.on_error("on_message", 1, content="x")
+    stop_logging()
+
+    with open(log_cfg["FILE"]) as f:
+        entry = json.loads(f.readline())
+    assert entry["event"] == "on_message"
+    assert entry["message"].endswith("arguments 1, content='x'")
+    assert "RuntimeError: boom" in entry["exception"]
+
+def test_startup_benchmark():
+    """
+    Runs the startup benchmark for the commands that don't need Discord and
+    checks that they don't import discord.py.
+    """
+    from benchmarks.startup import parse_args, run_benchmark
+
+    results = run_benchmark(parse_args([
+        "--repeat", "1", "--only", "init-config", "init-db"
+    ]))
+    assert not results["init-config"]["discord"]
+    assert not results["init-config"]["sqlalchemy"]
+    assert not results["init-db"]["discord"]
+    assert results["init-db"]["import_ms"] > 0
+
+async def test_db_settings(config_path):
+    """
+    Tests that engine and SQLite options from a DB configuration section are
+    applied, and runs a small database settings benchmark.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    from benchmarks.db_settings import parse_args, run_benchmark
+
+    config = load_config(config_path)
+    db_cfg = dict(FACTORY["DB"], URL=config["DB"], POOL_SIZE=2)
+    database.init_db(db_cfg)
+    engine = database.get_engine(db_cfg)
+    assert engine.pool.size() == 2
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+    engine.dispose()
+
+    results = await run_benchmark(parse_args([
+        "--courses", "20", "--lookups", "200", "--only", "default", "wal"
+    ]))
+    assert results["wal"]["insert_per_s"] > 0
+
+async def test_low_memory(config_path):
+    """
+    Tests low-memory mode: discord.py's member cache and startup chunking
+    are disabled, removed reactions find members from the LRU or by fetching
+    them, role changes through stale members don't undo other changes, and
+    role resets scan the guild's members.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    config = load_config(config_path)
+    config["MEMBERS"]["LOW_MEMORY"] = True
+    database.init_db(config["DB"])
+    populate_db(database.get_engine(config["DB"]))
+    bot = MockClient(config, debug=True)
+    bot.run()
+    assert not bot._connection.member_cache_flags.value
+    assert not bot._connection._chunk_guilds
+    bot.create_channel(TEST_CHANNEL)
+    guild = bot.create_guild(1)
+    role = guild.create_role(1)
+    other = guild.create_role(2)
+    first = guild.create_member(1)
+    second = guild.create_member(2)
+    message = MockMessage(TEST_MESSAGE, "")
+
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(message, TEST_CHANNEL, 1, first.snapshot())
+    )
+    await bot._roles.drain()
+    first.roles.add(other)
+    second.roles.add(role)
+    for member in (first, second):
+        event = MockReactionEvent(message, TEST_CHANNEL, 1, member)
+        event.member = None
+        await bot.on_raw_reaction_remove(event)
+    await bot._roles.drain()
+    assert first.roles == {other} and not second.roles
+    stats = bot._members.stats()
+    assert stats["hits"] == 1 and stats["fetches"] == 1
+
+    first.roles.add(role)
+    await bot._parse_command(MockMessage(1, "!resetrole,1", guild=guild))
+    assert first.roles == {other}
+    assert bot._members.stats()["scans"] == 1
+    await bot.close()
+
+async def test_signup_log(config_path):
+    """
+    Tests that reactions are recorded as signup events, written in batches
+    when the batch size is reached and on shutdown, without waiting for the
+    database in the handlers.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    config = load_config(config_path)
+    config["SIGNUP_LOG"]["BATCH_SIZE"] = 3
+    config["SIGNUP_LOG"]["FLUSH_INTERVAL"] = 60
+    database.init_db(config["DB"])
+    populate_db(database.get_engine(config["DB"]))
+    bot = MockClient(config, debug=True)
+    bot.run()
+    bot.create_channel(TEST_CHANNEL)
+    guild = bot.create_guild(1)
+    guild.create_role(1)
+    message = MockMessage(TEST_MESSAGE, "")
+    for user_id in range(4):
+        event = MockReactionEvent(
+            message, TEST_CHANNEL, 1, guild.create_member(user_id)
+        )
+        await bot.on_raw_reaction_add(event)
+    await bot.on_raw_reaction_remove(event)
+    await asyncio.sleep(0)
+    assert bot._signups.stats()["pending"] == 2
+    await bot.close()
+
+    stats = bot._signups.stats()
+    assert stats["written"] == 5 and stats["flushes"] == 2
+    with Session(database.get_engine(config["DB"])) as s:
+        events = s.query(database.SignupEvent).order_by("id").all()
+    assert [e.action for e in events] == ["add"] * 4 + ["remove"]
+    assert events[-1].user_id == 3 and events[-1].role_id == 1
+
+async def test_coursestats(bot):
+    """
+    Tests that signup counters start from zero for new courses, follow the
+    role changes made for reactions but not repeated reactions, are
+    corrected by reconciliation, and are reported by the coursestats command
+    in messages that fit Discord's length limit.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    signup = bot.create_channel(TEST_CHANNEL, guild)
+    control = bot.create_channel(CONTROL_CHANNEL, guild)
+    role = guild.create_role(5)
+    members = [guild.create_member(i) for i in range(3)]
+    await bot._parse_command(
+        MockMessage(1, "!addcourse,5,C1,Course,Kurssi", guild=guild)
+    )
+    msg = signup._log[-1]
+    for member in members:
+        await bot.on_raw_reaction_add(
+            MockReactionEvent(msg, TEST_CHANNEL, 1, member)
+        )
+    await bot.on_raw_reaction_remove(
+        MockReactionEvent(msg, TEST_CHANNEL, 1, members[0])
+    )
+    await bot._roles.drain()
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(msg, TEST_CHANNEL, 1, members[1])
+    )
+    await bot._roles.drain()
+    await bot._parse_command(MockMessage(1, "!coursestats", guild=guild))
+    assert control._log[-1].content == "C1 Course: 2"
+
+    members[0].roles.add(role)
+    msg.reactions.append(MockReaction(members[1:]))
+    await bot._reconcile()
+    assert bot._counts.get(role.id) == 3
+
+    await bot._report_lines(["x" * 1500, "y" * 1500], 1)
+    assert [len(m.content) for m in control._log[-2:]] == [1500, 1500]
+
+async def test_pack_courses(bot):
+    """
+    Tests packing single-course signup messages into a grouped message:
+    reactions on the grouped message are routed by emoji, the bot's own
+    reactions are ignored, old messages keep working, and reconciliation
+    counts reactions on both for the role.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    signup = bot.create_channel(TEST_CHANNEL, guild)
+    control = bot.create_channel(CONTROL_CHANNEL, guild)
+    roles = [guild.create_role(i) for i in (1, 2, 3)]
+    members = [guild.create_member(i) for i in range(3)]
+    for role in roles:
+        await bot._parse_command(MockMessage(
+            1, f"!addcourse,{role.id},C{role.id},Course,Kurssi", guild=guild
+        ))
+    old = signup._log[0]
+    old.reactions.append(MockReaction([members[0]]))
+    members[0].roles.add(roles[0])
+
+    await bot._parse_command(MockMessage(1, "!packcourses,2", guild=guild))
+    assert "3 courses packed into 2 messages" in control._log[-1].content
+    grouped = signup._log[3]
+    a, b = "\N{REGIONAL INDICATOR SYMBOL LETTER A}", \
+        "\N{REGIONAL INDICATOR SYMBOL LETTER B}"
+    assert grouped.content == f"{a} C1 Course / Kurssi\n{b} C2 Course / Kurssi"
+    assert [r.emoji for r in grouped.reactions] == [a, b]
+
+    me = guild.create_member(99)
+    bot._connection.user = me
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(grouped, TEST_CHANNEL, 1, me, emoji=a)
+    )
+    await bot._roles.drain()
+    bot._connection.user = None
+    assert not me.roles and bot._counts.get(1) == 0
+
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(grouped, TEST_CHANNEL, 1, members[1], emoji=b)
+    )
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(grouped, TEST_CHANNEL, 1, members[2], emoji="x")
+    )
+    await bot._roles.drain()
+    assert members[1].roles == {roles[1]}
+    assert not members[2].roles
+
+    grouped.reactions[1]._users.append(members[1])
+    await bot._reconcile()
+    assert roles[0] in members[0].roles
+    assert bot._counts.get(1) == 1 and bot._counts.get(2) == 1
+
+    await bot._parse_command(MockMessage(1, "!packcourses", guild=guild))
+    assert "0 courses packed" in control._log[-1].content
+    await bot._parse_command(MockMessage(1, "!coursestats", guild=guild))
+    assert control._log[-1].content.count("C1") == 1
+
+async def test_pack_courses_shared(bot):
+    """
+    Tests that a role signed up for on both the old and the grouped message
+    of a packed course is only removed when the member has un-reacted on
+    both, and that clearing the reactions of one message only removes the
+    role from members who haven't reacted to the other.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    signup = bot.create_channel(TEST_CHANNEL, guild)
+    bot.create_channel(CONTROL_CHANNEL, guild)
+    role = guild.create_role(1)
+    members = [guild.create_member(i) for i in range(3)]
+    await bot._parse_command(MockMessage(
+        1, "!addcourse,1,C1,Course,Kurssi", guild=guild
+    ))
+    await bot._parse_command(MockMessage(1, "!packcourses", guild=guild))
+    old, grouped = signup._log
+    old.reactions.append(MockReaction([]))
+    emoji = grouped.reactions[0].emoji
+
+    async def react(message, member, reaction, add=True):
+        if add:
+            message.reactions[0]._users.append(member)
+            await bot.on_raw_reaction_add(MockReactionEvent(
+                message, TEST_CHANNEL, 1, member, emoji=reaction
+            ))
+        else:
+            message.reactions[0]._users.remove(member)
+            await bot.on_raw_reaction_remove(MockReactionEvent(
+                message, TEST_CHANNEL, 1, member, emoji=reaction
+            ))
+        await bot._roles.drain()
+
+    check = "\N{WHITE HEAVY CHECK MARK}"
+    await react(old, members[0], check)
+    await react(grouped, members[0], emoji)
+    await react(old, members[0], check, add=False)
+    assert role in members[0].roles
+    await react(grouped, members[0], emoji, add=False)
+    assert role not in members[0].roles
+
+    await react(old, members[0], check)
+    await react(grouped, members[0], emoji)
+    await react(grouped, members[1], emoji)
+    assert bot._counts.get(1) == 2
+    grouped.reactions[0]._users.clear()
+    await bot.on_raw_reaction_clear(
+        MockReactionEvent(grouped, TEST_CHANNEL, 1, members[0])
+    )
+    assert role in members[0].roles
+    assert role not in members[1].roles
+    assert bot._counts.get(1) == 1
+
+async def test_rerender(bot):
+    """
+    Tests that rerender only edits signup messages that differ from the
+    current template, paces the edits, and resumes after a failed edit
+    without reading the channel again for messages that are done.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    signup = bot.create_channel(TEST_CHANNEL, guild)
+    control = bot.create_channel(CONTROL_CHANNEL, guild)
+    for i in range(4):
+        await bot._parse_command(MockMessage(
+            1, f"!addcourse,{i},C{i},Course,Kurssi", guild=guild
+        ))
+    await bot._parse_command(MockMessage(1, "!rerender", guild=guild))
+    assert control._log[-1].content.startswith("Re-render done: 0 edited, 4")
+
+    assert bot.reload_config(dict(
+        bot._cfg,
+        MESSAGES=dict(bot._cfg["MESSAGES"], SIGNUP="{code}: {name_en}"),
+        RERENDER={"EDIT_RATE": 20, "EDIT_BURST": 1},
+    ))
+    signup._log[0].content = "C0: Course"
+
+    async def fail(content=None):
+        raise MockHTTPException()
+
+    signup._log[1].edit = fail
+    start = time.perf_counter()
+    await bot._parse_command(MockMessage(1, "!rerender", guild=guild))
+    assert time.perf_counter() - start >= 0.09
+    assert control._log[-1].content == (
+        "Re-render done: 2 edited, 1 unchanged, 0 missing, 1 failed"
+    )
+    assert [m.content for m in signup._log[2:4]] == ["C2: Course", "C3: Course"]
+
+    del signup._log[1].edit
+    await bot._parse_command(MockMessage(1, "!rerender", guild=guild))
+    assert control._log[-1].content == (
+        "Re-render done: 1 edited, 3 unchanged, 0 missing, 0 failed"
+    )
+    assert signup._log[1].content == "C1: Course"
+
+async def test_record_replay(config_path, tmp_path):
+    """
+    Tests recording handled reaction events and replaying them with the
+    replay command: the replay handles every event and ends with the
+    expected roles, and a replay with a different signup channel reports
+    the users whose roles differ.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    recording = str(tmp_path / "events.jsonl")
+    config = load_config(config_path)
+    config["RECORD"] = {"ENABLED": True, "FILE": recording}
+    database.init_db(config["DB"])
+    populate_db(database.get_engine(config["DB"]))
+    bot = MockClient(config, debug=True)
+    bot.run()
+    await bot.setup_hook()
+    guild = bot.create_guild(1)
+    guild.create_role(1)
+    members = [guild.create_member(i) for i in range(1, 4)]
+    msg = MockMessage(TEST_MESSAGE, "placeholder")
+    for member in members:
+        await bot.on_raw_reaction_add(
+            MockReactionEvent(msg, TEST_CHANNEL, 1, member)
+        )
+    await bot.on_raw_reaction_remove(
+        MockReactionEvent(msg, TEST_CHANNEL, 1, members[0])
+    )
+    await bot.on_raw_reaction_add(
+        MockReactionEvent(MockMessage(1, ""), TEST_CHANNEL + 1, 1, members[0])
+    )
+    await bot.close()
+    with open(recording) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line["e"] for line in lines] == ["start"] + ["add"] * 3 + ["remove"]
+    assert lines[0]["courses"][0]["r"] == 1
+
+    runner = CliRunner()
+    result = await asyncio.to_thread(
+        runner.invoke, replay_recording, [recording, config_path, "--unpaced"]
+    )
+    assert result.exit_code == 0, result.output
+    report = json.loads(result.output)
+    assert report["events"] == 4 and report["errors"] == 0
+    assert report["latency"]["add"]["count"] == 3
+    assert report["state"] == {"users": 3, "differences": 0, "diffs": []}
+
+    other = tmp_path / "other.json"
+    other.write_text(json.dumps({"SIGNUP_CHANNEL": TEST_CHANNEL + 1}))
+    result = await asyncio.to_thread(
+        runner.invoke, replay_recording, [recording, str(other), "--unpaced"]
+    )
+    report = json.loads(result.output)
+    assert report["state"]["differences"] == 2
+    assert report["state"]["diffs"][0]["missing"] == [1]
+
+async def test_role_journal(config_path, tmp_path):
+    """
+    Tests the role journal: a failed removal of a role reset is retried
+    after a restart together with an operation left in flight, becomes a
+    dead letter after its last attempt even if its retries raise unexpected
+    errors, and is made when it's requeued.
+    Finally the bot is shut down with SIGTERM's handler.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    """
+    config = load_config(config_path)
+    config["JOURNAL"].update(
+        ENABLED=True, FILE=str(tmp_path / "journal.db"), BACKOFF=0.01,
+        MAX_ATTEMPTS=2, POLL_INTERVAL=0.01
+    )
+    config["RECONCILE"]["ENABLED"] = False
+    database.init_db(config["DB"])
+
+    async def fail(*roles, atomic=True):
+        raise MockHTTPException()
+
+    async def crash(*roles, atomic=True):
+        raise RuntimeError("unexpected")
+
+    def start(bot):
+        bot.run()
+        control = bot.create_channel(CONTROL_CHANNEL)
+        guild = bot.create_guild(1)
+        role = guild.create_role(1)
+        guild.create_role(2)
+        for i in range(5):
+            guild.create_member(i).roles.add(role)
+        return control, guild
+
+    bot = MockClient(config, debug=True)
+    _, guild = start(bot)
+    await bot.setup_hook()
+    guild.get_member(3).remove_roles = fail
+    await bot._remove_role_from_all(guild.get_role(1), "Reset")
+    await bot._journal.record([(1, 4, 2, True, "reaction")])
+    await bot.close()
+    assert bot._journal.stats() == {
+        "recorded": 6, "finished": 4, "failed": 1, "dead": 0
+    }
+
+    bot = MockClient(config, debug=True)
+    control, guild = start(bot)
+    guild.get_member(3).remove_roles = crash
+    await bot.setup_hook()
+    await bot.on_ready()
+    for _ in range(100):
+        if bot._journal.dead:
+            break
+        await asyncio.sleep(0.01)
+    assert guild.get_role(2) in guild.get_member(4).roles
+    assert bot._journal.stats()["dead"] == 1
+
+    msg = MockMessage(1, "!deadletters")
+    msg.guild = guild
+    await bot._parse_command(msg)
+    assert control._log[-1].content.startswith("1 dead letters\n")
+    assert "remove role 1 from user 3 (Reset, 2 attempts)" in (
+        control._log[-1].content
+    )
+
+    del guild.get_member(3).remove_roles
+    msg = MockMessage(2, "!retrydead")
+    msg.guild = guild
+    await bot._parse_command(msg)
+    assert control._log[-1].content == "1 dead letters requeued"
+    for _ in range(100):
+        if guild.get_role(1) not in guild.get_member(3).roles:
+            break
+        await asyncio.sleep(0.01)
+    assert guild.get_role(1) not in guild.get_member(3).roles
+
+    bot._terminate()
+    await bot._shutdown_task
+    assert bot._journal_task.cancelled()
+    with Session(create_engine(f"sqlite:///{tmp_path / 'journal.db'}")) as s:
+        assert s.execute(text("SELECT COUNT(*) FROM role_operation")).scalar() == 0
+
+async def failed_signups(config_path, tmp_path):
+    """
+    Starts a bot with the role journal for the journal supersede tests, and
+    makes two members react while their role edits fail, leaving failed
+    adds waiting for a retry. Returns the bot, guild, role and members.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    * tmp_path (fixture) - directory for the journal file
+    """
+    config = load_config(config_path)
+    config["JOURNAL"].update(ENABLED=True, FILE=str(tmp_path / "journal.db"))
+    config["ROLE_QUEUE"]["SETTLE"] = 0.01
+    database.init_db(config["DB"])
+    populate_db(database.get_engine(config["DB"]))
+    bot = MockClient(config, debug=True)
+    bot.run()
+    bot.create_channel(TEST_CHANNEL)
+    bot.create_channel(CONTROL_CHANNEL)
+    guild = bot.create_guild(1)
+    role = guild.create_role(1)
+    members = [guild.create_member(1), guild.create_member(2)]
+    await bot.setup_hook()
+
+    async def fail(roles=None):
+        raise MockHTTPException()
+
+    for member in members:
+        member.edit = fail
+        await bot.on_raw_reaction_add(
+            MockReactionEvent(MockMessage(TEST_MESSAGE, ""), TEST_CHANNEL, 1,
+                              member)
+        )
+    await bot._roles.drain()
+    assert bot._journal.stats()["failed"] == 2
+    return bot, guild, role, members
+
+async def journaled_users(journal):
+    """
+    Returns the user IDs of the operations in a role journal.
+
+    * journal (RoleJournal) - the role journal
+    """
+    return await journal._db.run(
+        lambda s: sorted(op.user_id for op in s.query(RoleOperation))
+    )
+
+async def test_role_journal_unreact(config_path, tmp_path):
+    """
+    Tests that a failed add waiting for a retry is dropped from the journal
+    when the member un-reacts, even though the removal needs no API call.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    * tmp_path (fixture) - directory for the journal file
+    """
+    bot, guild, role, members = await failed_signups(config_path, tmp_path)
+    await bot.on_raw_reaction_remove(MockReactionEvent(
+        MockMessage(TEST_MESSAGE, ""), TEST_CHANNEL, 1, members[0]
+    ))
+    await bot._roles.drain()
+    assert await journaled_users(bot._journal) == [2]
+    await bot.close()
+
+async def test_role_journal_reset(config_path, tmp_path):
+    """
+    Tests that resetting a role drops its failed adds from the journal, so
+    that retries don't give the role back after the reset.
+
+    * config_path (fixture) - path to the test configuration for loading it
+    * tmp_path (fixture) - directory for the journal file
+    """
+    bot, guild, role, members = await failed_signups(config_path, tmp_path)
+    await bot._parse_command(MockMessage(1, "!resetrole,1", guild=guild))
+    assert await journaled_users(bot._journal) == []
+    await bot.close()
+
+async def test_role_journal_discard(tmp_path):
+    """
+    Tests that discarding a role's operations keeps those of the users who
+    keep the role.
+
+    * tmp_path (fixture) - directory for the journal file
+    """
+    journal = RoleJournal(str(tmp_path / "journal.db"))
+    await journal.open()
+    await journal.record([
+        (1, user_id, 1, True, "reaction") for user_id in (1, 2, 3)
+    ])
+    assert await journal.discard_role(1, 1, {2}) == 2
+    assert await journaled_users(journal) == [2]
+    await journal.close()
+
+async def test_role_journal_flush(tmp_path, caplog):
+    """
+    Tests that finished operations whose batched delete fails are logged and
+    kept, and deleted when the journal is closed.
+    """
+    journal = RoleJournal(str(tmp_path / "journal.db"), flush_interval=0.01)
+    await journal.open()
+    ids = await journal.record([(1, 1, 1, True, "reaction")])
+    run = journal._db.run
+
+    async def fail_once(func, *args):
+        journal._db.run = run
+        raise OSError("disk I/O error")
+
+    journal._db.run = fail_once
+    journal.finish(ids)
+    await asyncio.sleep(0.05)
+    assert "disk I/O error" in caplog.text
+    await journal.close()
+    with Session(create_engine(f"sqlite:///{tmp_path / 'journal.db'}")) as s:
+        assert s.execute(text("SELECT COUNT(*) FROM role_operation")).scalar() == 0
+
+async def test_rollover(bot):
+    """
+    Tests archiving courses with !rollover: young signup messages are deleted
+    in bulk and old ones one by one, a grouped message that still has a
+    course left is kept, roles are cleared, and the archived courses leave
+    the course table and index.
+
+    * bot (fixture) - configured testable bot object
+    """
+    guild = bot.create_guild(1)
+    signup = bot.create_channel(TEST_CHANNEL, guild)
+    control = bot.create_channel(CONTROL_CHANNEL, guild)
+    roles = [guild.create_role(i) for i in (1, 2, 3, 4)]
+    members = [guild.create_member(i) for i in range(4)]
+    for member, role in zip(members, roles):
+        member.roles.add(role)
+    await bot._parse_command(MockMessage(
+        1, "!addcourse,1,C1,Course,Kurssi", guild=guild
+    ))
+    young = discord.utils.time_snowflake(discord.utils.utcnow())
+    for i in range(3):
+        signup._log.append(MockMessage(young + i, "signup"))
+    with Session(bot._engine) as s:
+        s.add_all([
+            database.Course(code="C2", message_id=young, role_id=2, guild_id=1),
+            database.Course(code="C3", message_id=young + 1, role_id=3,
+                            guild_id=1),
+            database.Course(code="C2", message_id=young + 2, role_id=2,
+                            guild_id=1, emoji="a"),
+            database.Course(code="C4", message_id=young + 2, role_id=4,
+                            guild_id=1, emoji="b"),
+        ])
+        s.commit()
+    await bot._load_courses()
+
+    await bot._parse_command(MockMessage(1, "!rollover", guild=guild))
+    assert "Give the codes" in control._log[-1].content
+    await bot._parse_command(MockMessage(1, "!rollover,C1,C2,C3", guild=guild))
+    assert control._log[-1].content == (
+        "Rollover done: 4 courses archived, 3 signup messages deleted "
+        "(2 in bulk), 0 missing, 0 failed, 1 kept for other courses. "
+        "Cleared 3 roles from 3 members, 0 failed"
+    )
+    assert [m.id for m in signup._log] == [young + 2]
+    assert signup.bulk_deletes == 1
+    assert [m.roles for m in members] == [set(), set(), set(), {roles[3]}]
+    assert await bot._get_courses(young) == []
+    assert [c.code for c in await bot._get_courses(young + 2)] == ["C4"]
+    with Session(bot._engine) as s:
+        assert [c.code for c in s.query(database.Course)] == ["C4"]
+        assert sorted(
+            c.code for c in s.query(database.ArchivedCourse)
+        ) == ["C1", "C2", "C2", "C3"]